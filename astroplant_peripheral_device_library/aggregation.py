@@ -0,0 +1,274 @@
+"""
+Local aggregation of sensor samples.
+
+Samples are collected per channel (physical quantity and unit) in
+fixed-capacity ring buffers backed by `array`, such that sampling does not
+create a Python object per sample. At each aggregate window boundary (a
+multiple of the aggregate interval, in wall clock time), the samples of each
+channel are summarized in one pass over the buffer (vectorized with NumPy
+if it is installed; it is imported on the first summary, not with the
+drivers).
+
+Sensors enable local aggregation with the "localAggregation" configuration
+option. `measure` then returns measurements only at window boundaries, with
+the mean of the window's samples as their value; the full summary is kept as
+`LocalAggregation.latest`.
+"""
+
+import datetime
+import math
+import statistics
+import time
+from array import array
+from collections import namedtuple
+
+# NumPy, None if not installed, or False if not imported yet.
+_np = False
+
+Summary = namedtuple(
+    "Summary", ["count", "minimum", "maximum", "mean", "median", "stddev"]
+)
+
+Aggregate = namedtuple(
+    "Aggregate", ["physical_quantity", "physical_unit", "start", "end", "summary"]
+)
+
+
+class RingBuffer(object):
+    """
+    A fixed-capacity buffer of floats, overwriting the oldest samples when
+    full.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self._data = array("d", bytes(8 * capacity))
+        self._next = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def append(self, value: float):
+        self._data[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self._len = min(self._len + 1, self.capacity)
+
+    def clear(self):
+        self._next = 0
+        self._len = 0
+
+    def unordered(self) -> memoryview:
+        """
+        A view of the samples in the buffer, in no particular order.
+        """
+        return memoryview(self._data)[: self._len]
+
+    def values(self) -> array:
+        """
+        A copy of the samples in the buffer, oldest first.
+        """
+        if self._len < self.capacity:
+            return self._data[: self._len]
+        return self._data[self._next :] + self._data[: self._next]
+
+
+def _numpy():
+    global _np
+    if _np is False:
+        try:
+            import numpy
+
+            _np = numpy
+        except ImportError:
+            _np = None
+    return _np
+
+
+def summarize(values) -> Summary:
+    """
+    Summarize samples.
+
+    :param values: A buffer of doubles, e.g. `RingBuffer.unordered()`.
+    """
+    count = len(values)
+    if count == 0:
+        nan = float("nan")
+        return Summary(0, nan, nan, nan, nan, nan)
+
+    np = _numpy()
+    if np is not None:
+        data = np.frombuffer(values, dtype=np.float64)
+        return Summary(
+            count,
+            float(data.min()),
+            float(data.max()),
+            float(data.mean()),
+            float(np.median(data)),
+            float(data.std()),
+        )
+
+    data = values.tolist()
+    mean = math.fsum(data) / count
+    return Summary(
+        count,
+        min(data),
+        max(data),
+        mean,
+        statistics.median(data),
+        statistics.pstdev(data, mean),
+    )
+
+
+class Aggregator(object):
+    """
+    Collects samples per channel, and summarizes them per aggregate window.
+
+    :param aggregate_interval: The length of a window, in seconds.
+    :param capacity: The maximum number of samples kept per channel and
+    window. Older samples are overwritten when more are collected.
+    """
+
+    def __init__(self, aggregate_interval: float, capacity: int):
+        self.aggregate_interval = aggregate_interval
+        self.capacity = capacity
+        # Buffers per (physical quantity, physical unit), in order of first
+        # sample.
+        self.channels = {}
+        self.window_start = None
+
+    def _window_start(self, timestamp: float) -> float:
+        return math.floor(timestamp / self.aggregate_interval) * self.aggregate_interval
+
+    def add(
+        self, physical_quantity: str, physical_unit: str, value: float, timestamp=None
+    ):
+        """
+        Add a sample.
+
+        :param timestamp: The wall clock time of the sample, defaults to
+        now.
+        :return: The aggregates of the preceding window, if this sample is
+        the first of a new window; otherwise an empty list.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        aggregates = []
+        window_start = self._window_start(timestamp)
+        if self.window_start is None:
+            self.window_start = window_start
+        elif window_start > self.window_start:
+            aggregates = self.collect()
+            self.window_start = window_start
+
+        key = (physical_quantity, physical_unit)
+        buffer = self.channels.get(key)
+        if buffer is None:
+            buffer = self.channels[key] = RingBuffer(self.capacity)
+        buffer.append(value)
+        return aggregates
+
+    def collect(self) -> list:
+        """
+        Summarize and clear the samples of the current window.
+        """
+        if self.window_start is None:
+            return []
+
+        start = self.window_start
+        end = start + self.aggregate_interval
+        aggregates = []
+        for ((physical_quantity, physical_unit), buffer) in self.channels.items():
+            if len(buffer) == 0:
+                continue
+            aggregates.append(
+                Aggregate(
+                    physical_quantity,
+                    physical_unit,
+                    start,
+                    end,
+                    summarize(buffer.unordered()),
+                )
+            )
+            buffer.clear()
+        return aggregates
+
+
+class LocalAggregation(object):
+    """
+    Optional local aggregation of a sensor's samples, configured by the
+    "localAggregation" and "aggregationCapacity" configuration options.
+
+    :param sensor: The sensor, with `measurement_interval` and
+    `aggregate_interval` set.
+    """
+
+    def __init__(self, sensor, configuration):
+        self.sensor = sensor
+        self.enabled = configuration.get("localAggregation", False)
+
+        samples_per_window = math.ceil(
+            sensor.aggregate_interval / max(sensor.measurement_interval, 1e-3)
+        )
+        capacity = configuration.get("aggregationCapacity", max(samples_per_window, 1))
+        self.aggregator = Aggregator(sensor.aggregate_interval, capacity)
+
+        # The aggregates of the last completed window.
+        self.latest = []
+
+    def measurements(self, samples, timestamp=None):
+        """
+        Turn samples into the measurements returned by `measure`. Without
+        local aggregation, every sample becomes a raw measurement. With local
+        aggregation, samples are buffered, and a measurement of each
+        channel's mean is returned when a window completes.
+
+        :param samples: A list of (physical quantity, physical unit, value)
+        tuples, or of `oversampling.Oversampled` tuples. The sample and
+        rejected counts of the latter are set as the `samples` and `rejected`
+        attributes of raw measurements.
+        :param timestamp: The wall clock time of the samples, defaults to now.
+        If given, the measurements are stamped with it, e.g. such that all
+        measurements of a measurement group share one time.
+        """
+        if not self.enabled:
+            return [
+                self._measurement(*sample, timestamp=timestamp) for sample in samples
+            ]
+
+        if timestamp is None:
+            timestamp = time.time()
+        aggregates = []
+        for (quantity, unit, value, *_) in samples:
+            aggregates += self.aggregator.add(quantity, unit, value, timestamp)
+
+        if not aggregates:
+            return []
+
+        self.latest = aggregates
+        return [
+            self._measurement(
+                aggregate.physical_quantity,
+                aggregate.physical_unit,
+                aggregate.summary.mean,
+                timestamp=timestamp,
+            )
+            for aggregate in aggregates
+        ]
+
+    def _measurement(
+        self, quantity, unit, value, samples=None, rejected=None, timestamp=None
+    ):
+        measurement = self.sensor.create_raw_measurement(quantity, unit, value)
+        if samples is not None:
+            measurement.samples = samples
+            measurement.rejected = rejected
+        if timestamp is not None:
+            # Measurements are stamped with the time they are created at
+            measurement.datetime = datetime.datetime.fromtimestamp(
+                timestamp, datetime.timezone.utc
+            )
+        return measurement
@@ -1,3 +1,5 @@
+import math
+
 import trio
 from astroplant_kit.peripheral import (
     FatalPeripheralError,
@@ -5,12 +7,20 @@ from astroplant_kit.peripheral import (
     TemporaryPeripheralError,
 )
 
-from . import i2c
+from . import i2c, i2c_backends, metrics
+from .sampling import SampledSensor
 
 # Based on: https://gist.github.com/oskar456/95c66d564c58361ecf9f
 
+MTREG_MIN = 31
+MTREG_MAX = 254
+MTREG_DEFAULT = 69
+
+MAX_COUNT = 0xFFFF
 
-class Bh1750(Sensor):
+
+@metrics.instrument
+class Bh1750(SampledSensor, Sensor):
 
     # Define some constants from the datasheet
     POWER_DOWN = 0x00  # No active state
@@ -38,85 +48,162 @@ class Bh1750(Sensor):
     # Device is automatically set to Power Down after measurement.
     ONE_TIME_LOW_RES_MODE = 0x23
 
+    # Resolutions available for auto-ranging, as (one-time mode, continuous
+    # mode, lux per step at the default MTreg, result coefficient).
+    RANGES = [
+        (ONE_TIME_LOW_RES_MODE, CONTINUOUS_LOW_RES_MODE, 4.0, 1),
+        (ONE_TIME_HIGH_RES_MODE_1, CONTINUOUS_HIGH_RES_MODE_1, 1.0, 1),
+        (ONE_TIME_HIGH_RES_MODE_2, CONTINUOUS_HIGH_RES_MODE_2, 0.5, 2),
+    ]
+
+    # Fraction of the full count range a reading may use after re-ranging,
+    # leaving room for the light intensity to rise until the next reading.
+    AUTO_RANGE_HEADROOM = 0.8
+
+    # Hysteresis of re-ranging, such that a fluctuating light intensity does
+    # not reprogram the sensor at every reading. The current range is kept
+    # while its readings stay below this fraction of the full count range,
+    # and while its conversion time (or, if the precision cannot be reached,
+    # its resolution) is within this factor of that of the selected range.
+    AUTO_RANGE_KEEP_HEADROOM = 0.95
+    AUTO_RANGE_MARGIN = 1.5
+
     def __init__(self, *args, configuration):
         super().__init__(*args)
 
         self.measurement_interval = configuration["intervals"]["measurementInterval"]
         self.aggregate_interval = configuration["intervals"]["aggregateInterval"]
+        self.set_up_sampling(configuration)
+
+        # In continuous mode the sensor keeps converting, and a measurement
+        # only reads the latest result.
+        self.continuous = configuration.get("continuous", False)
+        self._result_ready_at = None
+
+        # With auto-ranging, MTreg and resolution are chosen based on the
+        # previous reading. The precision is relative to the reading.
+        self.auto_range = configuration.get("autoRange", False)
+        self.auto_range_precision = configuration.get("autoRangePrecision", 0.01)
+        self.saturated = False
+        self._last_lux = None
+        # The range in use, as returned by `_select_range`.
+        self._range = None
 
         address = int(configuration["i2cAddress"], base=16)
-        self.i2c_device = i2c.I2cDevice(address)
+        self.i2c_device = i2c.AsyncI2cDevice(
+            address,
+            backend=i2c_backends.configured_backend(configuration),
+            timing=i2c.NO_DELAY_TIMING,
+        )
 
     async def set_up(self):
         try:
-            self.set_sensitivity()
+            await self.set_sensitivity()
+            if self.continuous:
+                self._range = (
+                    self.ONE_TIME_HIGH_RES_MODE_1,
+                    self.CONTINUOUS_HIGH_RES_MODE_1,
+                    MTREG_DEFAULT,
+                )
+                await self.start_continuous(self.CONTINUOUS_HIGH_RES_MODE_1)
         except Exception as e:
             raise FatalPeripheralError("could not perform sensor setup (BH1750)") from e
 
     async def clean_up(self):
+        if self.continuous:
+            try:
+                await self.power_down()
+            except Exception:
+                pass
         self.i2c_device.stop()
 
-    def _set_mode(self, mode):
+    async def _set_mode(self, mode):
         self.mode = mode
-        self.i2c_device.write_byte(self.mode)
+        await self.i2c_device.write_byte(self.mode)
 
-    def power_down(self):
-        self._set_mode(self.POWER_DOWN)
+    async def power_down(self):
+        await self._set_mode(self.POWER_DOWN)
 
-    def power_on(self):
-        self._set_mode(self.POWER_ON)
+    async def power_on(self):
+        await self._set_mode(self.POWER_ON)
 
-    def reset(self):
-        self.power_on()  # It has to be powered on before resetting
-        self._set_mode(self.RESET)
+    async def reset(self):
+        await self.power_on()  # It has to be powered on before resetting
+        await self._set_mode(self.RESET)
 
-    def cont_low_res(self):
-        self._set_mode(self.CONTINUOUS_LOW_RES_MODE)
+    async def cont_low_res(self):
+        await self._set_mode(self.CONTINUOUS_LOW_RES_MODE)
 
-    def cont_high_res(self):
-        self._set_mode(self.CONTINUOUS_HIGH_RES_MODE_1)
+    async def cont_high_res(self):
+        await self._set_mode(self.CONTINUOUS_HIGH_RES_MODE_1)
 
-    def cont_high_res2(self):
-        self._set_mode(self.CONTINUOUS_HIGH_RES_MODE_2)
+    async def cont_high_res2(self):
+        await self._set_mode(self.CONTINUOUS_HIGH_RES_MODE_2)
 
-    def oneshot_low_res(self):
-        self._set_mode(self.ONE_TIME_LOW_RES_MODE)
+    async def oneshot_low_res(self):
+        await self._set_mode(self.ONE_TIME_LOW_RES_MODE)
 
-    def oneshot_high_res(self):
-        self._set_mode(self.ONE_TIME_HIGH_RES_MODE_1)
+    async def oneshot_high_res(self):
+        await self._set_mode(self.ONE_TIME_HIGH_RES_MODE_1)
 
-    def oneshot_high_res2(self):
-        self._set_mode(self.ONE_TIME_HIGH_RES_MODE_2)
+    async def oneshot_high_res2(self):
+        await self._set_mode(self.ONE_TIME_HIGH_RES_MODE_2)
 
-    def set_sensitivity(self, sensitivity=69):
+    async def set_sensitivity(self, sensitivity=MTREG_DEFAULT):
         """
         Set the sensor sensitivity.
         Valid values are 31 (lowest) to 254 (highest), default is 69.
         """
-        if sensitivity < 31:
-            self.mtreg = 31
-        elif sensitivity > 254:
-            self.mtreg = 254
+        if sensitivity < MTREG_MIN:
+            self.mtreg = MTREG_MIN
+        elif sensitivity > MTREG_MAX:
+            self.mtreg = MTREG_MAX
         else:
             self.mtreg = sensitivity
-        self.power_on()
-        self._set_mode(0x40 | (self.mtreg >> 5))
-        self._set_mode(0x60 | (self.mtreg & 0x1F))
-        self.power_down()
+        await self.power_on()
+        await self._set_mode(0x40 | (self.mtreg >> 5))
+        await self._set_mode(0x60 | (self.mtreg & 0x1F))
+        await self.power_down()
+
+    async def start_continuous(self, mode):
+        """
+        Put the sensor in a continuous measurement mode. The first result is
+        available after one conversion time.
+        """
+        await self.power_on()
+        await self._set_mode(mode)
+        self._result_ready_at = trio.current_time() + self.conversion_time()
 
-    def get_result(self):
+    async def get_result(self):
         """
         Return current measurement result in lux.
         """
-        data = self.i2c_device.read_word_data(self.mode)
-        count = data >> 8 | (data & 0xFF) << 8
+        data = await self.i2c_device.read_word_data(self.mode)
+        return self._to_lux(data >> 8 | (data & 0xFF) << 8)
+
+    async def get_latest_result(self):
+        """
+        Return the latest measurement result in lux, without sending a
+        command. Sending the mode again would restart a continuous conversion.
+        """
+        (msb, lsb) = await self.i2c_device.read_device(2)
+        return self._to_lux(msb << 8 | lsb)
+
+    def _to_lux(self, count):
+        self.saturated = count >= MAX_COUNT
         mode2coeff = 2 if (self.mode & 0x03) == 0x01 else 1
         ratio = 1 / (1.2 * (self.mtreg / 69.0) * mode2coeff)
         return ratio * count
 
-    async def wait_for_result(self, additional=0):
+    def conversion_time(self):
+        """
+        Return the time in seconds a conversion takes in the current mode.
+        """
         basetime = 0.018 if (self.mode & 0x03) == 0x03 else 0.128
-        await trio.sleep(basetime * (self.mtreg / 69.0) + additional)
+        return basetime * (self.mtreg / 69.0)
+
+    async def wait_for_result(self, additional=0):
+        await trio.sleep(self.conversion_time() + additional)
 
     async def do_measurement(self, mode, additional_delay=0):
         """
@@ -125,10 +212,10 @@ class Bh1750(Sensor):
         delay specified in parameter additional_delay.
         Return output value in lux.
         """
-        self.reset()
-        self._set_mode(mode)
+        await self.reset()
+        await self._set_mode(mode)
         await self.wait_for_result(additional=additional_delay)
-        return self.get_result()
+        return await self.get_result()
 
     def measure_low_res(self, additional_delay=0):
         return self.do_measurement(self.ONE_TIME_LOW_RES_MODE, additional_delay)
@@ -139,12 +226,206 @@ class Bh1750(Sensor):
     def measure_high_res2(self, additional_delay=0):
         return self.do_measurement(self.ONE_TIME_HIGH_RES_MODE_2, additional_delay)
 
-    async def measure(self):
+    def _range_key(self, lux, one_time_mode, lux_per_step, mtreg):
+        """
+        Rank a range at the given light intensity: ranges reaching the
+        required precision come first, by conversion time, followed by the
+        others, by resolution.
+        """
+        resolution = lux_per_step * MTREG_DEFAULT / mtreg
+        if lux > 0 and resolution <= lux * self.auto_range_precision:
+            basetime = 0.018 if (one_time_mode & 0x03) == 0x03 else 0.128
+            return (0, basetime * (mtreg / MTREG_DEFAULT))
+        return (1, resolution)
+
+    def _select_range(self, lux):
+        """
+        Select the resolution and MTreg giving the shortest conversion time
+        that still reaches the required precision at the given light
+        intensity, without saturating. If the precision cannot be reached, the
+        finest resolution is selected.
+
+        :return: A tuple of one-time mode, continuous mode and MTreg.
+        """
+        target = lux * self.auto_range_precision
+        best = None
+        best_key = None
+
+        for (one_time_mode, continuous_mode, lux_per_step, coefficient) in self.RANGES:
+            # Largest MTreg that does not saturate at the given intensity
+            if lux > 0:
+                max_mtreg = int(
+                    MAX_COUNT
+                    * self.AUTO_RANGE_HEADROOM
+                    * MTREG_DEFAULT
+                    / (1.2 * coefficient * lux)
+                )
+                max_mtreg = min(max_mtreg, MTREG_MAX)
+            else:
+                max_mtreg = MTREG_MAX
+            if max_mtreg < MTREG_MIN:
+                continue
+
+            # Smallest MTreg that gives the required resolution
+            if target > 0:
+                mtreg = max(math.ceil(lux_per_step * MTREG_DEFAULT / target), MTREG_MIN)
+            else:
+                mtreg = MTREG_MAX
+            mtreg = min(mtreg, max_mtreg)
+
+            key = self._range_key(lux, one_time_mode, lux_per_step, mtreg)
+            if best_key is None or key < best_key:
+                best = (one_time_mode, continuous_mode, mtreg)
+                best_key = key
+
+        if best is None:
+            # Too bright to avoid saturation, use the least sensitive setting
+            best = (self.ONE_TIME_LOW_RES_MODE, self.CONTINUOUS_LOW_RES_MODE, MTREG_MIN)
+        return best
+
+    def _range_constants(self, one_time_mode):
+        """
+        :return: The lux per step at the default MTreg and the result
+        coefficient of a range.
+        """
+        for (mode, _, lux_per_step, coefficient) in self.RANGES:
+            if mode == one_time_mode:
+                return (lux_per_step, coefficient)
+        raise ValueError(f"not an auto-ranging mode: {one_time_mode:#04x}")
+
+    def _keeps_range(self, lux, selected) -> bool:
+        """
+        Whether the current range is still good enough at the given light
+        intensity, compared to the selected range.
+        """
+        if self._range is None or self.saturated:
+            return False
+
+        (one_time_mode, _, mtreg) = self._range
+        (lux_per_step, coefficient) = self._range_constants(one_time_mode)
+        count = 1.2 * coefficient * lux * mtreg / MTREG_DEFAULT
+        if count > MAX_COUNT * self.AUTO_RANGE_KEEP_HEADROOM:
+            return False
+
+        (selected_mode, _, selected_mtreg) = selected
+        (selected_lux_per_step, _) = self._range_constants(selected_mode)
+        (precise, value) = self._range_key(lux, one_time_mode, lux_per_step, mtreg)
+        (selected_precise, selected_value) = self._range_key(
+            lux, selected_mode, selected_lux_per_step, selected_mtreg
+        )
+        # Switch if only the selected range reaches the precision
+        return (
+            precise == selected_precise
+            and value <= selected_value * self.AUTO_RANGE_MARGIN
+        )
+
+    def _update_range(self, lux):
+        """
+        Select the range for the next conversion based on the given reading,
+        keeping the current range unless it saturates, misses the precision,
+        or is clearly worse than the selected range.
+
+        :return: A tuple of one-time mode, continuous mode and MTreg.
+        """
+        selected = self._select_range(lux)
+        if not self._keeps_range(lux, selected):
+            self._range = selected
+        return self._range
+
+    async def _apply_sensitivity(self, mtreg):
+        if mtreg != self.mtreg:
+            await self.set_sensitivity(mtreg)
+
+    async def measure_auto_range(self):
+        """
+        Perform a one-time measurement, with the range selected based on the
+        previous reading. If there is no usable previous reading, a quick
+        low resolution probe is done first.
+        """
+        if self._last_lux is None or self.saturated:
+            await self._apply_sensitivity(MTREG_MIN)
+            self._last_lux = await self.measure_low_res()
+
+        (one_time_mode, _, mtreg) = self._update_range(self._last_lux)
+        await self._apply_sensitivity(mtreg)
+        self._last_lux = await self.do_measurement(one_time_mode)
+        return self._last_lux
+
+    async def measure_continuous(self):
+        """
+        Read the latest result of a continuous measurement. Only waits if the
+        first conversion after starting is not yet done.
+
+        With auto-ranging, the range for subsequent conversions is adjusted
+        based on this result.
+        """
+        await trio.sleep_until(self._result_ready_at)
+        lux = await self.get_latest_result()
+
+        if self.auto_range:
+            if self.saturated:
+                self._range = (
+                    self.ONE_TIME_LOW_RES_MODE,
+                    self.CONTINUOUS_LOW_RES_MODE,
+                    MTREG_MIN,
+                )
+            else:
+                self._update_range(lux)
+            (_, continuous_mode, mtreg) = self._range
+            if continuous_mode != self.mode or mtreg != self.mtreg:
+                await self._apply_sensitivity(mtreg)
+                await self.start_continuous(continuous_mode)
+
+        return lux
+
+    async def trigger_sample(self):
+        """
+        Start a conversion, for measurement groups. In continuous mode the
+        sensor is already converting.
+
+        :return: The trio time at which the result is ready.
+        """
+        try:
+            if self.continuous:
+                return self._result_ready_at
+
+            if self.auto_range:
+                if self._last_lux is None or self.saturated:
+                    await self._apply_sensitivity(MTREG_MIN)
+                    self._last_lux = await self.measure_low_res()
+                (mode, _, mtreg) = self._update_range(self._last_lux)
+                await self._apply_sensitivity(mtreg)
+            else:
+                mode = self.ONE_TIME_HIGH_RES_MODE_1
+
+            await self.reset()
+            await self._set_mode(mode)
+        except Exception as e:
+            raise TemporaryPeripheralError("could not write to sensor (BH1750)") from e
+
+        return trio.current_time() + self.conversion_time()
+
+    async def read_sample(self):
         try:
-            light = await self.measure_high_res(additional_delay=0)
+            if self.continuous:
+                light = await self.measure_continuous()
+            else:
+                light = await self.get_result()
+                self._last_lux = light
         except Exception as e:
             raise TemporaryPeripheralError("could not read from sensor (BH1750)") from e
 
-        light_measurement = self.create_raw_measurement("Light intensity", "Lux", light)
+        return [("Light intensity", "Lux", light)]
+
+    async def sample(self):
+        try:
+            if self.continuous:
+                light = await self.measure_continuous()
+            elif self.auto_range:
+                light = await self.measure_auto_range()
+            else:
+                light = await self.measure_high_res(additional_delay=0)
+        except Exception as e:
+            raise TemporaryPeripheralError("could not read from sensor (BH1750)") from e
 
-        return [light_measurement]
+        return [("Light intensity", "Lux", light)]
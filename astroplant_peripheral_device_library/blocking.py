@@ -0,0 +1,191 @@
+"""
+Detection of driver calls blocking the trio event loop.
+
+In debug mode, the driver calls instrumented by `metrics.instrument` are
+stepped through one resumption at a time, measuring how long each step holds
+the event loop before yielding. A step taking longer than the threshold is
+logged, or raises `LoopBlockedError` in the driver call. The worst offenders
+are kept for `report`.
+
+Enable the debug mode by calling `enable`, or by setting the
+ASTROPLANT_BLOCKING_THRESHOLD environment variable to the threshold in
+seconds.
+"""
+
+import logging
+import os
+import threading
+import time
+import types
+
+logger = logging.getLogger("astroplant_peripheral_device_library.blocking")
+
+ENV = "ASTROPLANT_BLOCKING_THRESHOLD"
+
+DEFAULT_THRESHOLD = 0.01
+
+
+class LoopBlockedError(Exception):
+    """
+    A driver call held the event loop longer than the threshold.
+    """
+
+    pass
+
+
+class Offender(object):
+    """
+    Loop stalls of one driver call.
+    """
+
+    def __init__(self, label: str):
+        self.label = label
+        # Calls with at least one step over the threshold.
+        self.calls = 0
+        self.longest = 0.0
+        self.total = 0.0
+
+    def as_dict(self):
+        return {
+            "label": self.label,
+            "calls": self.calls,
+            "longest_seconds": self.longest,
+            "total_seconds": self.total,
+        }
+
+
+_threshold = None
+_raise = False
+_lock = threading.Lock()
+_offenders = {}
+
+
+def enable(threshold=DEFAULT_THRESHOLD, raise_on_block=False):
+    """
+    Enable detection of loop stalls.
+
+    :param threshold: The time in seconds a driver call may hold the event
+    loop without yielding.
+    :param raise_on_block: Whether to raise `LoopBlockedError` in the driver
+    call when the threshold is exceeded, rather than logging a warning.
+    """
+    global _threshold, _raise
+    _threshold = threshold
+    _raise = raise_on_block
+
+
+def disable():
+    global _threshold
+    _threshold = None
+
+
+def enabled() -> bool:
+    return _threshold is not None
+
+
+def reset():
+    with _lock:
+        _offenders.clear()
+
+
+def report(count=10) -> list:
+    """
+    Get the driver calls that held the event loop longest, longest first.
+    """
+    with _lock:
+        offenders = sorted(_offenders.values(), key=lambda o: o.longest, reverse=True)
+        return [offender.as_dict() for offender in offenders[:count]]
+
+
+def format_report(count=10) -> str:
+    lines = ["calls over threshold  longest (ms)  total (ms)  call"]
+    for offender in report(count):
+        lines.append(
+            f"{offender['calls']:21d}  "
+            f"{offender['longest_seconds'] * 1e3:12.2f}  "
+            f"{offender['total_seconds'] * 1e3:10.2f}  "
+            f"{offender['label']}"
+        )
+    return "\n".join(lines)
+
+
+def _blocked(label: str, steps: list):
+    """
+    Record the steps over the threshold of a call, and return the error to
+    raise, if any.
+    """
+    longest = max(steps)
+    with _lock:
+        if label not in _offenders:
+            _offenders[label] = Offender(label)
+        offender = _offenders[label]
+        offender.calls += 1
+        offender.longest = max(offender.longest, longest)
+        offender.total += sum(steps)
+
+    message = f"{label} held the event loop for {longest * 1e3:.1f} ms without yielding"
+    if _raise:
+        return LoopBlockedError(message)
+    logger.warning(message)
+    return None
+
+
+@types.coroutine
+def monitor(coro, label: str):
+    """
+    Run a coroutine, measuring the duration of each step between yields to
+    the event loop.
+
+    :param coro: The coroutine of the driver call.
+    :param label: The name of the call in reports.
+    """
+    threshold = _threshold
+    # Durations of the steps over the threshold.
+    steps = []
+    (send, throw) = (None, None)
+    while True:
+        start = time.perf_counter()
+        try:
+            if throw is not None:
+                yielded = coro.throw(throw)
+            else:
+                yielded = coro.send(send)
+        except StopIteration as e:
+            duration = time.perf_counter() - start
+            if duration > threshold:
+                steps.append(duration)
+            if steps:
+                error = _blocked(label, steps)
+                if error is not None:
+                    raise error
+            return e.value
+        except BaseException:
+            duration = time.perf_counter() - start
+            if duration > threshold:
+                steps.append(duration)
+            if steps:
+                _blocked(label, steps)
+            raise
+
+        duration = time.perf_counter() - start
+        if duration > threshold:
+            steps.append(duration)
+            if _raise:
+                # Abort the call: its cleanup runs before the error propagates
+                error = _blocked(label, steps)
+                try:
+                    coro.throw(error)
+                except StopIteration:
+                    pass
+                else:
+                    coro.close()
+                raise error
+
+        try:
+            (send, throw) = ((yield yielded), None)
+        except BaseException as e:
+            (send, throw) = (None, e)
+
+
+if os.environ.get(ENV):
+    enable(float(os.environ[ENV]))
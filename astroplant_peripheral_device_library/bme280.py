@@ -8,45 +8,75 @@ from ctypes import c_short
 from ctypes import c_byte
 from ctypes import c_ubyte
 
-from . import i2c
+from . import i2c, i2c_backends, metrics
+from .sampling import SampledSensor
 import trio
 from astroplant_kit.peripheral import Sensor
 
 
-class Bme280(Sensor):
-    def __init__(self, *args, i2c_address, **kwargs):
-        super().__init__(*args, **kwargs)
+@metrics.instrument
+class Bme280(SampledSensor, Sensor):
+    def __init__(self, *args, configuration):
+        super().__init__(*args)
 
         self.measurement_interval = configuration["intervals"]["measurementInterval"]
         self.aggregate_interval = configuration["intervals"]["aggregateInterval"]
+        self.set_up_sampling(configuration)
 
-        address = int(i2c_address, base=16)
-        self.i2c_device = i2c.I2cDevice(address)
+        address = int(configuration["i2cAddress"], base=16)
+        self.i2c_device = i2c.AsyncI2cDevice(
+            address,
+            backend=i2c_backends.configured_backend(configuration),
+            timing=i2c.NO_DELAY_TIMING,
+        )
 
-    async def measure(self):
-        (temperature, pressure, humidity) = await self.readAll()
+    async def clean_up(self):
+        self.i2c_device.stop()
 
-        temperature_measurement = self.create_raw_measurement(
-            "Temperature", "Degrees Celsius", temperature
-        )
-        pressure_measurement = self.create_raw_measurement(
-            "Pressure", "Hectopascal", pressure
-        )
-        humidity_measurement = self.create_raw_measurement(
-            "Humidity", "Percentage", humidity
-        )
+    async def sample(self):
+        (temperature, pressure, humidity) = await self.readAll()
 
-        return [temperature_measurement, pressure_measurement, humidity_measurement]
+        return [
+            ("Temperature", "Degrees Celsius", temperature),
+            ("Pressure", "Hectopascal", pressure),
+            ("Humidity", "Percentage", humidity),
+        ]
 
-    def readID(self):
+    async def readID(self):
         # Chip ID Register Address
         REG_ID = 0xD0
-        (chip_id, chip_version) = self.i2c_device.read_i2c_block_data(REG_ID, 2)
+        (chip_id, chip_version) = await self.i2c_device.read_i2c_block_data(REG_ID, 2)
         return (chip_id, chip_version)
 
+    async def trigger_sample(self):
+        """
+        Start a conversion, for measurement groups.
+
+        :return: The trio time at which the result is ready.
+        """
+        return await self.start_conversion()
+
+    async def read_sample(self):
+        (temperature, pressure, humidity) = await self.read_conversion()
+
+        return [
+            ("Temperature", "Degrees Celsius", temperature),
+            ("Pressure", "Hectopascal", pressure),
+            ("Humidity", "Percentage", humidity),
+        ]
+
     async def readAll(self):
+        ready_at = await self.start_conversion()
+        await trio.sleep_until(ready_at)
+        return await self.read_conversion()
+
+    async def start_conversion(self):
+        """
+        Start a measurement, and read the calibration data.
+
+        :return: The trio time at which the measurement is done.
+        """
         # Register Addresses
-        REG_DATA = 0xF7
         REG_CONTROL = 0xF4
         REG_CONFIG = 0xF5
 
@@ -61,16 +91,41 @@ class Bme280(Sensor):
 
         # Oversample setting for humidity register - page 26
         OVERSAMPLE_HUM = 2
-        self.i2c_device.write_byte_data(REG_CONTROL_HUM, OVERSAMPLE_HUM)
 
         control = OVERSAMPLE_TEMP << 5 | OVERSAMPLE_PRES << 2 | MODE
-        self.i2c_device.write_byte_data(REG_CONTROL, control)
 
-        # Read blocks of calibration data from EEPROM
-        # See Page 22 data sheet
-        cal1 = self.i2c_device.read_i2c_block_data(0x88, 24)
-        cal2 = self.i2c_device.read_i2c_block_data(0xA1, 1)
-        cal3 = self.i2c_device.read_i2c_block_data(0xE1, 7)
+        # Start a measurement, and read blocks of calibration data from EEPROM
+        # in one combined transaction. See Page 22 data sheet
+        self._calibration = await self.i2c_device.transaction(
+            [
+                i2c.Write([REG_CONTROL_HUM, OVERSAMPLE_HUM]),
+                i2c.Write([REG_CONTROL, control]),
+                i2c.Write([0x88]),
+                i2c.Read(24),
+                i2c.Write([0xA1]),
+                i2c.Read(1),
+                i2c.Write([0xE1]),
+                i2c.Read(7),
+            ]
+        )
+
+        # Wait in ms (Datasheet Appendix B: Measurement time and current calculation)
+        wait_time = (
+            1.25
+            + (2.3 * OVERSAMPLE_TEMP)
+            + ((2.3 * OVERSAMPLE_PRES) + 0.575)
+            + ((2.3 * OVERSAMPLE_HUM) + 0.575)
+        )
+        return trio.current_time() + wait_time / 1000
+
+    async def read_conversion(self):
+        """
+        Read the result of the measurement started by `start_conversion`.
+        """
+        # Register Addresses
+        REG_DATA = 0xF7
+
+        (cal1, cal2, cal3) = self._calibration
 
         # Convert byte data to word values
         dig_T1 = getUShort(cal1, 0)
@@ -101,17 +156,8 @@ class Bme280(Sensor):
 
         dig_H6 = getChar(cal3, 6)
 
-        # Wait in ms (Datasheet Appendix B: Measurement time and current calculation)
-        wait_time = (
-            1.25
-            + (2.3 * OVERSAMPLE_TEMP)
-            + ((2.3 * OVERSAMPLE_PRES) + 0.575)
-            + ((2.3 * OVERSAMPLE_HUM) + 0.575)
-        )
-        await trio.sleep(wait_time / 1000)  # Wait the required time
-
         # Read temperature/pressure/humidity
-        data = self.i2c_device.read_i2c_block_data(REG_DATA, 8)
+        data = await self.i2c_device.read_i2c_block_data(REG_DATA, 8)
         pres_raw = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
         temp_raw = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
         hum_raw = (data[6] << 8) | data[7]
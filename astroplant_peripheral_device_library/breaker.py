@@ -0,0 +1,211 @@
+"""
+Circuit breakers for failing peripherals.
+
+A sensor's circuit opens after a number of consecutive
+`TemporaryPeripheralError`s, e.g. when the sensor is unplugged. While open,
+measurements fail immediately with `CircuitOpenError`, without spending bus
+time, serial timeouts or worker threads on the dead device. After a backoff,
+a single measurement is let through as a probe: if it succeeds the circuit
+closes, otherwise it opens again with the backoff multiplied.
+
+Sensors are configured with the "circuitBreaker" configuration option:
+
+    "circuitBreaker": {
+        "failureThreshold": 5,
+        "initialBackoff": 10,
+        "maxBackoff": 600
+    }
+
+A failure threshold of 0 disables the circuit breaker. The states of all
+circuit breakers are available through `states`, and as metrics.
+"""
+
+import logging
+import weakref
+
+import trio
+from astroplant_kit.peripheral import TemporaryPeripheralError
+
+from . import metrics
+
+logger = logging.getLogger("astroplant_peripheral_device_library.breaker")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Values of the states in metrics.
+_STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_INITIAL_BACKOFF = 10.0
+DEFAULT_MAX_BACKOFF = 600.0
+DEFAULT_MULTIPLIER = 2.0
+
+
+class CircuitOpenError(TemporaryPeripheralError):
+    """
+    A call was rejected, because the peripheral's circuit is open.
+    """
+
+    pass
+
+
+_breakers = weakref.WeakSet()
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive failures of a peripheral.
+
+    :param peripheral: The peripheral, used in logs and metrics.
+    :param failure_threshold: The number of consecutive failures opening the
+    circuit. 0 disables the circuit breaker.
+    :param initial_backoff: The time in seconds until the first probe after
+    the circuit opened.
+    :param max_backoff: The maximum time in seconds between probes.
+    :param multiplier: The factor the backoff grows by after a failed probe.
+    """
+
+    def __init__(
+        self,
+        peripheral,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        initial_backoff=DEFAULT_INITIAL_BACKOFF,
+        max_backoff=DEFAULT_MAX_BACKOFF,
+        multiplier=DEFAULT_MULTIPLIER,
+    ):
+        self.labels = metrics.peripheral_labels(peripheral)
+        self.failure_threshold = failure_threshold
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.backoff = initial_backoff
+        # The trio time from which a probe is let through, while open.
+        self.probe_at = None
+        # The number of times the circuit opened.
+        self.opened = 0
+
+        _breakers.add(self)
+
+    def _describe(self) -> str:
+        return f"{self.labels['driver']} {self.labels['peripheral']}".strip()
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.probe_at = now + self.backoff
+        self.opened += 1
+        logger.warning(
+            f"{self._describe()}: circuit opened after "
+            f"{self.consecutive_failures} consecutive failures, "
+            f"probing in {self.backoff:.1f} s"
+        )
+
+    def _failure(self):
+        now = trio.current_time()
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN:
+            self.backoff = min(self.backoff * self.multiplier, self.max_backoff)
+            self._open(now)
+        elif self.consecutive_failures >= self.failure_threshold:
+            self.backoff = self.initial_backoff
+            self._open(now)
+
+    def _success(self):
+        if self.state != CLOSED:
+            logger.info(f"{self._describe()}: circuit closed")
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.backoff = self.initial_backoff
+        self.probe_at = None
+
+    async def call(self, fn, *args):
+        """
+        Call an async function through the circuit breaker.
+
+        :raises CircuitOpenError: If the circuit is open, or another call is
+        probing the peripheral.
+        """
+        if self.failure_threshold <= 0:
+            return await fn(*args)
+
+        if self.state == OPEN:
+            remaining = self.probe_at - trio.current_time()
+            if remaining > 0:
+                raise CircuitOpenError(
+                    "circuit open after repeated failures, "
+                    f"next probe in {remaining:.1f} s"
+                )
+            self.state = HALF_OPEN
+        elif self.state == HALF_OPEN:
+            raise CircuitOpenError("circuit open after repeated failures, probing")
+
+        probing = self.state == HALF_OPEN
+        try:
+            result = await fn(*args)
+        except TemporaryPeripheralError:
+            self._failure()
+            raise
+        except BaseException:
+            if probing:
+                # The probe did not finish (e.g. it was cancelled), probe
+                # again on the next call.
+                self.state = OPEN
+                self.probe_at = trio.current_time()
+            raise
+
+        self._success()
+        return result
+
+    def as_dict(self) -> dict:
+        return dict(
+            self.labels,
+            state=self.state,
+            consecutive_failures=self.consecutive_failures,
+            backoff_seconds=self.backoff,
+            opened=self.opened,
+        )
+
+
+def configured(peripheral, configuration) -> CircuitBreaker:
+    """
+    Create the circuit breaker of a peripheral from its "circuitBreaker"
+    configuration option.
+    """
+    options = configuration.get("circuitBreaker", {})
+    return CircuitBreaker(
+        peripheral,
+        failure_threshold=options.get("failureThreshold", DEFAULT_FAILURE_THRESHOLD),
+        initial_backoff=options.get("initialBackoff", DEFAULT_INITIAL_BACKOFF),
+        max_backoff=options.get("maxBackoff", DEFAULT_MAX_BACKOFF),
+        multiplier=options.get("multiplier", DEFAULT_MULTIPLIER),
+    )
+
+
+def states() -> list:
+    """
+    Get the states of all circuit breakers.
+    """
+    return [breaker.as_dict() for breaker in list(_breakers)]
+
+
+def _collect_metrics():
+    for breaker in list(_breakers):
+        yield (
+            "astroplant_circuit_state",
+            "Circuit breaker state of peripherals (0 closed, 1 open, 2 half open).",
+            breaker.labels,
+            _STATE_VALUES[breaker.state],
+        )
+        yield (
+            "astroplant_circuit_opened",
+            "Number of times the circuit breaker of peripherals opened.",
+            breaker.labels,
+            breaker.opened,
+        )
+
+
+metrics.add_collector(_collect_metrics)
@@ -6,10 +6,11 @@ https://github.com/joan2937/pigpio/blob/master/EXAMPLES/Python/DHT22_AM2302_SENS
 import threading
 import time
 
-import pigpio
-import trio
 from astroplant_kit.peripheral import Sensor, TemporaryPeripheralError
 
+from . import hardware, metrics, workers
+from .sampling import SampledSensor
+
 
 class _DHT22:
     """
@@ -36,10 +37,10 @@ class _DHT22:
     gpio ------------+
     """
 
-    def __init__(self, pi, gpio, LED=None, power=None):
+    def __init__(self, pigpio, pi, gpio, LED=None, power=None):
         """
-        Instantiate with the Pi and gpio to which the DHT22 output
-        pin is connected.
+        Instantiate with the pigpio module (or its emulation), the Pi and
+        gpio to which the DHT22 output pin is connected.
 
         Optionally a LED may be specified.  This will be blinked for
         each successful reading.
@@ -52,6 +53,7 @@ class _DHT22:
         eventually cause the DHT22 to hang.  A 3 second interval seems OK.
         """
 
+        self.pigpio = pigpio
         self.pi = pi
         self.gpio = gpio
         self.LED = LED
@@ -95,7 +97,7 @@ class _DHT22:
         Accumulate the 40 data bits.  Format into 5 bytes, humidity high,
         humidity low, temperature high, temperature low, checksum.
         """
-        diff = pigpio.tickDiff(self.high_tick, tick)
+        diff = self.pigpio.tickDiff(self.high_tick, tick)
 
         if level == 0:
 
@@ -239,9 +241,9 @@ class _DHT22:
 
             self.msg_event.clear()
 
-            self.pi.write(self.gpio, pigpio.LOW)
+            self.pi.write(self.gpio, self.pigpio.LOW)
             time.sleep(0.017)  # 17 ms
-            self.pi.set_mode(self.gpio, pigpio.INPUT)
+            self.pi.set_mode(self.gpio, self.pigpio.INPUT)
             self.pi.set_watchdog(self.gpio, 200)
 
             # Wait for a successful message
@@ -257,7 +259,8 @@ class _DHT22:
             self.cb = None
 
 
-class Dht22(Sensor):
+@metrics.instrument
+class Dht22(SampledSensor, Sensor):
     SLEEP_BETWEEN_MEASUREMENTS = 3.5
 
     def __init__(self, *args, configuration):
@@ -265,11 +268,33 @@ class Dht22(Sensor):
 
         self.measurement_interval = configuration["intervals"]["measurementInterval"]
         self.aggregate_interval = configuration["intervals"]["aggregateInterval"]
+        self.set_up_sampling(configuration)
 
         self.pin = configuration["gpioAddress"]
-        self.dht22 = _DHT22(pigpio.pi(), self.pin)
+        pigpio = hardware.pigpio(configuration)
+        self.dht22 = _DHT22(pigpio, pigpio.pi(), self.pin)
+
+        metrics.add_collector(self._collect_metrics)
+
+    def _collect_metrics(self):
+        labels = dict(metrics.peripheral_labels(self), gpio=self.pin)
+        for (result, count) in [
+            ("success", self.dht22.successful_message()),
+            ("bad_checksum", self.dht22.bad_checksum()),
+            ("short_message", self.dht22.short_message()),
+            ("missing_message", self.dht22.missing_message()),
+            ("sensor_reset", self.dht22.sensor_resets()),
+        ]:
+            yield (
+                "astroplant_dht22_messages",
+                "DHT22 messages received, by result.",
+                dict(labels, result=result),
+                count,
+            )
 
     async def clean_up(self):
+        metrics.remove_collector(self._collect_metrics)
+
         try:
             self.dht22.cancel()
         except Exception:
@@ -277,12 +302,14 @@ class Dht22(Sensor):
 
         self.dht22.pi.stop()
 
-    async def measure(self):
+    async def sample(self):
         successful_message_count_before = self.dht22.successful_message()
 
         # Trigger a new reading in a separate thread (timing is important for the DHT22)
         try:
-            await trio.to_thread.run_sync(self.dht22.trigger)
+            await workers.run_sync(
+                self.dht22.trigger, group="Dht22", priority=workers.PRIORITY_HIGH
+            )
         except Exception as e:
             raise TemporaryPeripheralError("failed to read from sensor (DHT22)") from e
 
@@ -291,14 +318,10 @@ class Dht22(Sensor):
             temperature = self.dht22.temperature()
             humidity = self.dht22.humidity()
 
-            temperature_measurement = self.create_raw_measurement(
-                "Temperature", "Degrees Celsius", temperature
-            )
-            humidity_measurement = self.create_raw_measurement(
-                "Humidity", "Percent", humidity
-            )
-
-            return [temperature_measurement, humidity_measurement]
+            return [
+                ("Temperature", "Degrees Celsius", temperature),
+                ("Humidity", "Percent", humidity),
+            ]
         else:
             # No valid measurement was made
             raise TemporaryPeripheralError(
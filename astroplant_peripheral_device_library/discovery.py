@@ -0,0 +1,261 @@
+"""
+Discovery of I2C devices.
+
+A bus is scanned once, probing the addresses of known chips and identifying
+them:
+
+- BME280 at 0x76 and 0x77, by its chip ID register (0x60);
+- BH1750 at 0x23 and 0x5C, by its address;
+- PCF8574 LCD backpacks at 0x20-0x27 and 0x38-0x3F, by their address.
+
+Both a BH1750 and a backpack can be at 0x23. There, a chip reading back the
+port values written to it is a PCF8574; a BH1750 takes the values as its
+power down and power on opcodes, and reads back its unchanged result
+register instead.
+
+Scan results are cached per boot (by the kernel's boot ID) in a file, such
+that restarting the kit does not probe the bus again. Configurations can be
+auto-filled with the address of a discovered chip, and configured addresses
+without a device fail before the driver is created. Cached results missing
+the device are refreshed first, as it may have been slow or absent at the
+first scan:
+
+    configuration = await discovery.autofill("Bme280", configuration)
+
+Scan a bus from the command line with:
+
+    python -m astroplant_peripheral_device_library.discovery --bus 1
+"""
+
+import json
+import logging
+import os
+
+from astroplant_kit.peripheral import FatalPeripheralError
+
+from . import hardware, i2c, i2c_backends
+
+logger = logging.getLogger("astroplant_peripheral_device_library.discovery")
+
+CACHE_ENV = "ASTROPLANT_DISCOVERY_CACHE"
+DEFAULT_CACHE_PATH = "/tmp/astroplant-i2c-discovery.json"
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+
+BME280_CHIP_ID_REGISTER = 0xD0
+BME280_CHIP_ID = 0x60
+
+# Port values written to and read back from a PCF8574, with the LCD's enable
+# and read/write lines low. To a BH1750 these are its power down and power on
+# opcodes.
+PCF8574_PROBE_VALUES = [0x00, 0x01]
+
+# Addresses of the known chips, by driver.
+ADDRESSES = {
+    "Bme280": [0x76, 0x77],
+    "Bh1750": [0x23, 0x5C],
+    "LCD": list(range(0x20, 0x28)) + list(range(0x38, 0x40)),
+}
+
+# Scan results per (bus, backend), as dicts of address to driver name.
+_scanned = {}
+
+
+def _boot_id():
+    try:
+        with open(BOOT_ID_PATH) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cache_path() -> str:
+    return os.environ.get(CACHE_ENV, DEFAULT_CACHE_PATH)
+
+
+def _cache_key(bus: int, backend: str) -> str:
+    return f"{backend}:{bus}"
+
+
+def _load_cache(boot_id) -> dict:
+    try:
+        with open(_cache_path()) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("boot_id") != boot_id:
+        return {}
+    return cache.get("buses", {})
+
+
+def _store_cache(boot_id, buses: dict):
+    path = _cache_path()
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump({"boot_id": boot_id, "buses": buses}, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.warning(f"could not write I2C discovery cache {path}: {e}")
+
+
+def _identify(device: i2c.I2cDevice):
+    """
+    Probe an address, and identify the chip responding.
+
+    :return: The name of the chip's driver, None if the address does not
+    respond, or "" if the chip is not known.
+    """
+    try:
+        device.read_byte()
+    except Exception:
+        return None
+
+    address = device.address
+    if address in ADDRESSES["Bme280"]:
+        try:
+            chip_id = device.read_byte_data(BME280_CHIP_ID_REGISTER)
+        except Exception:
+            return ""
+        return "Bme280" if chip_id == BME280_CHIP_ID else ""
+    if address in ADDRESSES["Bh1750"] and address in ADDRESSES["LCD"]:
+        try:
+            return "LCD" if _reads_back(device) else "Bh1750"
+        except Exception:
+            return ""
+    for (driver, addresses) in ADDRESSES.items():
+        if address in addresses:
+            return driver
+    return ""
+
+
+def _reads_back(device: i2c.I2cDevice) -> bool:
+    """
+    Whether the chip reads back the port values written to it, as a PCF8574
+    does.
+    """
+    for value in PCF8574_PROBE_VALUES:
+        device.write_byte(value)
+        if device.read_byte() != value:
+            return False
+    return True
+
+
+def _scan(bus: int, backend, addresses) -> dict:
+    found = {}
+    for address in addresses:
+        device = i2c.I2cDevice(
+            address, bus=bus, backend=backend, timing=i2c.NO_DELAY_TIMING
+        )
+        try:
+            driver = _identify(device)
+        finally:
+            device.stop()
+        if driver is not None:
+            found[address] = driver
+    return found
+
+
+async def scan(bus=1, backend=None, refresh=False) -> dict:
+    """
+    Scan a bus for known chips, using cached results of this boot if
+    available.
+
+    :param backend: The I2C backend to scan with, see `i2c_backends`.
+    :param refresh: Whether to scan again, ignoring cached results.
+    :return: A dict of the responding addresses to the names of their
+    drivers, or "" for unknown chips.
+    """
+    if backend is None:
+        backend = "emulated" if hardware.emulated() else i2c_backends.DEFAULT_BACKEND
+    key = _cache_key(bus, backend)
+
+    if not refresh and key in _scanned:
+        return _scanned[key]
+
+    boot_id = _boot_id()
+    # Emulated devices do not persist across processes.
+    persistent = boot_id is not None and backend != "emulated"
+    buses = _load_cache(boot_id) if persistent else {}
+    if not refresh and key in buses:
+        found = {
+            int(address, base=16): driver for (address, driver) in buses[key].items()
+        }
+    else:
+        addresses = sorted(
+            {address for addresses in ADDRESSES.values() for address in addresses}
+        )
+        found = await i2c.run_sync(bus, _scan, bus, backend, addresses)
+        if persistent:
+            buses[key] = {hex(address): driver for (address, driver) in found.items()}
+            _store_cache(boot_id, buses)
+
+    _scanned[key] = found
+    return found
+
+
+def _describe(found: dict) -> str:
+    if not found:
+        return "no devices found"
+    return ", ".join(
+        f"{hex(address)} ({driver or 'unknown'})"
+        for (address, driver) in sorted(found.items())
+    )
+
+
+async def autofill(driver: str, configuration: dict, bus=1) -> dict:
+    """
+    Check a peripheral's configured I2C address against the discovered
+    devices, or fill in the address of the first discovered chip of the
+    driver.
+
+    :param driver: The name of the driver, e.g. "Bme280".
+    :return: The configuration, with "i2cAddress" set.
+    :raises FatalPeripheralError: If no matching device was found.
+    """
+    backend = i2c_backends.configured_backend(configuration)
+
+    if "i2cAddress" in configuration:
+        address = int(configuration["i2cAddress"], base=16)
+        found = await scan(bus, backend)
+        if address not in found:
+            # The device may have been absent or slow when the bus was scanned
+            found = await scan(bus, backend, refresh=True)
+        if address not in found:
+            raise FatalPeripheralError(
+                f"no I2C device at configured address {hex(address)} "
+                f"({driver}), bus {bus}: {_describe(found)}"
+            )
+        return configuration
+
+    addresses = _addresses(await scan(bus, backend), driver)
+    if not addresses:
+        found = await scan(bus, backend, refresh=True)
+        addresses = _addresses(found, driver)
+    if not addresses:
+        raise FatalPeripheralError(
+            f"no {driver} found on I2C bus {bus}: {_describe(found)}"
+        )
+    return dict(configuration, i2cAddress=hex(addresses[0]))
+
+
+def _addresses(found: dict, driver: str) -> list:
+    return [address for (address, name) in sorted(found.items()) if name == driver]
+
+
+def main():
+    import argparse
+
+    import trio
+
+    parser = argparse.ArgumentParser(description="Scan an I2C bus for known chips.")
+    parser.add_argument("--bus", type=int, default=1)
+    parser.add_argument("--backend", default=None)
+    parser.add_argument("--refresh", action="store_true", help="ignore cached results")
+    args = parser.parse_args()
+
+    found = trio.run(scan, args.bus, args.backend, args.refresh)
+    for (address, driver) in sorted(found.items()):
+        print(f"{hex(address)}  {driver or 'unknown'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Emulated hardware, for running the drivers without a Raspberry Pi.
+
+The submodules mirror the parts of the hardware interface libraries used by
+the drivers:
+
+- `pigpio`: a simulated pigpiod, with I2C register maps of the BME280, BH1750
+  and HD44780 LCD behind a PCF8574 backpack, DHT22 edge generation and PWM
+  state;
+- `serial`: a pty-backed MH-Z19;
+- `w1thermsensor`: DS18B20 sensors in a fake w1 sysfs tree;
+- `picamera2`: a camera producing synthetic frames;
+- `i2c_dev`: a fake /dev/i2c-N ioctl layer for `i2c_backends.DevI2cBackend`.
+
+Select emulation through `hardware`. The emulated devices report the
+physical quantities in `ENVIRONMENT`, with some noise.
+
+Transactions take roughly as long as on real hardware. The latencies are
+scaled by `LATENCY_SCALE` (or the ASTROPLANT_EMULATION_LATENCY_SCALE
+environment variable); set it to 0 to run at full speed.
+"""
+
+import os
+import random
+import time
+
+LATENCY_SCALE = float(os.environ.get("ASTROPLANT_EMULATION_LATENCY_SCALE", "1.0"))
+
+ENVIRONMENT = {
+    "temperature": 21.5,  # Degrees Celsius
+    "humidity": 55.0,  # Percent
+    "pressure": 1013.25,  # Hectopascal
+    "light": 350.0,  # Lux
+    "co2": 600.0,  # Parts per million
+}
+
+# Relative standard deviation of the noise on emulated readings.
+NOISE = 0.005
+
+
+def delay(seconds: float):
+    """
+    Block for an emulated latency.
+    """
+    seconds *= LATENCY_SCALE
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+def reading(quantity: str) -> float:
+    """
+    Get a noisy reading of a quantity in the emulated environment.
+    """
+    value = ENVIRONMENT[quantity]
+    return random.gauss(value, abs(value) * NOISE)
@@ -0,0 +1,219 @@
+"""
+A fake /dev/i2c-N ioctl layer on top of the emulated I2C devices.
+
+The layer decodes the I2C_SLAVE, I2C_SMBUS and I2C_RDWR ioctls of
+`i2c_backends.DevI2cBackend` as the kernel would, and performs them on the
+devices of the emulated pigpiod, such that the backend's ioctl encoding can be
+exercised without hardware:
+
+    fake = FakeI2cDev()
+    backend = i2c_backends.DevI2cBackend(1, 0x76, **fake.hooks())
+    assert backend.read_byte_data(0xD0) == 0x60
+
+Every ioctl is recorded in `FakeI2cDev.calls`, as (request, arg) tuples.
+
+Check the backend against the emulated pigpio backend with:
+
+    python -m astroplant_peripheral_device_library.emulation.i2c_dev
+"""
+
+import errno
+import itertools
+import re
+
+from .. import i2c_backends
+from . import pigpio
+
+
+class FakeI2cDev(object):
+    """
+    Open /dev/i2c-N files, answering their ioctls from emulated devices.
+    """
+
+    def __init__(self):
+        # Bus and selected address per open file descriptor.
+        self._files = {}
+        self._fds = itertools.count(1000)
+        self.calls = []
+
+    def hooks(self) -> dict:
+        """
+        Get the functions to pass to `DevI2cBackend`.
+        """
+        return {
+            "opener": self.open,
+            "ioctl": self.ioctl,
+            "reader": self.read,
+            "closer": self.close,
+        }
+
+    def open(self, path: str, flags: int) -> int:
+        match = re.fullmatch(r"/dev/i2c-(\d+)", path)
+        if match is None:
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory", path)
+        fd = next(self._fds)
+        self._files[fd] = [int(match.group(1)), None]
+        return fd
+
+    def close(self, fd: int):
+        if self._files.pop(fd, None) is None:
+            raise OSError(errno.EBADF, "Bad file descriptor")
+
+    def _device(self, fd: int, address=None):
+        if fd not in self._files:
+            raise OSError(errno.EBADF, "Bad file descriptor")
+        (bus, selected) = self._files[fd]
+        if address is None:
+            address = selected
+        if address is None:
+            raise OSError(errno.EINVAL, "Invalid argument")
+        device = pigpio._daemon.i2c_device(bus, address)
+        if device is None:
+            raise OSError(errno.ENXIO, "No such device or address")
+        return device
+
+    def read(self, fd: int, count: int) -> bytes:
+        with pigpio._daemon.lock:
+            return self._device(fd).read(count)
+
+    def ioctl(self, fd: int, request: int, arg):
+        self.calls.append((request, arg))
+        if fd not in self._files:
+            raise OSError(errno.EBADF, "Bad file descriptor")
+
+        with pigpio._daemon.lock:
+            if request == i2c_backends.I2C_SLAVE:
+                self._files[fd][1] = arg
+            elif request == i2c_backends.I2C_SMBUS:
+                self._smbus(self._device(fd), arg)
+            elif request == i2c_backends.I2C_RDWR:
+                for idx in range(arg.nmsgs):
+                    self._message(fd, arg.msgs[idx])
+            else:
+                raise OSError(errno.ENOTTY, "Inappropriate ioctl for device")
+        return 0
+
+    def _smbus(self, device, arg):
+        reading = arg.read_write == i2c_backends.I2C_SMBUS_READ
+        if arg.size == i2c_backends.I2C_SMBUS_BYTE:
+            if reading:
+                arg.data.contents.byte = device.read(1)[0]
+            else:
+                device.write([arg.command])
+        elif arg.size == i2c_backends.I2C_SMBUS_BYTE_DATA:
+            if reading:
+                device.write([arg.command])
+                arg.data.contents.byte = device.read(1)[0]
+            else:
+                device.write([arg.command, arg.data.contents.byte])
+        elif arg.size == i2c_backends.I2C_SMBUS_WORD_DATA:
+            if reading:
+                device.write([arg.command])
+                arg.data.contents.word = int.from_bytes(device.read(2), "little")
+            else:
+                word = arg.data.contents.word
+                device.write([arg.command, *word.to_bytes(2, "little")])
+        elif arg.size == i2c_backends.I2C_SMBUS_I2C_BLOCK_DATA:
+            block = arg.data.contents.block
+            count = block[0]
+            if not 0 < count <= i2c_backends.I2C_SMBUS_BLOCK_MAX:
+                raise OSError(errno.EINVAL, "Invalid argument")
+            if reading:
+                device.write([arg.command])
+                for (idx, value) in enumerate(device.read(count)):
+                    block[idx + 1] = value
+            else:
+                device.write([arg.command, *block[1 : count + 1]])
+        else:
+            raise OSError(errno.EINVAL, "Invalid argument")
+
+    def _message(self, fd: int, message):
+        device = self._device(fd, message.addr)
+        if message.flags & i2c_backends.I2C_M_RD:
+            data = device.read(message.len)
+            for (idx, value) in enumerate(data):
+                message.buf[idx] = value
+        else:
+            device.write([message.buf[idx] for idx in range(message.len)])
+
+
+def _write_read(write, read):
+    def operation(backend):
+        write(backend)
+        return read(backend)
+
+    return operation
+
+
+# Operations on a BME280, and their names.
+_OPERATIONS = [
+    ("read_byte_data", lambda b: b.read_byte_data(0xD0)),
+    ("read_word_data", lambda b: b.read_word_data(0x88)),
+    ("read_i2c_block_data", lambda b: b.read_i2c_block_data(0x88, 24)),
+    (
+        "write_byte_data",
+        _write_read(
+            lambda b: b.write_byte_data(0xF2, 0x05), lambda b: b.read_byte_data(0xF2)
+        ),
+    ),
+    (
+        "write_word_data",
+        _write_read(
+            lambda b: b.write_word_data(0xF4, 0x0127), lambda b: b.read_word_data(0xF4)
+        ),
+    ),
+    (
+        "write_i2c_block_data",
+        _write_read(
+            lambda b: b.write_i2c_block_data(0xF4, [0x27, 0xA0]),
+            lambda b: b.read_i2c_block_data(0xF4, 2),
+        ),
+    ),
+    ("transaction", lambda b: b.transaction([(False, [0xD0]), (True, 1)])),
+    (
+        "write_byte, read_byte",
+        _write_read(lambda b: b.write_byte(0xD0), lambda b: b.read_byte()),
+    ),
+    (
+        "write_byte, read_device",
+        _write_read(lambda b: b.write_byte(0x88), lambda b: b.read_device(6)),
+    ),
+]
+
+
+def _check(dev, reference) -> int:
+    """
+    Perform the same operations through both backends, and compare the
+    results.
+
+    :return: The number of operations whose results differ.
+    """
+    failures = 0
+    for (name, operation) in _OPERATIONS:
+        expected = operation(reference)
+        actual = operation(dev)
+        if actual != expected:
+            failures += 1
+            print(f"FAIL {name}: {actual!r}, expected {expected!r}")
+        else:
+            print(f"ok   {name}: {actual!r}")
+    return failures
+
+
+def main():
+    import sys
+
+    address = 0x76
+    fake = FakeI2cDev()
+    dev = i2c_backends.DevI2cBackend(1, address, **fake.hooks())
+    reference = i2c_backends.EmulatedBackend(1, address)
+    try:
+        failures = _check(dev, reference)
+    finally:
+        dev.close()
+        reference.close()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
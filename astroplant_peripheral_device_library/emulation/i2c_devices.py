@@ -0,0 +1,278 @@
+"""
+Register-level models of the I2C devices used in a kit.
+
+Each model sees the raw bytes of I2C writes and produces the bytes of I2C
+reads, as the physical chip would.
+"""
+
+import random
+
+from . import reading
+
+
+class I2cModel(object):
+    def write(self, data):
+        """
+        Handle bytes written to the device.
+        """
+        raise NotImplementedError()
+
+    def read(self, count: int) -> bytes:
+        """
+        Produce bytes read from the device.
+        """
+        raise NotImplementedError()
+
+
+class RegisterModel(I2cModel):
+    """
+    A device with a register pointer: the first byte written selects the
+    register, subsequent bytes are written to consecutive registers, and reads
+    start at the selected register.
+    """
+
+    def __init__(self):
+        self.registers = bytearray(256)
+        self.pointer = 0
+
+    def write(self, data):
+        data = bytes(data)
+        if not data:
+            return
+        self.pointer = data[0]
+        for value in data[1:]:
+            self.registers[self.pointer] = value
+            self.on_write(self.pointer, value)
+            self.pointer = (self.pointer + 1) & 0xFF
+
+    def read(self, count: int) -> bytes:
+        data = bytes(self.registers[(self.pointer + i) & 0xFF] for i in range(count))
+        self.pointer = (self.pointer + count) & 0xFF
+        return data
+
+    def on_write(self, register: int, value: int):
+        pass
+
+
+def _pack_u16(value):
+    return [value & 0xFF, (value >> 8) & 0xFF]
+
+
+def _pack_s16(value):
+    return _pack_u16(value & 0xFFFF)
+
+
+class Bme280Model(RegisterModel):
+    CHIP_ID = 0x60
+
+    # Calibration of a typical chip.
+    DIG_T = [27504, 26435, -1000]
+    DIG_P = [36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000]
+    DIG_H1 = 75
+    DIG_H2 = 362
+    DIG_H3 = 0
+    DIG_H4 = 313
+    DIG_H5 = 50
+    DIG_H6 = 30
+
+    # Raw ADC values reading 25 degrees Celsius, 1006 hPa and 35 % humidity
+    # with the calibration above.
+    ADC_T = 519888
+    ADC_P = 415148
+    ADC_H = 26500
+
+    def __init__(self):
+        super().__init__()
+        self.registers[0xD0] = self.CHIP_ID
+
+        cal1 = (
+            _pack_u16(self.DIG_T[0])
+            + _pack_s16(self.DIG_T[1])
+            + _pack_s16(self.DIG_T[2])
+        )
+        cal1 += _pack_u16(self.DIG_P[0])
+        for dig in self.DIG_P[1:]:
+            cal1 += _pack_s16(dig)
+        self.registers[0x88 : 0x88 + 24] = bytes(cal1)
+        self.registers[0xA1] = self.DIG_H1
+
+        cal3 = _pack_s16(self.DIG_H2) + [self.DIG_H3]
+        cal3 += [
+            (self.DIG_H4 >> 4) & 0xFF,
+            (self.DIG_H4 & 0x0F) | ((self.DIG_H5 & 0x0F) << 4),
+            (self.DIG_H5 >> 4) & 0xFF,
+            self.DIG_H6 & 0xFF,
+        ]
+        self.registers[0xE1 : 0xE1 + 7] = bytes(cal3)
+
+    def on_write(self, register: int, value: int):
+        # Writing a forced or normal mode to ctrl_meas starts a conversion
+        if register == 0xF4 and value & 0x03:
+            self._convert()
+
+    def _convert(self):
+        adc_t = self.ADC_T + int(random.gauss(0, 50))
+        adc_p = self.ADC_P + int(random.gauss(0, 50))
+        adc_h = self.ADC_H + int(random.gauss(0, 20))
+        self.registers[0xF7:0xFF] = bytes(
+            [
+                (adc_p >> 12) & 0xFF,
+                (adc_p >> 4) & 0xFF,
+                (adc_p << 4) & 0xF0,
+                (adc_t >> 12) & 0xFF,
+                (adc_t >> 4) & 0xFF,
+                (adc_t << 4) & 0xF0,
+                (adc_h >> 8) & 0xFF,
+                adc_h & 0xFF,
+            ]
+        )
+
+
+class Bh1750Model(I2cModel):
+    POWER_DOWN = 0x00
+    POWER_ON = 0x01
+    RESET = 0x07
+
+    MEASUREMENT_MODES = frozenset([0x10, 0x11, 0x13, 0x20, 0x21, 0x23])
+
+    def __init__(self):
+        self.powered = False
+        self.mode = None
+        self.mtreg = 69
+        self.count = 0
+
+    def write(self, data):
+        for command in bytes(data):
+            self._command(command)
+
+    def _command(self, command: int):
+        if command == self.POWER_DOWN:
+            self.powered = False
+        elif command == self.POWER_ON:
+            self.powered = True
+        elif command == self.RESET:
+            self.count = 0
+        elif command & 0xF8 == 0x40:
+            self.mtreg = (self.mtreg & 0x1F) | ((command & 0x07) << 5)
+        elif command & 0xE0 == 0x60:
+            self.mtreg = (self.mtreg & 0xE0) | (command & 0x1F)
+        elif command in self.MEASUREMENT_MODES:
+            self.mode = command
+            self.powered = True
+            self._convert()
+            if command & 0x20:
+                # One-time modes power down after the measurement
+                self.powered = False
+
+    def _convert(self):
+        coefficient = 2 if (self.mode & 0x03) == 0x01 else 1
+        count = int(reading("light") * 1.2 * (self.mtreg / 69.0) * coefficient)
+        count = min(max(count, 0), 0xFFFF)
+        if (self.mode & 0x03) == 0x03:
+            # Low resolution
+            count &= ~0x03
+        self.count = count
+
+    def read(self, count: int) -> bytes:
+        if self.powered and self.mode is not None and not self.mode & 0x20:
+            # Continuous modes keep converting
+            self._convert()
+        data = bytes([self.count >> 8, self.count & 0xFF])
+        return (data + bytes(count))[:count]
+
+
+class Pcf8574LcdModel(I2cModel):
+    """
+    An HD44780 character LCD in 4-bit mode, behind a PCF8574 I/O expander.
+    """
+
+    REGISTER_SELECT = 0x01
+    ENABLE = 0x04
+    BACKLIGHT = 0x08
+
+    ROW_OFFSETS = [0x00, 0x40, 0x14, 0x54]
+
+    def __init__(self):
+        self.ddram = bytearray(b" " * 0x80)
+        self.cgram = bytearray(64)
+        self.address = 0
+        self.cgram_selected = False
+        self.backlight = False
+
+        self.commands = 0
+        self.characters = 0
+
+        self._port = 0
+        self._high_nibble = None
+
+    def write(self, data):
+        for byte in bytes(data):
+            # Data is latched on the falling edge of the enable line
+            if self._port & self.ENABLE and not byte & self.ENABLE:
+                self._latch(self._port)
+            self._port = byte
+            self.backlight = bool(byte & self.BACKLIGHT)
+
+    def read(self, count: int) -> bytes:
+        return bytes([self._port]) * count
+
+    def _latch(self, port: int):
+        nibble = port & 0xF0
+        if self._high_nibble is None:
+            self._high_nibble = nibble
+            return
+
+        value = self._high_nibble | (nibble >> 4)
+        self._high_nibble = None
+        if port & self.REGISTER_SELECT:
+            self._data(value)
+        else:
+            self._command(value)
+
+    def _command(self, command: int):
+        self.commands += 1
+        if command & 0x80:
+            self.address = command & 0x7F
+            self.cgram_selected = False
+        elif command & 0x40:
+            self.address = command & 0x3F
+            self.cgram_selected = True
+        elif command == 0x01:
+            self.ddram[:] = b" " * len(self.ddram)
+            self.address = 0
+            self.cgram_selected = False
+        elif command & 0xFE == 0x02:
+            self.address = 0
+            self.cgram_selected = False
+
+    def _data(self, value: int):
+        self.characters += 1
+        if self.cgram_selected:
+            self.cgram[self.address] = value
+            self.address = (self.address + 1) & 0x3F
+        else:
+            self.ddram[self.address] = value
+            self.address = (self.address + 1) & 0x7F
+
+    def text(self, rows=2, columns=16):
+        """
+        Return the characters shown on the display, one string per row.
+        Custom characters (codes 0-7) are shown as their code.
+        """
+        lines = []
+        for row in range(rows):
+            offset = self.ROW_OFFSETS[row]
+            line = self.ddram[offset : offset + columns]
+            lines.append("".join(str(c) if c < 8 else chr(c) for c in line))
+        return lines
+
+
+# Models present at each address of an emulated bus.
+DEFAULT_DEVICES = {
+    0x23: Bh1750Model,
+    0x5C: Bh1750Model,
+    0x76: Bme280Model,
+    0x77: Bme280Model,
+    0x27: Pcf8574LcdModel,
+    0x3F: Pcf8574LcdModel,
+}
@@ -0,0 +1,61 @@
+"""
+An emulated picamera2 module, producing synthetic frames.
+"""
+
+import numpy as np
+from PIL import Image
+
+from . import delay
+
+# Time to expose and read out a full-resolution still.
+CAPTURE_TIME = 0.2
+
+
+class Picamera2(object):
+    def __init__(self, camera_num=0):
+        self.camera_num = camera_num
+        self.size = (1640, 1232)
+        self.started = False
+        self.frames = 0
+
+    def create_still_configuration(self, main=None, **kwargs):
+        main = dict(main or {})
+        main.setdefault("size", (3280, 2464))
+        return {"main": main}
+
+    def configure(self, config):
+        self.size = tuple(config["main"]["size"])
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def close(self):
+        self.stop()
+
+    def _frame(self, width, height):
+        """
+        Produce an RGB frame: a gradient, shifting with every frame.
+        """
+        self.frames += 1
+        x = np.arange(width, dtype=np.uint16)
+        y = np.arange(height, dtype=np.uint16)[:, np.newaxis]
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:, :, 0] = (x + self.frames) & 0xFF
+        frame[:, :, 1] = (y + self.frames) & 0xFF
+        frame[:, :, 2] = ((x + y) >> 1) & 0xFF
+        return frame
+
+    def capture_file(self, target, format=None):
+        delay(CAPTURE_TIME)
+        (width, height) = self.size
+        if isinstance(target, np.ndarray):
+            # Unencoded captures are padded to multiples of 32 by 16 pixels
+            padded_width = width + (-width % 32)
+            padded_height = height + (-height % 16)
+            frame = self._frame(padded_width, padded_height)
+            target[: frame.size] = frame.reshape(-1)
+        else:
+            Image.fromarray(self._frame(width, height)).save(target, format=format)
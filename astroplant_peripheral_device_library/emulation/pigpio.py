@@ -0,0 +1,483 @@
+"""
+An emulated pigpio module, with a simulated pigpiod behind it.
+
+Only the parts of the pigpio API used by the drivers are implemented. As with
+the real daemon, all `pi` connections share the same GPIO, PWM, script and
+I2C state.
+"""
+
+import threading
+import time
+
+from . import delay, reading
+from .i2c_devices import DEFAULT_DEVICES
+
+## Constants, as in pigpio
+INPUT = 0
+OUTPUT = 1
+
+LOW = 0
+HIGH = 1
+TIMEOUT = 2
+
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+
+PUD_OFF = 0
+PUD_DOWN = 1
+PUD_UP = 2
+
+PI_SCRIPT_INITING = 0
+PI_SCRIPT_HALTED = 1
+PI_SCRIPT_RUNNING = 2
+PI_SCRIPT_WAITING = 3
+PI_SCRIPT_FAILED = 4
+
+## Latencies
+# Round-trip of a command over the pigpiod socket.
+SOCKET_ROUND_TRIP = 0.0001
+# Time to transfer a byte over I2C at 100 kHz (8 bits and acknowledge).
+I2C_BYTE_TIME = 0.00009
+
+# Transaction counters, for benchmarking.
+stats = {
+    "commands": 0,
+    "i2c_transactions": 0,
+    "i2c_bytes": 0,
+    "gpio_edges": 0,
+}
+
+
+def reset_stats():
+    for key in stats:
+        stats[key] = 0
+
+
+class error(Exception):
+    pass
+
+
+def tickDiff(t1, t2):
+    tDiff = t2 - t1
+    if tDiff < 0:
+        tDiff += 1 << 32
+    return tDiff
+
+
+def _tick():
+    return int(time.monotonic() * 1e6) & 0xFFFFFFFF
+
+
+class _Daemon(object):
+    """
+    The state of the simulated pigpiod.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+
+        self.modes = {}
+        self.levels = {}
+        self.pwm_ranges = {}
+        self.pwm_duty_cycles = {}
+        self.hardware_pwm = {}
+        self.callbacks = []
+
+        self.scripts = {}
+        self._next_script = 0
+
+        # I2C devices per (bus, address), and open handles.
+        self.i2c_devices = {}
+        self.i2c_handles = {}
+        self._next_handle = 0
+
+        # GPIOs pulled low by the host, possibly triggering a DHT22.
+        self._triggered = {}
+        # Tick at which the last DHT22 message ended. Messages are spaced such
+        # that the decoder recognizes each start, also when latencies are
+        # scaled down.
+        self.dht22_tick = 0
+
+    def i2c_device(self, bus, address):
+        key = (bus, address)
+        if key not in self.i2c_devices:
+            model = DEFAULT_DEVICES.get(address)
+            self.i2c_devices[key] = model() if model is not None else None
+        return self.i2c_devices[key]
+
+    def open_i2c(self, bus, address):
+        handle = self._next_handle
+        self._next_handle += 1
+        self.i2c_handles[handle] = (bus, address)
+        return handle
+
+    def store_script(self, script):
+        script_id = self._next_script
+        self._next_script += 1
+        self.scripts[script_id] = _parse_script(script)
+        return script_id
+
+    def emit(self, gpio, level, tick):
+        stats["gpio_edges"] += 1
+        for callback in list(self.callbacks):
+            if callback.gpio != gpio:
+                continue
+            if (
+                level == TIMEOUT
+                or callback.edge == EITHER_EDGE
+                or (callback.edge == RISING_EDGE and level == 1)
+                or (callback.edge == FALLING_EDGE and level == 0)
+            ):
+                callback.func(gpio, level, tick)
+
+    def write(self, gpio, level):
+        self.levels[gpio] = level
+        if level == LOW and self.modes.get(gpio) == OUTPUT:
+            self._triggered[gpio] = _tick()
+
+    def set_mode(self, gpio, mode):
+        self.modes[gpio] = mode
+        if mode == INPUT and gpio in self._triggered:
+            # The host released the line after pulling it low: a DHT22 on
+            # this GPIO responds with a message.
+            start = max(self._triggered.pop(gpio), self.dht22_tick + 300000)
+            threading.Thread(
+                target=_emit_dht22_message, args=(self, gpio, start), daemon=True
+            ).start()
+
+
+_daemon = _Daemon()
+
+
+def _parse_script(script):
+    if isinstance(script, bytes):
+        script = script.decode("ascii")
+    tokens = script.split()
+    arities = {"pwm": 2, "hp": 3, "w": 2}
+
+    commands = []
+    idx = 0
+    while idx < len(tokens):
+        command = tokens[idx].lower()
+        if command not in arities:
+            return None
+        args = tokens[idx + 1 : idx + 1 + arities[command]]
+        commands.append((command, args))
+        idx += 1 + arities[command]
+    return commands
+
+
+def _emit_dht22_message(daemon, gpio, start):
+    humidity = int(round(reading("humidity") * 10))
+    temperature = int(round(reading("temperature") * 10))
+    if temperature < 0:
+        temperature = -temperature | 0x8000
+
+    data = [humidity >> 8, humidity & 0xFF, temperature >> 8, temperature & 0xFF]
+    data.append(sum(data) & 0xFF)
+    bits = [(byte >> (7 - idx)) & 1 for byte in data for idx in range(8)]
+
+    # The host held the line low for ~17 ms. The sensor answers with a
+    # response (80 us low, 80 us high), then each bit as 50 us low followed
+    # by 26 us (0) or 70 us (1) high.
+    edges = []
+    tick = start + 17000 + 30
+    edges.append((1, tick))
+    for duration in (20, 80):
+        tick += duration
+        edges.append((0, tick))
+        tick += 80
+        edges.append((1, tick))
+    for bit in bits:
+        tick += 70 if bit else 26
+        edges.append((0, tick))
+        tick += 50
+        edges.append((1, tick))
+
+    delay((tick - start) / 1e6)
+    with daemon.lock:
+        daemon.dht22_tick = tick
+        for (level, edge_tick) in edges:
+            daemon.emit(gpio, level, edge_tick & 0xFFFFFFFF)
+
+
+class _Callback(object):
+    def __init__(self, gpio, edge, func):
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func if func is not None else self._tally
+        self.count = 0
+
+    def _tally(self, gpio, level, tick):
+        self.count += 1
+
+    def tally(self):
+        return self.count
+
+    def reset_tally(self):
+        self.count = 0
+
+    def cancel(self):
+        with _daemon.lock:
+            if self in _daemon.callbacks:
+                _daemon.callbacks.remove(self)
+
+
+class pi(object):
+    def __init__(self, host=None, port=None, show_errors=True):
+        self.connected = True
+        self._callbacks = []
+
+    def stop(self):
+        for callback in self._callbacks:
+            callback.cancel()
+        self._callbacks = []
+        self.connected = False
+
+    def _command(self):
+        if not self.connected:
+            raise error("not connected to emulated pigpiod")
+        stats["commands"] += 1
+        delay(SOCKET_ROUND_TRIP)
+
+    ## GPIO
+    def set_mode(self, gpio, mode):
+        self._command()
+        with _daemon.lock:
+            _daemon.set_mode(gpio, mode)
+        return 0
+
+    def get_mode(self, gpio):
+        self._command()
+        return _daemon.modes.get(gpio, INPUT)
+
+    def set_pull_up_down(self, gpio, pud):
+        self._command()
+        return 0
+
+    def read(self, gpio):
+        self._command()
+        return _daemon.levels.get(gpio, LOW)
+
+    def write(self, gpio, level):
+        self._command()
+        with _daemon.lock:
+            # Writing implicitly makes the GPIO an output
+            _daemon.modes[gpio] = OUTPUT
+            _daemon.write(gpio, level)
+        return 0
+
+    def set_watchdog(self, user_gpio, wdog_timeout):
+        self._command()
+        return 0
+
+    def callback(self, user_gpio, edge=RISING_EDGE, func=None):
+        self._command()
+        callback = _Callback(user_gpio, edge, func)
+        with _daemon.lock:
+            _daemon.callbacks.append(callback)
+        self._callbacks.append(callback)
+        return callback
+
+    ## PWM
+    def set_PWM_range(self, user_gpio, range_):
+        self._command()
+        _daemon.pwm_ranges[user_gpio] = range_
+        return 0
+
+    def get_PWM_range(self, user_gpio):
+        self._command()
+        return _daemon.pwm_ranges.get(user_gpio, 255)
+
+    def set_PWM_dutycycle(self, user_gpio, dutycycle):
+        self._command()
+        _daemon.pwm_duty_cycles[user_gpio] = int(dutycycle)
+        return 0
+
+    def get_PWM_dutycycle(self, user_gpio):
+        self._command()
+        if user_gpio in _daemon.hardware_pwm:
+            return _daemon.hardware_pwm[user_gpio][1]
+        return _daemon.pwm_duty_cycles.get(user_gpio, 0)
+
+    def hardware_PWM(self, gpio, PWMfreq, PWMduty):
+        self._command()
+        _daemon.hardware_pwm[gpio] = (PWMfreq, int(PWMduty))
+        return 0
+
+    ## Scripts
+    def store_script(self, script):
+        self._command()
+        with _daemon.lock:
+            return _daemon.store_script(script)
+
+    def script_status(self, script_id):
+        self._command()
+        if script_id not in _daemon.scripts:
+            raise error("unknown script id")
+        if _daemon.scripts[script_id] is None:
+            return (PI_SCRIPT_FAILED, [0] * 10)
+        return (PI_SCRIPT_HALTED, [0] * 10)
+
+    def run_script(self, script_id, params=None):
+        self._command()
+        commands = _daemon.scripts.get(script_id)
+        if commands is None:
+            raise error("bad script id")
+
+        params = list(params or []) + [0] * 10
+
+        def value(arg):
+            return params[int(arg[1:])] if arg.startswith("p") else int(arg)
+
+        with _daemon.lock:
+            for (command, args) in commands:
+                args = [value(arg) for arg in args]
+                if command == "pwm":
+                    _daemon.pwm_duty_cycles[args[0]] = args[1]
+                elif command == "hp":
+                    _daemon.hardware_pwm[args[0]] = (args[1], args[2])
+                elif command == "w":
+                    _daemon.write(args[0], args[1])
+        return 0
+
+    def delete_script(self, script_id):
+        self._command()
+        _daemon.scripts.pop(script_id, None)
+        return 0
+
+    ## I2C
+    def i2c_open(self, i2c_bus, i2c_address, i2c_flags=0):
+        self._command()
+        with _daemon.lock:
+            return _daemon.open_i2c(i2c_bus, i2c_address)
+
+    def i2c_close(self, handle):
+        self._command()
+        with _daemon.lock:
+            _daemon.i2c_handles.pop(handle, None)
+        return 0
+
+    def _i2c(self, handle, num_bytes):
+        if handle not in _daemon.i2c_handles:
+            raise error("unknown handle")
+        (bus, address) = _daemon.i2c_handles[handle]
+        device = _daemon.i2c_device(bus, address)
+
+        stats["commands"] += 1
+        stats["i2c_transactions"] += 1
+        stats["i2c_bytes"] += num_bytes + 1
+        # Address byte plus data bytes
+        delay(SOCKET_ROUND_TRIP + (num_bytes + 1) * I2C_BYTE_TIME)
+
+        if device is None:
+            raise error("I2C write failed")
+        return device
+
+    def i2c_write_quick(self, handle, bit):
+        self._i2c(handle, 0)
+        return 0
+
+    def i2c_read_byte(self, handle):
+        with _daemon.lock:
+            return self._i2c(handle, 1).read(1)[0]
+
+    def i2c_write_byte(self, handle, byte_val):
+        with _daemon.lock:
+            self._i2c(handle, 1).write([byte_val])
+        return 0
+
+    def i2c_read_device(self, handle, count):
+        with _daemon.lock:
+            data = self._i2c(handle, count).read(count)
+        return (count, bytearray(data))
+
+    def i2c_write_device(self, handle, data):
+        with _daemon.lock:
+            self._i2c(handle, len(data)).write(data)
+        return 0
+
+    def i2c_read_byte_data(self, handle, reg):
+        with _daemon.lock:
+            device = self._i2c(handle, 2)
+            device.write([reg])
+            return device.read(1)[0]
+
+    def i2c_write_byte_data(self, handle, reg, byte_val):
+        with _daemon.lock:
+            self._i2c(handle, 2).write([reg, byte_val])
+        return 0
+
+    def i2c_read_word_data(self, handle, reg):
+        with _daemon.lock:
+            device = self._i2c(handle, 3)
+            device.write([reg])
+            data = device.read(2)
+        return data[0] | data[1] << 8
+
+    def i2c_write_word_data(self, handle, reg, word_val):
+        with _daemon.lock:
+            self._i2c(handle, 3).write([reg, word_val & 0xFF, word_val >> 8])
+        return 0
+
+    def i2c_read_i2c_block_data(self, handle, reg, count):
+        with _daemon.lock:
+            device = self._i2c(handle, 1 + count)
+            device.write([reg])
+            data = device.read(count)
+        return (count, bytearray(data))
+
+    def i2c_write_i2c_block_data(self, handle, reg, data):
+        with _daemon.lock:
+            self._i2c(handle, 1 + len(data)).write([reg, *data])
+        return 0
+
+    def i2c_zip(self, handle, data):
+        data = list(data)
+        num_bytes = 0
+        operations = []
+        idx = 0
+        while idx < len(data) and data[idx] != 0:
+            command = data[idx]
+            if command == 4:
+                # Address
+                idx += 2
+            elif command in (2, 3):
+                # Combined flag on/off
+                idx += 1
+            elif command == 6:
+                operations.append((True, data[idx + 1]))
+                num_bytes += data[idx + 1]
+                idx += 2
+            elif command == 7:
+                length = data[idx + 1]
+                operations.append((False, data[idx + 2 : idx + 2 + length]))
+                num_bytes += length
+                idx += 2 + length
+            else:
+                raise error("unsupported i2c_zip command")
+
+        result = bytearray()
+        with _daemon.lock:
+            device = self._i2c(handle, num_bytes)
+            for (is_read, payload) in operations:
+                if is_read:
+                    result += device.read(payload)
+                else:
+                    device.write(payload)
+        return (len(result), result)
+
+
+def i2c_devices():
+    """
+    Get the emulated I2C devices that have been accessed, per (bus, address).
+    """
+    return {key: device for (key, device) in _daemon.i2c_devices.items() if device}
+
+
+def pwm_duty_cycles():
+    """
+    Get the current software PWM duty cycle of each GPIO.
+    """
+    return dict(_daemon.pwm_duty_cycles)
@@ -0,0 +1,172 @@
+"""
+An emulated pyserial module, with an MH-Z19 CO2 sensor on the other end.
+
+Opening a port starts an emulated sensor on a pseudo-terminal, and talks to
+it through the pty, such that reads and writes go through the kernel as they
+would with the real UART.
+"""
+
+import fcntl
+import os
+import select
+import struct
+import termios
+import threading
+import time
+import tty
+
+from . import delay, reading
+
+EIGHTBITS = 8
+PARITY_NONE = "N"
+STOPBITS_ONE = 1
+
+# Time to transfer a byte at 9600 baud (start, 8 data and stop bits).
+BYTE_TIME = 10 / 9600
+
+# Time the sensor takes to process a command.
+PROCESSING_TIME = 0.002
+
+# Traffic counters, for benchmarking.
+stats = {
+    "frames": 0,
+    "bytes": 0,
+}
+
+
+def reset_stats():
+    for key in stats:
+        stats[key] = 0
+
+
+class SerialException(IOError):
+    pass
+
+
+def _checksum(frame) -> int:
+    return (0xFF - (sum(frame[1:8]) & 0xFF) + 1) & 0xFF
+
+
+class MhZ19Emulator(object):
+    """
+    An MH-Z19 on the master end of a pseudo-terminal.
+    """
+
+    def __init__(self):
+        # The slave end is held open, such that the master does not see a
+        # hangup before the port is opened.
+        (self.master, self._slave) = os.openpty()
+        self.port = os.ttyname(self._slave)
+        tty.setraw(self._slave)
+
+        self.detection_range = 5000
+        self.self_calibration = True
+        self.commands = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._slave)
+        os.close(self.master)
+
+    def _run(self):
+        buffer = bytearray()
+        while not self._stop.is_set():
+            (readable, _, _) = select.select([self.master], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                buffer += os.read(self.master, 64)
+            except OSError:
+                return
+
+            while True:
+                start = buffer.find(b"\xff\x01")
+                if start < 0:
+                    del buffer[: max(len(buffer) - 1, 0)]
+                    break
+                del buffer[:start]
+                if len(buffer) < 9:
+                    break
+                frame = bytes(buffer[:9])
+                if frame[8] != _checksum(frame):
+                    del buffer[:1]
+                    continue
+                del buffer[:9]
+                self._handle(frame)
+
+    def _handle(self, frame):
+        self.commands += 1
+        stats["frames"] += 1
+        command = frame[2]
+        delay(len(frame) * BYTE_TIME + PROCESSING_TIME)
+
+        if command == 0x86:
+            co2 = int(min(max(reading("co2"), 0), self.detection_range))
+            temperature = int(reading("temperature")) + 40
+            response = bytearray(
+                [0xFF, 0x86, co2 >> 8, co2 & 0xFF, temperature, 0, 0, 0, 0]
+            )
+            response[8] = _checksum(response)
+            delay(len(response) * BYTE_TIME)
+            os.write(self.master, bytes(response))
+        elif command == 0x79:
+            self.self_calibration = frame[3] == 0xA0
+        elif command == 0x99:
+            self.detection_range = frame[6] << 8 | frame[7]
+
+
+class Serial(object):
+    def __init__(
+        self,
+        port=None,
+        baudrate=9600,
+        bytesize=EIGHTBITS,
+        parity=PARITY_NONE,
+        stopbits=STOPBITS_ONE,
+        timeout=None,
+    ):
+        self.port = port
+        self.timeout = timeout
+
+        self.emulator = MhZ19Emulator()
+        self.fd = os.open(self.emulator.port, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self.fd)
+
+    @property
+    def in_waiting(self):
+        data = fcntl.ioctl(self.fd, termios.FIONREAD, struct.pack("I", 0))
+        return struct.unpack("I", data)[0]
+
+    def write(self, data):
+        # Writes return once buffered, like on a real tty; the sensor sees
+        # the command after it has been transmitted.
+        stats["bytes"] += len(data)
+        return os.write(self.fd, bytes(data))
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        data = bytearray()
+        while len(data) < size:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+            (readable, _, _) = select.select([self.fd], [], [], remaining)
+            if not readable:
+                break
+            data += os.read(self.fd, size - len(data))
+        stats["bytes"] += len(data)
+        return bytes(data)
+
+    def reset_input_buffer(self):
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+    def close(self):
+        os.close(self.fd)
+        self.emulator.close()
@@ -0,0 +1,83 @@
+"""
+An emulated w1thermsensor module, with DS18B20 sensors in a fake w1 sysfs
+tree.
+"""
+
+import os
+import tempfile
+
+from . import delay, reading
+
+THERM_SENSOR_DS18S20 = 0x10
+THERM_SENSOR_DS1822 = 0x22
+THERM_SENSOR_DS18B20 = 0x28
+THERM_SENSOR_DS1825 = 0x3B
+THERM_SENSOR_DS28EA00 = 0x42
+THERM_SENSOR_MAX31850K = 0x3B
+
+# Conversion time at 12 bit resolution.
+CONVERSION_TIME = 0.75
+
+# Sensors present on the emulated bus, as (type, id).
+SENSORS = [(THERM_SENSOR_DS18B20, "0000075a6c33")]
+
+BASE_DIRECTORY = tempfile.mkdtemp(prefix="astroplant-w1-")
+
+
+class NoSensorFoundError(Exception):
+    pass
+
+
+class SensorNotReadyError(Exception):
+    pass
+
+
+def _w1_slave(temperature: float) -> str:
+    """
+    Render the w1_slave file of a sensor reading the given temperature, at
+    the sensor's 1/16 degree resolution.
+    """
+    sixteenths = int(round(temperature * 16))
+    raw = sixteenths & 0xFFFF
+    data = [raw & 0xFF, raw >> 8, 0x4B, 0x46, 0x7F, 0xFF, 0x0C, 0x10]
+    crc = 0
+    for byte in data:
+        for _ in range(8):
+            mix = (crc ^ byte) & 0x01
+            crc >>= 1
+            if mix:
+                crc ^= 0x8C
+            byte >>= 1
+    data.append(crc)
+    hex_data = " ".join("%02x" % byte for byte in data)
+    millidegrees = sixteenths * 1000 // 16
+    return "%s : crc=%02x YES\n%s t=%d\n" % (hex_data, crc, hex_data, millidegrees)
+
+
+class W1ThermSensor(object):
+    def __init__(self, sensor_type=None, sensor_id=None):
+        for (type_, id_) in SENSORS:
+            if (sensor_type is None or sensor_type == type_) and (
+                sensor_id is None or sensor_id == id_
+            ):
+                break
+        else:
+            raise NoSensorFoundError("no sensor found with the given type and id")
+
+        self.type = type_
+        self.id = id_
+        self.sensorpath = os.path.join(
+            BASE_DIRECTORY, "%02x-%s" % (type_, id_), "w1_slave"
+        )
+        os.makedirs(os.path.dirname(self.sensorpath), exist_ok=True)
+
+    def get_temperature(self) -> float:
+        delay(CONVERSION_TIME)
+        with open(self.sensorpath, "w") as f:
+            f.write(_w1_slave(reading("temperature")))
+
+        with open(self.sensorpath) as f:
+            lines = f.readlines()
+        if not lines[0].strip().endswith("YES"):
+            raise SensorNotReadyError("sensor is not yet ready to read temperature")
+        return float(lines[1].split("t=")[1]) / 1000
@@ -0,0 +1,258 @@
+"""
+An on-disk archive of raw camera frames.
+
+Raw frames are written to `.npy` files through memory maps, with an index of
+the captures by timestamp and command. When the archive exceeds its size, the
+oldest captures are evicted. Frames are read back as read-only memory maps,
+such that NDVI and statistics can be recomputed with different parameters
+block by block, without loading whole frames into memory:
+
+    archive = FrameArchive("/var/lib/astroplant/frames")
+    capture = archive.captures(command="ndvi")[-1]
+    ndvi = archive.ndvi(capture)
+
+The camera archives its frames when configured with the "frameArchive"
+option:
+
+    "frameArchive": {
+        "directory": "/var/lib/astroplant/frames",
+        "maxBytes": 1073741824
+    }
+"""
+
+import json
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+
+DEFAULT_MAX_BYTES = 1 << 30
+DEFAULT_CHUNK_ROWS = 64
+
+
+class FrameArchive(object):
+    """
+    :param directory: The directory holding the frames and index, created if
+    needed.
+    :param max_bytes: The size of the frames kept, beyond which the oldest
+    captures are evicted.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._entries = self._load_index()
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.directory, file_name)
+
+    def _load_index(self) -> list:
+        try:
+            with open(self._path(INDEX_FILE)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return []
+        # Frames may have been removed behind the archive's back
+        return [entry for entry in entries if os.path.exists(self._path(entry["file"]))]
+
+    def _store_index(self):
+        path = self._path(INDEX_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self._entries, f)
+        os.replace(path + ".tmp", path)
+
+    @property
+    def size(self) -> int:
+        """
+        The size of the archived frames, in bytes.
+        """
+        with self._lock:
+            return sum(entry["bytes"] for entry in self._entries)
+
+    def add(self, frame, command: str, kind: str, capture=None) -> dict:
+        """
+        Archive a frame. Blocking, run it in a worker thread.
+
+        :param frame: The frame, as an array of height x width x channels.
+        :param command: The camera command the frame was captured for, e.g.
+        "ndvi".
+        :param kind: The kind of frame within the capture, e.g. "red" or
+        "nir".
+        :param capture: The id of the capture the frame belongs to. Frames
+        of one capture share an id. Defaults to a new id.
+        :return: The index entry of the frame.
+        """
+        timestamp = time.time()
+        if capture is None:
+            capture = f"{timestamp:.6f}"
+        file_name = f"{capture}-{kind}.npy"
+
+        try:
+            mapped = np.lib.format.open_memmap(
+                self._path(file_name), mode="w+", dtype=frame.dtype, shape=frame.shape
+            )
+            mapped[...] = frame
+            mapped.flush()
+            del mapped
+        except BaseException:
+            # Do not leave partially written frames behind
+            self._remove({"file": file_name})
+            raise
+
+        entry = {
+            "capture": capture,
+            "timestamp": timestamp,
+            "command": command,
+            "kind": kind,
+            "file": file_name,
+            "shape": list(frame.shape),
+            "dtype": str(frame.dtype),
+            "bytes": os.path.getsize(self._path(file_name)),
+        }
+        with self._lock:
+            self._entries.append(entry)
+            self._evict(keep=capture)
+            self._store_index()
+        return entry
+
+    def add_capture(self, frames: dict, command: str) -> list:
+        """
+        Archive the frames of a capture under one id. Blocking, run it in a
+        worker thread. If a frame cannot be archived, the frames of the
+        capture archived before it are removed again.
+
+        :param frames: The frames by kind, e.g. {"red": ..., "nir": ...}.
+        :param command: The camera command the frames were captured for.
+        :return: The index entries of the frames.
+        """
+        entries = []
+        capture = None
+        try:
+            for (kind, frame) in frames.items():
+                entry = self.add(frame, command, kind, capture)
+                capture = entry["capture"]
+                entries.append(entry)
+        except BaseException:
+            with self._lock:
+                for entry in entries:
+                    self._remove(entry)
+                self._store_index()
+            raise
+        return entries
+
+    def _remove(self, entry: dict):
+        try:
+            os.remove(self._path(entry["file"]))
+        except OSError:
+            pass
+        if entry in self._entries:
+            self._entries.remove(entry)
+
+    def _evict(self, keep):
+        total = sum(entry["bytes"] for entry in self._entries)
+        while total > self.max_bytes:
+            oldest = self._entries[0]["capture"]
+            if oldest == keep:
+                break
+            for entry in [e for e in self._entries if e["capture"] == oldest]:
+                self._remove(entry)
+                total -= entry["bytes"]
+
+    def captures(self, command=None, since=None, until=None) -> list:
+        """
+        Get the archived captures, oldest first, as dicts of the frame kinds
+        to their index entries.
+
+        :param command: Only captures of this command.
+        :param since: Only captures from this timestamp.
+        :param until: Only captures before this timestamp.
+        """
+        with self._lock:
+            entries = list(self._entries)
+
+        captures = {}
+        for entry in entries:
+            if command is not None and entry["command"] != command:
+                continue
+            if since is not None and entry["timestamp"] < since:
+                continue
+            if until is not None and entry["timestamp"] >= until:
+                continue
+            captures.setdefault(entry["capture"], {})[entry["kind"]] = entry
+        return list(captures.values())
+
+    def frame(self, entry: dict):
+        """
+        Open an archived frame as a read-only memory map.
+        """
+        return np.load(self._path(entry["file"]), mmap_mode="r")
+
+    def statistics(self, entry: dict, channel=0, chunk_rows=DEFAULT_CHUNK_ROWS) -> dict:
+        """
+        Compute the minimum, maximum, mean and standard deviation of a
+        channel of a frame, reading it in blocks of rows.
+        """
+        frame = self.frame(entry)
+        (minimum, maximum) = (math.inf, -math.inf)
+        (count, total, squares) = (0, 0.0, 0.0)
+        for start in range(0, frame.shape[0], chunk_rows):
+            block = frame[start : start + chunk_rows, :, channel].astype(np.float64)
+            minimum = min(minimum, float(block.min()))
+            maximum = max(maximum, float(block.max()))
+            count += block.size
+            total += float(block.sum())
+            squares += float(np.square(block).sum())
+
+        mean = total / count
+        return {
+            "minimum": minimum,
+            "maximum": maximum,
+            "mean": mean,
+            "stddev": math.sqrt(max(squares / count - mean * mean, 0.0)),
+        }
+
+    def ndvi(
+        self,
+        capture: dict,
+        red_channel=0,
+        nir_channel=0,
+        chunk_rows=DEFAULT_CHUNK_ROWS,
+        out=None,
+    ):
+        """
+        Compute the NDVI of a capture with red and NIR frames, reading the
+        frames in blocks of rows.
+
+        :param capture: The capture, see `captures`.
+        :param red_channel: The channel of the red frame holding red light.
+        :param nir_channel: The channel of the NIR frame holding near
+        infrared light.
+        :param out: An array of height x width to write the NDVI to, e.g. a
+        memory map. Defaults to a new float32 array.
+        :return: The NDVI, between -1 and 1; 0 where both frames are dark.
+        """
+        red = self.frame(capture["red"])
+        nir = self.frame(capture["nir"])
+        if out is None:
+            out = np.empty(red.shape[:2], dtype=np.float32)
+
+        for start in range(0, red.shape[0], chunk_rows):
+            rows = slice(start, start + chunk_rows)
+            red_block = red[rows, :, red_channel].astype(np.float32)
+            nir_block = nir[rows, :, nir_channel].astype(np.float32)
+            denominator = nir_block + red_block
+            np.divide(
+                nir_block - red_block,
+                denominator,
+                out=out[rows],
+                where=denominator != 0,
+            )
+            out[rows][denominator == 0] = 0.0
+        return out
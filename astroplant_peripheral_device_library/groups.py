@@ -0,0 +1,119 @@
+"""
+Measurement groups, measuring several sensors together.
+
+A group first triggers the conversions of all its sensors, then waits once
+until the slowest conversion is done, and then reads all results. The latency
+of a group measurement is that of its slowest sensor rather than the sum over
+its sensors, and all measurements of a round share one timestamp:
+
+    group = groups.MeasurementGroup([bme280, bh1750, ds18b20])
+    result = await group.measure()
+
+Sensors take part in the trigger and read phases by implementing
+`trigger_sample`, returning the trio time at which their result is ready, and
+`read_sample`. Other sensors (e.g. DS18B20, DHT22 and MH-Z19, whose
+conversion is driven by a blocking call or by the sensor itself) take their
+`sample` concurrently with the group's wait. Samples, and the trigger and read
+of a sensor together, go through the sensors' circuit breakers.
+"""
+
+import time
+from collections import namedtuple
+
+import trio
+
+from . import timeline
+
+GroupMeasurement = namedtuple(
+    "GroupMeasurement", ["timestamp", "measurements", "errors"]
+)
+
+
+def _triggered(sensor) -> bool:
+    return hasattr(sensor, "trigger_sample") and hasattr(sensor, "read_sample")
+
+
+class MeasurementGroup(object):
+    """
+    A group of sensors measured together.
+
+    :param sensors: The sensors, implementing `sample`, and optionally
+    `trigger_sample` and `read_sample`.
+    """
+
+    def __init__(self, sensors):
+        self.sensors = list(sensors)
+
+    async def measure(self) -> GroupMeasurement:
+        """
+        Measure all sensors in the group. A sensor failing does not affect
+        the others.
+
+        :return: The timestamp of the round, the measurements per sensor, and
+        the errors of the sensors that failed.
+        """
+        samples = {}
+        errors = {}
+        # Trio times at which the triggered conversions are done.
+        ready_at = {}
+
+        triggered = [sensor for sensor in self.sensors if _triggered(sensor)]
+        # Sensors whose trigger has not finished yet.
+        triggering = set(triggered)
+        all_triggered = trio.Event()
+        # Set once the slowest conversion is done.
+        reading = trio.Event()
+
+        def _done_triggering(sensor):
+            triggering.discard(sensor)
+            if not triggering:
+                all_triggered.set()
+
+        async def _trigger_and_read(sensor):
+            try:
+                ready_at[sensor] = await sensor.trigger_sample()
+            finally:
+                _done_triggering(sensor)
+            await reading.wait()
+            return await sensor.read_sample()
+
+        async def _measure_triggered(sensor):
+            # Trigger and read are one call through the circuit breaker, such
+            # that a probe only succeeds once the result has been read.
+            try:
+                samples[sensor] = await sensor.breaker.call(_trigger_and_read, sensor)
+            except Exception as e:
+                errors[sensor] = e
+            finally:
+                _done_triggering(sensor)
+
+        async def _sample(sensor):
+            try:
+                samples[sensor] = await sensor.breaker.call(sensor.sample)
+            except Exception as e:
+                errors[sensor] = e
+
+        if not triggering:
+            all_triggered.set()
+
+        with timeline.span("measurement group", "driver", sensors=len(self.sensors)):
+            async with trio.open_nursery() as nursery:
+                for sensor in self.sensors:
+                    if _triggered(sensor):
+                        nursery.start_soon(_measure_triggered, sensor)
+                    else:
+                        nursery.start_soon(_sample, sensor)
+
+                await all_triggered.wait()
+                if ready_at:
+                    await trio.sleep_until(max(ready_at.values()))
+                timestamp = time.time()
+                reading.set()
+
+        measurements = {}
+        for sensor in self.sensors:
+            if sensor in samples:
+                measurements[sensor] = sensor.aggregation.measurements(
+                    samples[sensor], timestamp
+                )
+        return GroupMeasurement(timestamp, measurements, errors)
@@ -0,0 +1,79 @@
+"""
+Access to the hardware interface libraries used by the drivers.
+
+Drivers obtain pigpio, pyserial, picamera2 and w1thermsensor through this
+module, such that emulated hardware (see `emulation`) can be selected
+instead. Emulation is selected for the whole process by setting the
+ASTROPLANT_EMULATION environment variable or calling `set_emulation`, or
+per peripheral by the "emulated" configuration option.
+
+When traffic is recorded or replayed (see `trace`), pigpio and pyserial are
+wrapped accordingly.
+"""
+
+import importlib
+import os
+
+from . import trace
+
+EMULATION_ENV = "ASTROPLANT_EMULATION"
+
+_emulation = os.environ.get(EMULATION_ENV, "") not in ("", "0")
+
+
+def set_emulation(enabled: bool):
+    """
+    Select emulated hardware for all peripherals that do not configure
+    otherwise.
+    """
+    global _emulation
+    _emulation = enabled
+
+
+def emulated(configuration=None) -> bool:
+    """
+    Whether emulated hardware is to be used.
+
+    :param configuration: The peripheral configuration, if any.
+    """
+    if configuration is not None and "emulated" in configuration:
+        return bool(configuration["emulated"])
+    return _emulation
+
+
+def _module(name: str, configuration):
+    if emulated(configuration):
+        return importlib.import_module(f".emulation.{name}", __package__)
+    return importlib.import_module(name)
+
+
+def pigpio(configuration=None):
+    """
+    Get the pigpio module, or its emulation.
+    """
+    if trace.replaying():
+        return trace.replay_pigpio()
+    return trace.record_pigpio(_module("pigpio", configuration))
+
+
+def serial(configuration=None):
+    """
+    Get the pyserial module, or its emulation.
+    """
+    if trace.replaying():
+        return trace.replay_serial()
+    return trace.record_serial(_module("serial", configuration))
+
+
+def picamera2(configuration=None):
+    """
+    Get the picamera2 module, or its emulation.
+    """
+    return _module("picamera2", configuration)
+
+
+def w1thermsensor(configuration=None):
+    """
+    Get the w1thermsensor module, or its emulation.
+    """
+    return _module("w1thermsensor", configuration)
@@ -1,5 +1,11 @@
-from time import sleep
-import pigpio
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import trio
+
+from . import i2c_backends, i2c_bus, metrics, timeline, workers
+from .i2c_bus import PRIORITY_DISPLAY, PRIORITY_SENSOR
 
 """
 SMBus protocol summary:
@@ -9,27 +15,184 @@ https://www.kernel.org/doc/Documentation/i2c/smbus-protocol
 
 SLEEP_TIME = 0.0001
 
+# Delays a device requires between transactions, in seconds:
+# - post_write_delay: after a write, before the next transaction;
+# - inter_byte_delay: between the bytes written by `I2cDevice.write_bytes`.
+TimingProfile = namedtuple(
+    "TimingProfile",
+    ["post_write_delay", "inter_byte_delay"],
+    defaults=[SLEEP_TIME, 0.0],
+)
+
+DEFAULT_TIMING = TimingProfile()
+NO_DELAY_TIMING = TimingProfile(post_write_delay=0.0, inter_byte_delay=0.0)
+
+## Operations of combined transactions
+# Write bytes to the device.
+Write = namedtuple("Write", ["data"])
+# Read a number of bytes from the device.
+Read = namedtuple("Read", ["count"])
+
+# The number of transactions that may be in flight concurrently on a bus, when
+# running transactions asynchronously.
+BUS_CAPACITY = 1
+
+_bus_limiters = {}
+
+
+def bus_limiter(bus: int) -> trio.CapacityLimiter:
+    """
+    Get the capacity limiter for asynchronous transactions on a bus.
+    """
+    if bus not in _bus_limiters:
+        _bus_limiters[bus] = trio.CapacityLimiter(BUS_CAPACITY)
+    return _bus_limiters[bus]
+
+
+async def run_sync(bus: int, fn, *args, priority=PRIORITY_SENSOR):
+    """
+    Run a function performing blocking transactions on a bus in a worker
+    thread of the shared pool, without blocking the event loop.
+
+    :param bus: The bus the transactions are performed on.
+    :param fn: The function to run.
+    :param priority: The priority of the transactions, see `i2c_bus`.
+    """
+    return await workers.run_sync(
+        fn, *args, group=f"i2c-{bus}", priority=priority, limiter=bus_limiter(bus)
+    )
+
+
+def _encode_messages(operations) -> list:
+    messages = []
+    for operation in operations:
+        if isinstance(operation, Write):
+            if not 0 < len(operation.data) <= 255:
+                raise ValueError("write length must be between 1 and 255 bytes")
+            messages.append((False, list(operation.data)))
+        elif isinstance(operation, Read):
+            if not 0 < operation.count <= 255:
+                raise ValueError("read length must be between 1 and 255 bytes")
+            messages.append((True, operation.count))
+        else:
+            raise TypeError(f"unknown I2C operation: {operation!r}")
+    return messages
+
 
 class I2cDevice(object):
-    def __init__(self, address, bus=1):
+    def __init__(
+        self,
+        address,
+        bus=1,
+        priority=PRIORITY_SENSOR,
+        backend=None,
+        timing=DEFAULT_TIMING,
+    ):
         """
         Initialize the I2C device.
 
         Raspberry Pi revision 2, Raspberry Pi 2 & Raspberry Pi 3 use bus 1
         Raspberry Pi revision 1 uses bus 0
+
+        :param priority: The priority of this device's transactions when
+        waiting for the bus, see `i2c_bus`.
+        :param backend: The name of the backend performing the transactions,
+        see `i2c_backends`. Defaults to pigpio.
+        :param timing: The `TimingProfile` of the device.
         """
         self.bus = bus
         self.address = address
-        self.pi = pigpio.pi()
+        self.priority = priority
+        self.timing = timing
+        self.bus_scheduler = i2c_bus.get_bus(bus)
+
+        # Monotonic time before which the next transaction may not start.
+        self.ready_at = 0.0
 
-        # Open I2C handle
-        self.handle = self.pi.i2c_open(self.bus, self.address)
+        self.backend = i2c_backends.open_backend(backend, bus, address)
 
     def stop(self):
         """
         Release resources.
         """
-        self.pi.stop()
+        self.backend.close()
+
+    def exclusive(self):
+        """
+        Hold the bus for the duration of the context, such that a sequence of
+        transactions is not interleaved with transactions of other devices.
+        """
+        return self.bus_scheduler.transaction(self.priority)
+
+    def defer(self, seconds: float):
+        """
+        Require the next transaction to start no sooner than the given time
+        from now.
+        """
+        self.ready_at = max(self.ready_at, time.monotonic() + seconds)
+
+    def _wait_until_ready(self):
+        delay = self.ready_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    @contextmanager
+    def _transaction(self, size: int):
+        """
+        :param size: The number of bytes transferred, for metrics.
+        """
+        # Delays are waited before acquiring the bus, leaving the bus free for
+        # other devices in the meantime.
+        self._wait_until_ready()
+        with self.exclusive(), timeline.span(
+            f"i2c {self.address:#04x}", "i2c", bus=self.bus, size=size
+        ):
+            self._wait_until_ready()
+            if not metrics.enabled():
+                yield
+                return
+
+            start = time.perf_counter()
+            failed = True
+            try:
+                yield
+                failed = False
+            finally:
+                metrics.record_i2c(
+                    self.bus,
+                    self.address,
+                    size,
+                    time.perf_counter() - start,
+                    failed,
+                )
+
+    def _wrote(self):
+        self.ready_at = time.monotonic() + self.timing.post_write_delay
+
+    def transaction(self, operations):
+        """
+        Perform a sequence of writes and reads as one combined transaction,
+        with repeated starts between the operations.
+
+        :param operations: A list of `Write` and `Read` operations.
+        :return: A list with the bytes read by each `Read` operation.
+        """
+        messages = _encode_messages(operations)
+        size = sum(
+            payload if is_read else len(payload) for (is_read, payload) in messages
+        )
+        with self._transaction(size):
+            data = self.backend.transaction(messages)
+            if any(not is_read for (is_read, _) in messages):
+                self._wrote()
+
+        results = []
+        offset = 0
+        for operation in operations:
+            if isinstance(operation, Read):
+                results.append(data[offset : offset + operation.count])
+                offset += operation.count
+        return results
 
     def read_byte(self):
         """
@@ -37,7 +200,8 @@ class I2cDevice(object):
 
         :return: A byte read from the I2C device.
         """
-        return self.pi.i2c_read_byte(self.handle)
+        with self._transaction(1):
+            return self.backend.read_byte()
 
     def write_byte(self, byte: int):
         """
@@ -45,8 +209,31 @@ class I2cDevice(object):
 
         :param byte: The byte to write.
         """
-        self.pi.i2c_write_byte(self.handle, byte)
-        sleep(SLEEP_TIME)
+        with self._transaction(1):
+            self.backend.write_byte(byte)
+            self._wrote()
+
+    def write_bytes(self, data):
+        """
+        Write bytes to the I2C device one by one, honouring the device's
+        inter-byte delay.
+
+        :param data: The bytes to write.
+        """
+        for byte in data:
+            self.write_byte(byte)
+            self.defer(self.timing.inter_byte_delay)
+
+    def read_device(self, count: int):
+        """
+        Read raw bytes from the I2C device, without sending a register or
+        command first.
+
+        :param count: The number of bytes to read.
+        :return: The bytes read from the I2C device.
+        """
+        with self._transaction(count):
+            return self.backend.read_device(count)
 
     def read_byte_data(self, register: int):
         """
@@ -55,7 +242,8 @@ class I2cDevice(object):
         :param register: The address of the register to read from.
         :return: A byte read from the I2C device.
         """
-        return self.pi.i2c_read_byte_data(self.handle, register)
+        with self._transaction(2):
+            return self.backend.read_byte_data(register)
 
     def write_byte_data(self, register: int, data: int):
         """
@@ -64,8 +252,9 @@ class I2cDevice(object):
         :param register: The address of the register to write to.
         :param data: The data byte to write.
         """
-        self.pi.i2c_write_byte_data(self.handle, register, data)
-        sleep(SLEEP_TIME)
+        with self._transaction(2):
+            self.backend.write_byte_data(register, data)
+            self._wrote()
 
     def read_word_data(self, register: int):
         """
@@ -74,7 +263,8 @@ class I2cDevice(object):
         :param register: The address of the register to read from.
         :return: A word (two bytes) read from the I2C device.
         """
-        return self.pi.i2c_read_word_data(self.handle, register)
+        with self._transaction(3):
+            return self.backend.read_word_data(register)
 
     def write_word_data(self, register: int, data: int):
         """
@@ -83,8 +273,9 @@ class I2cDevice(object):
         :param register: The address of the register to write to.
         :param data: The data word (two bytes) to write.
         """
-        self.pi.i2c_write_byte_data(self.handle, register, data)
-        sleep(SLEEP_TIME)
+        with self._transaction(3):
+            self.backend.write_word_data(register, data)
+            self._wrote()
 
     def read_i2c_block_data(self, register: int, count: int):
         """
@@ -92,8 +283,10 @@ class I2cDevice(object):
 
         :param register: The address of the register to read from.
         :param length: The number of bytes to read.
+        :return: The bytes read from the I2C device.
         """
-        return self.pi.i2c_read_i2c_block_data(self.handle, register, count)
+        with self._transaction(1 + count):
+            return self.backend.read_i2c_block_data(register, count)
 
     def write_i2c_block_data(self, register: int, data):
         """
@@ -102,5 +295,94 @@ class I2cDevice(object):
         :param register: The address of the register to write to.
         :param data: The list of data to write.
         """
-        self.pi.i2c_write_i2c_block_data(self.handle, register, data)
-        sleep(SLEEP_TIME)
+        with self._transaction(1 + len(data)):
+            self.backend.write_i2c_block_data(register, data)
+            self._wrote()
+
+
+class AsyncI2cDevice(object):
+    """
+    Asynchronous counterpart of `I2cDevice`.
+
+    Transactions are run in worker threads, such that a slow device does not
+    stall the event loop. Transactions on a bus are limited by the bus'
+    capacity limiter.
+    """
+
+    def __init__(
+        self,
+        address,
+        bus=1,
+        priority=PRIORITY_SENSOR,
+        backend=None,
+        timing=DEFAULT_TIMING,
+    ):
+        self.device = I2cDevice(
+            address, bus=bus, priority=priority, backend=backend, timing=timing
+        )
+        self.bus = bus
+        self.address = address
+
+    def stop(self):
+        """
+        Release resources.
+        """
+        self.device.stop()
+
+    async def run_sync(self, fn, *args):
+        """
+        Run a function performing multiple blocking transactions on `device`
+        in one go. The bus is held for the duration of the function.
+
+        :param fn: The function to run.
+        """
+
+        def _run():
+            with self.device.exclusive():
+                return fn(*args)
+
+        # Attribute offloaded work to the function, rather than the wrapper
+        _run.__qualname__ = getattr(fn, "__qualname__", _run.__qualname__)
+
+        await self._wait_until_ready()
+        return await run_sync(self.bus, _run, priority=self.device.priority)
+
+    async def _wait_until_ready(self):
+        # Wait for a pending delay on the event loop, rather than in a worker
+        # thread
+        delay = self.device.ready_at - time.monotonic()
+        if delay > 0:
+            await trio.sleep(delay)
+
+    async def transaction(self, operations):
+        await self._wait_until_ready()
+        return await run_sync(
+            self.bus, self.device.transaction, operations, priority=self.device.priority
+        )
+
+    async def read_byte(self):
+        return await self.run_sync(self.device.read_byte)
+
+    async def write_byte(self, byte: int):
+        await self.run_sync(self.device.write_byte, byte)
+
+    async def read_device(self, count: int):
+        return await self.run_sync(self.device.read_device, count)
+
+    async def read_byte_data(self, register: int):
+        return await self.run_sync(self.device.read_byte_data, register)
+
+    async def write_byte_data(self, register: int, data: int):
+        await self.run_sync(self.device.write_byte_data, register, data)
+
+    async def read_word_data(self, register: int):
+        return await self.run_sync(self.device.read_word_data, register)
+
+    async def write_word_data(self, register: int, data: int):
+        await self.run_sync(self.device.write_word_data, register, data)
+
+    async def read_i2c_block_data(self, register: int, count: int):
+        return await self.run_sync(self.device.read_i2c_block_data, register, count)
+
+    async def write_i2c_block_data(self, register: int, data):
+        await self.run_sync(self.device.write_i2c_block_data, register, data)
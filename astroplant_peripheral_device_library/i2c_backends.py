@@ -0,0 +1,326 @@
+"""
+Backends performing the actual I2C transactions of an `i2c.I2cDevice`.
+
+- "pigpio" (default): transactions are sent to the pigpiod daemon.
+- "dev": transactions are performed directly on /dev/i2c-N using the kernel's
+  SMBus and I2C_RDWR ioctls, bypassing the daemon.
+- "emulated": transactions are performed on the emulated devices of
+  `emulation.pigpio`. This is the default when emulation is enabled, see
+  `hardware`.
+- "replay": transactions are answered from a recorded trace. This is always
+  used while a trace is replayed, see `trace`.
+
+Backends perform single transactions; serialization and timing are handled
+by `i2c.I2cDevice`.
+"""
+
+import ctypes
+import os
+
+from . import hardware, trace
+
+## Linux I2C ioctls (linux/i2c-dev.h)
+I2C_SLAVE = 0x0703
+I2C_RDWR = 0x0707
+I2C_SMBUS = 0x0720
+
+I2C_SMBUS_READ = 1
+I2C_SMBUS_WRITE = 0
+
+I2C_SMBUS_BYTE = 1
+I2C_SMBUS_BYTE_DATA = 2
+I2C_SMBUS_WORD_DATA = 3
+I2C_SMBUS_I2C_BLOCK_DATA = 8
+
+I2C_SMBUS_BLOCK_MAX = 32
+
+I2C_M_RD = 0x0001
+
+## pigpio i2c_zip commands
+ZIP_END = 0
+ZIP_COMBINED_ON = 2
+ZIP_COMBINED_OFF = 3
+ZIP_ADDRESS = 4
+ZIP_READ = 6
+ZIP_WRITE = 7
+
+DEFAULT_BACKEND = "pigpio"
+
+
+class _SmbusData(ctypes.Union):
+    _fields_ = [
+        ("byte", ctypes.c_uint8),
+        ("word", ctypes.c_uint16),
+        ("block", ctypes.c_uint8 * (I2C_SMBUS_BLOCK_MAX + 2)),
+    ]
+
+
+class _SmbusIoctlData(ctypes.Structure):
+    _fields_ = [
+        ("read_write", ctypes.c_uint8),
+        ("command", ctypes.c_uint8),
+        ("size", ctypes.c_uint32),
+        ("data", ctypes.POINTER(_SmbusData)),
+    ]
+
+
+class _I2cMsg(ctypes.Structure):
+    _fields_ = [
+        ("addr", ctypes.c_uint16),
+        ("flags", ctypes.c_uint16),
+        ("len", ctypes.c_uint16),
+        ("buf", ctypes.POINTER(ctypes.c_uint8)),
+    ]
+
+
+class _I2cRdwrIoctlData(ctypes.Structure):
+    _fields_ = [
+        ("msgs", ctypes.POINTER(_I2cMsg)),
+        ("nmsgs", ctypes.c_uint32),
+    ]
+
+
+class PigpioBackend(object):
+    """
+    Perform transactions through the pigpiod daemon.
+    """
+
+    def __init__(self, bus: int, address: int, pigpio=None):
+        if pigpio is None:
+            import pigpio
+
+        self.pi = pigpio.pi()
+        self.handle = self.pi.i2c_open(bus, address)
+        self.address = address
+
+    def close(self):
+        try:
+            self.pi.i2c_close(self.handle)
+        finally:
+            self.pi.stop()
+
+    def read_byte(self):
+        return self.pi.i2c_read_byte(self.handle)
+
+    def write_byte(self, byte: int):
+        self.pi.i2c_write_byte(self.handle, byte)
+
+    def read_device(self, count: int):
+        (_, data) = self.pi.i2c_read_device(self.handle, count)
+        return data
+
+    def read_byte_data(self, register: int):
+        return self.pi.i2c_read_byte_data(self.handle, register)
+
+    def write_byte_data(self, register: int, data: int):
+        self.pi.i2c_write_byte_data(self.handle, register, data)
+
+    def read_word_data(self, register: int):
+        return self.pi.i2c_read_word_data(self.handle, register)
+
+    def write_word_data(self, register: int, data: int):
+        self.pi.i2c_write_word_data(self.handle, register, data)
+
+    def read_i2c_block_data(self, register: int, count: int):
+        (_, data) = self.pi.i2c_read_i2c_block_data(self.handle, register, count)
+        return data
+
+    def write_i2c_block_data(self, register: int, data):
+        self.pi.i2c_write_i2c_block_data(self.handle, register, data)
+
+    def transaction(self, messages):
+        """
+        Perform a combined transaction.
+
+        :param messages: A list of (is_read, data or count) tuples.
+        :return: The concatenated bytes read.
+        """
+        commands = [ZIP_ADDRESS, self.address, ZIP_COMBINED_ON]
+        for (is_read, payload) in messages:
+            if is_read:
+                commands += [ZIP_READ, payload]
+            else:
+                commands += [ZIP_WRITE, len(payload), *payload]
+        commands += [ZIP_COMBINED_OFF, ZIP_END]
+
+        (_, data) = self.pi.i2c_zip(self.handle, commands)
+        return data
+
+
+class DevI2cBackend(object):
+    """
+    Perform transactions directly on the kernel's /dev/i2c-N character device.
+
+    The `opener`, `ioctl`, `reader` and `closer` functions can be replaced,
+    e.g. to test against a fake ioctl layer, see `emulation.i2c_dev`.
+    """
+
+    def __init__(
+        self,
+        bus: int,
+        address: int,
+        opener=os.open,
+        ioctl=None,
+        reader=os.read,
+        closer=os.close,
+    ):
+        if ioctl is None:
+            import fcntl
+
+            ioctl = fcntl.ioctl
+
+        self._ioctl = ioctl
+        self._reader = reader
+        self._closer = closer
+        self.address = address
+        self.fd = opener(f"/dev/i2c-{bus}", os.O_RDWR)
+        try:
+            self._ioctl(self.fd, I2C_SLAVE, address)
+        except Exception:
+            self._closer(self.fd)
+            raise
+
+    def close(self):
+        self._closer(self.fd)
+
+    def _smbus(self, read_write: int, command: int, size: int, data=None):
+        arg = _SmbusIoctlData(
+            read_write=read_write,
+            command=command,
+            size=size,
+            data=ctypes.pointer(data) if data is not None else None,
+        )
+        self._ioctl(self.fd, I2C_SMBUS, arg)
+
+    def read_byte(self):
+        data = _SmbusData()
+        self._smbus(I2C_SMBUS_READ, 0, I2C_SMBUS_BYTE, data)
+        return data.byte
+
+    def write_byte(self, byte: int):
+        self._smbus(I2C_SMBUS_WRITE, byte, I2C_SMBUS_BYTE)
+
+    def read_device(self, count: int):
+        return bytearray(self._reader(self.fd, count))
+
+    def read_byte_data(self, register: int):
+        data = _SmbusData()
+        self._smbus(I2C_SMBUS_READ, register, I2C_SMBUS_BYTE_DATA, data)
+        return data.byte
+
+    def write_byte_data(self, register: int, value: int):
+        data = _SmbusData(byte=value)
+        self._smbus(I2C_SMBUS_WRITE, register, I2C_SMBUS_BYTE_DATA, data)
+
+    def read_word_data(self, register: int):
+        data = _SmbusData()
+        self._smbus(I2C_SMBUS_READ, register, I2C_SMBUS_WORD_DATA, data)
+        return data.word
+
+    def write_word_data(self, register: int, value: int):
+        data = _SmbusData(word=value)
+        self._smbus(I2C_SMBUS_WRITE, register, I2C_SMBUS_WORD_DATA, data)
+
+    def read_i2c_block_data(self, register: int, count: int):
+        if not 0 < count <= I2C_SMBUS_BLOCK_MAX:
+            raise ValueError(
+                f"block length must be between 1 and {I2C_SMBUS_BLOCK_MAX}"
+            )
+        data = _SmbusData()
+        data.block[0] = count
+        self._smbus(I2C_SMBUS_READ, register, I2C_SMBUS_I2C_BLOCK_DATA, data)
+        return bytearray(data.block[1 : count + 1])
+
+    def write_i2c_block_data(self, register: int, values):
+        if not 0 < len(values) <= I2C_SMBUS_BLOCK_MAX:
+            raise ValueError(
+                f"block length must be between 1 and {I2C_SMBUS_BLOCK_MAX}"
+            )
+        data = _SmbusData()
+        data.block[0] = len(values)
+        for (idx, value) in enumerate(values):
+            data.block[idx + 1] = value
+        self._smbus(I2C_SMBUS_WRITE, register, I2C_SMBUS_I2C_BLOCK_DATA, data)
+
+    def transaction(self, messages):
+        """
+        Perform a combined transaction.
+
+        :param messages: A list of (is_read, data or count) tuples.
+        :return: The concatenated bytes read.
+        """
+        buffers = []
+        msgs = (_I2cMsg * len(messages))()
+        for (idx, (is_read, payload)) in enumerate(messages):
+            if is_read:
+                buffer = (ctypes.c_uint8 * payload)()
+                msgs[idx].flags = I2C_M_RD
+            else:
+                buffer = (ctypes.c_uint8 * len(payload))(*payload)
+                msgs[idx].flags = 0
+            buffers.append((is_read, buffer))
+            msgs[idx].addr = self.address
+            msgs[idx].len = len(buffer)
+            msgs[idx].buf = ctypes.cast(buffer, ctypes.POINTER(ctypes.c_uint8))
+
+        arg = _I2cRdwrIoctlData(msgs=msgs, nmsgs=len(messages))
+        self._ioctl(self.fd, I2C_RDWR, arg)
+
+        data = bytearray()
+        for (is_read, buffer) in buffers:
+            if is_read:
+                data += bytes(buffer)
+        return data
+
+
+class EmulatedBackend(PigpioBackend):
+    """
+    Perform transactions on emulated devices, through the emulated pigpiod.
+    """
+
+    def __init__(self, bus: int, address: int):
+        super().__init__(bus, address, pigpio=hardware.pigpio({"emulated": True}))
+
+
+BACKENDS = {
+    "pigpio": PigpioBackend,
+    "dev": DevI2cBackend,
+    "emulated": EmulatedBackend,
+    "replay": trace.ReplayBackend,
+}
+
+
+def configured_backend(configuration):
+    """
+    Get the name of the backend to use for a peripheral: the "i2cBackend"
+    configuration option if set, otherwise "emulated" if the peripheral is
+    emulated. If the peripheral opts out of emulation, the default backend is
+    used; otherwise None, for the default backend of `open_backend`.
+    """
+    name = configuration.get("i2cBackend")
+    if name is not None:
+        return name
+    if hardware.emulated(configuration):
+        return "emulated"
+    if "emulated" in configuration:
+        # Opted out of emulation, also when it is enabled globally
+        return DEFAULT_BACKEND
+    return None
+
+
+def open_backend(name, bus: int, address: int):
+    """
+    Open an I2C backend.
+
+    :param name: The name of the backend, see `BACKENDS`. If None, the
+    default backend is used, or the emulated backend if emulation is enabled.
+    While a trace is replayed, the replay backend is used regardless; while
+    recording, the backend is wrapped to record its operations.
+    """
+    if trace.replaying():
+        name = "replay"
+    elif name is None:
+        name = "emulated" if hardware.emulated() else DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"unknown I2C backend: {name}")
+    return trace.record_backend(BACKENDS[name](bus, address), bus, address)
@@ -0,0 +1,100 @@
+"""
+Bus-level scheduling of I2C transactions.
+
+Multiple devices (and threads) share a bus. Each bus is owned by an `I2cBus`,
+which serializes transactions on it. When multiple transactions are waiting
+for the bus, they are granted in order of priority, then in order of arrival.
+"""
+
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+
+## Transaction priorities, lower is more urgent
+PRIORITY_SENSOR = 0
+PRIORITY_DISPLAY = 10
+
+_buses = {}
+_buses_lock = threading.Lock()
+
+
+def get_bus(number: int) -> "I2cBus":
+    """
+    Get the scheduler owning a bus.
+
+    :param number: The bus number.
+    """
+    with _buses_lock:
+        if number not in _buses:
+            _buses[number] = I2cBus(number)
+        return _buses[number]
+
+
+class I2cBus(object):
+    def __init__(self, number: int):
+        self.number = number
+
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._arrivals = itertools.count()
+
+        # The bus is reentrant for the thread holding it.
+        self._owner = None
+        self._depth = 0
+
+    def acquire(self, priority=PRIORITY_SENSOR):
+        """
+        Wait until the bus is granted to the calling thread.
+
+        :param priority: The priority of the transaction, lower is more
+        urgent.
+        """
+        me = threading.get_ident()
+        with self._condition:
+            if self._owner == me:
+                self._depth += 1
+                return
+
+            ticket = (priority, next(self._arrivals))
+            heapq.heappush(self._waiting, ticket)
+            while self._owner is not None or self._waiting[0] != ticket:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+
+            self._owner = me
+            self._depth = 1
+
+    def release(self):
+        """
+        Release the bus.
+        """
+        with self._condition:
+            if self._owner != threading.get_ident():
+                raise RuntimeError("I2C bus released by a thread not holding it")
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._condition.notify_all()
+
+    @contextmanager
+    def transaction(self, priority=PRIORITY_SENSOR):
+        """
+        Hold the bus for the duration of the context.
+
+        :param priority: The priority of the transaction, lower is more
+        urgent.
+        """
+        self.acquire(priority)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        The number of transactions waiting for the bus.
+        """
+        with self._condition:
+            return len(self._waiting)
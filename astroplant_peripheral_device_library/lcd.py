@@ -1,5 +1,5 @@
 import threading
-from time import sleep
+from time import monotonic, sleep
 
 import trio
 from astroplant_kit.peripheral import (
@@ -8,7 +8,7 @@ from astroplant_kit.peripheral import (
     TemporaryPeripheralError,
 )
 
-from . import i2c
+from . import i2c, i2c_backends, lcd_glyphs, metrics, timeline
 
 # I2C device constants
 ## Commands
@@ -53,8 +53,17 @@ LCD_1_LINE = 0x00
 LCD_5x10_DOTS = 0x04
 LCD_5x8_DOTS = 0x00
 
-## Row offsets
-LCD_ROW_OFFSETS = [0x80, 0xC0, 0x94, 0xD4]
+## Row offsets of the first two rows. Rows 2 and 3 continue rows 0 and 1, such
+## that their offsets depend on the number of columns, e.g. 0x94 and 0xD4 on a
+## 20x4 display.
+LCD_ROW_OFFSETS = [0x80, 0xC0]
+
+## Execution times of commands, in seconds. Clearing and returning home take
+## 1.52 ms; during initialization the first function set takes over 4.1 ms
+## and the second over 100 us.
+LCD_CLEAR_HOME_TIME = 0.002
+LCD_INIT_FIRST_TIME = 0.0045
+LCD_INIT_SECOND_TIME = 0.00015
 
 ## RS/RW/EN bits
 REGISTER_SELECT = 0x01
@@ -62,7 +71,10 @@ READ_WRITE = 0x02
 ENABLE = 0x04
 
 
+@metrics.instrument
 class LCD(Display):
+    TICK_SECONDS = 0.3
+
     def __init__(self, *args, configuration):
         super().__init__(*args)
 
@@ -71,36 +83,70 @@ class LCD(Display):
         else:
             address = int("0x27", base=16)
 
-        self.lines = []
-        self.rows = 2
-        self.columns = 16
+        self.rows = configuration.get("rows", 2)
+        self.columns = configuration.get("columns", 16)
+        self.row_offsets = (
+            LCD_ROW_OFFSETS + [offset + self.columns for offset in LCD_ROW_OFFSETS]
+        )[: self.rows]
 
-        self.i2c_device = i2c.I2cDevice(address)
+        # Pages of lines; pages rotate every `page_seconds`
+        self.pages = []
+        self._content = None
+        self.page_seconds = configuration.get("pageSeconds", 5)
+        self.write_lock = threading.Lock()
+
+        # The character codes on screen per row, such that only changed
+        # characters are written
+        self._blank = [" "] * self.columns
+        self._screen = [[ord(" ")] * self.columns for _ in range(self.rows)]
+
+        # Custom characters in CGRAM, uploaded from the LCD thread
+        self.glyphs = lcd_glyphs.GlyphCache(self.upload_glyph)
+
+        # Sensor reads take precedence over redraws when sharing the bus
+        self.i2c_device = i2c.I2cDevice(
+            address,
+            priority=i2c.PRIORITY_DISPLAY,
+            backend=i2c_backends.configured_backend(configuration),
+            timing=i2c.NO_DELAY_TIMING,
+        )
+
+    def _initialize(self):
+        # Transactions do not delay, the execution times are deferred
+        self.write_command(0x03)
+        self.i2c_device.defer(LCD_INIT_FIRST_TIME)
+        self.write_command(0x03)
+        self.i2c_device.defer(LCD_INIT_SECOND_TIME)
+        self.write_command(0x03)
+        self.write_command(0x02)
+
+        # Set LCD to 2 lines (also for 4-row displays), 5*8 character size, and
+        # 4 bit mode
+        self.write_command(
+            LCD_FUNCTION_SET
+            | (LCD_2_LINES if self.rows > 1 else LCD_1_LINE)
+            | LCD_5x8_DOTS
+            | LCD_4_BIT_MODE
+        )
+
+        self.clear()
+        self._screen = [[ord(" ")] * self.columns for _ in range(self.rows)]
+        self.turn_on()
+        self.home()
+
+        # Set LCD entry mode to left entry
+        self.write_command(LCD_ENTRY_MODE_SET | LCD_ENTRY_LEFT)
 
     async def set_up(self):
         try:
-            # Initialize
-            self.write_command(0x03)
-            self.write_command(0x03)
-            self.write_command(0x03)
-            self.write_command(0x02)
-
-            # Set LCD to 2 lines, 5*8 character size, and 4 bit mode
-            self.write_command(
-                LCD_FUNCTION_SET | LCD_2_LINES | LCD_5x8_DOTS | LCD_4_BIT_MODE
+            # The initialization sequence is slow, run it off the event loop
+            await i2c.run_sync(
+                self.i2c_device.bus, self._initialize, priority=i2c.PRIORITY_DISPLAY
             )
-
-            self.clear()
-            self.turn_on()
-            self.home()
-
-            # Set LCD entry mode to left entry
-            self.write_command(LCD_ENTRY_MODE_SET | LCD_ENTRY_LEFT)
         except Exception as e:
             raise FatalPeripheralError("failed to set up LCD") from e
 
         self._stop = threading.Event()
-        self.write_lock = threading.Lock()
 
         # Start LCD updates.
         self.thread = threading.Thread(target=self._run)
@@ -114,82 +160,134 @@ class LCD(Display):
         self.i2c_device.stop()
 
     def display(self, str):
+        """
+        Display text. Lines beyond the number of rows, and pages separated by
+        form feeds, are shown as pages rotating every `pageSeconds`.
+        """
+        self.display_pages([page.splitlines() for page in str.split("\f")])
+
+    def display_cells(self, lines):
+        """
+        Display lines of cells, each cell a character or a custom glyph (see
+        `lcd_glyphs`).
+
+        :param lines: The lines, as lists of cells.
+        """
+        self.display_pages([lines])
+
+    def display_pages(self, pages):
+        """
+        Display pages of lines, rotating every `pageSeconds`. Pages with more
+        lines than rows are split.
+
+        :param pages: The pages, as lists of lines of characters or cells.
+        """
+        content = [[list(line) for line in page] for page in pages]
+        with self.write_lock:
+            if content == self._content:
+                # Keep the page rotation and scroll positions going
+                return
+            self._content = content
+
+        layout = []
+        for page in pages:
+            lines = [LCDLine(line, self.columns) for line in page]
+            for first in range(0, max(len(lines), 1), self.rows):
+                layout.append(lines[first : first + self.rows])
+
         with self.write_lock:
-            self.lines = [LCDLine(str) for str in str.splitlines()]
+            self.pages = layout
 
     def _run(self):
-        lines = []
+        page_index = 0
+        page_started = monotonic()
+        # The pages last shown
+        shown = None
 
         while not self._stop.is_set():
-            lines_changed = False
             with self.write_lock:
-                if lines != self.lines:
-                    lines_changed = True
-                lines = self.lines.copy()
+                pages = self.pages
+
+            if pages is not shown:
+                # New content, start at the first page
+                shown = pages
+                page_index = 0
+                page_started = monotonic()
+                for line in pages[0] if pages else []:
+                    line.rewind()
+            elif len(pages) > 1 and monotonic() - page_started >= self.page_seconds:
+                page_index = (page_index + 1) % len(pages)
+                page_started = monotonic()
+                for line in pages[page_index]:
+                    line.rewind()
+
+            page = pages[page_index] if pages else []
+            frames = [
+                page[row].tick() if row < len(page) else self._blank
+                for row in range(self.rows)
+            ]
+
+            # Glyphs on screen keep their CGRAM slots
+            self.glyphs.pin(
+                cell for frame in frames for cell in frame if isinstance(cell, bytes)
+            )
 
-            if lines_changed:
+            for (row, frame) in enumerate(frames):
                 try:
-                    self.clear()
+                    self._write_frame(row, frame)
                 except Exception as e:
                     raise TemporaryPeripheralError("failed to write to LCD") from e
 
-            for row in range(min(self.rows, len(lines))):
-                line = lines[row]
-
-                if line.len <= self.columns:
-                    # Line fits fully
-                    if not line.written:
-                        try:
-                            self.set_cursor_position(row, 0)
-                            self._write_str(line.str)
-                        except Exception as e:
-                            raise TemporaryPeripheralError(
-                                "failed to write to LCD"
-                            ) from e
-
-                        line.written = True
-                else:
-                    NUM_STATIC_TICKS = 10
-                    # We only require printing when the line is new or when we are scrolling.
-                    if line.staticTicks == 0 or line.staticTicks >= NUM_STATIC_TICKS:
-                        # Line does not fit, scroll it continuously
-
-                        # Get cursor position on screen, based on current index in the line
-                        cursor_position = max(self.columns - line.idx - 1, 0)
-
-                        # Get the length of the line we can print on
-                        line_length = self.columns - cursor_position
-
-                        # Get the text to display
-                        text = line.str[line.idx - (line_length - 1) : line.idx + 1]
-                        prepend_spaces = " " * cursor_position
-                        append_spaces = " " * (line_length - len(text))
-
-                        # Set the cursor position and display
-                        try:
-                            self.set_cursor_position(row, 0)
-                            self._write_str(prepend_spaces + text + append_spaces)
-                        except Exception as e:
-                            raise TemporaryPeripheralError(
-                                "failed to write to LCD"
-                            ) from e
-
-                        # Text is now empty, so we are at the end of the line. Reset back to start
-                        if len(text) == 0:
-                            line.idx = 0
-
-                    # Only scroll after the line has been displayed staticly for a while.
-                    if line.staticTicks >= NUM_STATIC_TICKS:
-                        line.idx += 1
-                    else:
-                        line.staticTicks += 1
-
-            sleep(0.3)
+            sleep(self.TICK_SECONDS)
 
     def _write_str(self, str):
         for char in str:
             self.write_char(ord(char))
 
+    def _write_frame(self, row: int, cells):
+        """
+        Show a row, writing only the span of characters that changed.
+        """
+        # Upload glyphs before positioning the cursor, as uploading moves the
+        # address counter into CGRAM
+        codes = [
+            self._glyph_code(cell) if isinstance(cell, bytes) else ord(cell)
+            for cell in cells
+        ]
+        screen = self._screen[row]
+        changed = [
+            column for column in range(self.columns) if codes[column] != screen[column]
+        ]
+        if not changed:
+            return
+
+        (first, last) = (changed[0], changed[-1])
+        with timeline.span(
+            "LCD.redraw", "display", row=row, characters=last - first + 1
+        ):
+            self.set_cursor_position(row, first)
+            for column in range(first, last + 1):
+                self.write_char(codes[column])
+                screen[column] = codes[column]
+
+    def _glyph_code(self, glyph: bytes) -> int:
+        try:
+            return self.glyphs.slot(glyph)
+        except ValueError:
+            # More glyphs on screen than CGRAM slots
+            return ord(lcd_glyphs.fallback(glyph))
+
+    def upload_glyph(self, slot: int, glyph: bytes):
+        """
+        Write a custom character into a CGRAM slot.
+
+        :param slot: The slot, 0-7, which is also the character code.
+        :param glyph: The rows of the character, see `lcd_glyphs`.
+        """
+        self.write_command(LCD_SET_CGRAM_ADDR | (slot << 3))
+        for row in glyph:
+            self.write_char(row & 0x1F)
+
     def _pulse_data(self, data: int):
         """
         Pulse the Enable flag to send data.
@@ -201,10 +299,12 @@ class LCD(Display):
         else:
             data |= LCD_BACKLIGHT_OFF
 
+        # The delays are enforced before the next transaction, rather than
+        # slept unconditionally
         self.i2c_device.write_byte(data | ENABLE)
-        sleep(0.0005)
+        self.i2c_device.defer(0.0005)
         self.i2c_device.write_byte(data & ~ENABLE)
-        sleep(0.0001)
+        self.i2c_device.defer(0.0001)
 
     def write_command(self, command: int):
         # Send first four bits
@@ -220,13 +320,15 @@ class LCD(Display):
 
     def clear(self):
         self.write_command(LCD_CLEAR_DISPLAY)
+        self.i2c_device.defer(LCD_CLEAR_HOME_TIME)
 
     def home(self):
         self.write_command(LCD_RETURN_HOME)
+        self.i2c_device.defer(LCD_CLEAR_HOME_TIME)
 
     def set_cursor_position(self, row=0, column=0):
-        row = min(row, len(LCD_ROW_OFFSETS))
-        self.write_command(LCD_SET_DDRAM_ADDR | (column + LCD_ROW_OFFSETS[row]))
+        row = min(row, len(self.row_offsets) - 1)
+        self.write_command(LCD_SET_DDRAM_ADDR | (column + self.row_offsets[row]))
 
     def turn_on(self):
         self.write_command(LCD_DISPLAY_CONTROL | LCD_DISPLAY_ON)
@@ -254,9 +356,49 @@ class LCD(Display):
 
 
 class LCDLine(object):
-    def __init__(self, str):
-        self.str = str
-        self.len = len(str)
-        self.idx = 15  # Scrolling lines are displayed fully left-aligned at the start.
-        self.staticTicks = 0
-        self.written = False
+    """
+    A line of characters and custom glyphs, with its display frames
+    precomputed for the width of the display.
+
+    A line that does not fit is shown left-aligned for `STATIC_TICKS` ticks,
+    then scrolls left continuously, re-entering from the right.
+    """
+
+    STATIC_TICKS = 10
+
+    def __init__(self, str, columns=16):
+        # Characters and custom glyphs
+        self.cells = list(str)
+        self.len = len(self.cells)
+
+        if self.len <= columns:
+            self.frames = [self.cells + [" "] * (columns - self.len)]
+            self.start = 0
+        else:
+            # Frame i shows the cells up to and including cell i at the right
+            # edge, the first `columns - 1` frames enter from the right
+            self.frames = []
+            for idx in range(self.len + columns - 1):
+                cursor_position = max(columns - idx - 1, 0)
+                text = self.cells[max(idx - columns + 1, 0) : idx + 1]
+                frame = [" "] * cursor_position + text
+                self.frames.append(frame + [" "] * (columns - len(frame)))
+            # Fully left-aligned
+            self.start = columns - 1
+        self.rewind()
+
+    def rewind(self):
+        self.frame = self.start
+        self.static_ticks = 0
+
+    def tick(self) -> list:
+        """
+        Get the frame to show, and advance.
+        """
+        frame = self.frames[self.frame]
+        if len(self.frames) > 1:
+            if self.static_ticks < self.STATIC_TICKS:
+                self.static_ticks += 1
+            else:
+                self.frame = (self.frame + 1) % len(self.frames)
+        return frame
@@ -0,0 +1,167 @@
+"""
+Custom 5x8 glyphs for character LCDs, e.g. for bar gauges and sparklines.
+
+An HD44780 has 8 CGRAM slots for custom characters. `GlyphCache` assigns
+glyphs to slots on demand, evicting the least recently used glyph that is
+not on screen, such that a glyph is only uploaded again after it was
+evicted.
+
+Glyphs are 8 bytes, one per row from top to bottom, using the lower 5 bits of
+each byte. Lines of cells combine characters and glyphs, see
+`LCD.display_cells`. At most 8 distinct glyphs fit on screen at once, e.g. a
+sparkline of 7 characters and a bar gauge:
+
+    lcd.display_cells([
+        list("CO2 ") + lcd_glyphs.sparkline(history, 7),
+        list("Hum ") + lcd_glyphs.bar(0.35, 12),
+    ])
+
+Glyphs beyond that are shown as the closest character of the character ROM,
+see `fallback`.
+"""
+
+from collections import OrderedDict
+
+SLOTS = 8
+ROWS = 8
+COLUMNS = 5
+
+# The full block character of the HD44780 character ROM.
+FULL_BLOCK = chr(0xFF)
+
+
+def horizontal_bar(columns: int) -> bytes:
+    """
+    A glyph with the given number of columns filled, from the left.
+    """
+    row = (0x1F << (COLUMNS - columns)) & 0x1F
+    return bytes([row] * ROWS)
+
+
+def vertical_bar(rows: int) -> bytes:
+    """
+    A glyph with the given number of rows filled, from the bottom.
+    """
+    return bytes([0x00] * (ROWS - rows) + [0x1F] * rows)
+
+
+def bar(fraction: float, width: int) -> list:
+    """
+    Cells of a horizontal bar gauge, using at most one glyph.
+
+    :param fraction: The filled fraction of the gauge, between 0 and 1.
+    :param width: The width of the gauge, in characters.
+    """
+    fraction = min(max(fraction, 0.0), 1.0)
+    filled = round(fraction * width * COLUMNS)
+    (full, partial) = divmod(filled, COLUMNS)
+
+    cells = [FULL_BLOCK] * full
+    if partial:
+        cells.append(horizontal_bar(partial))
+    return cells + [" "] * (width - len(cells))
+
+
+def sparkline(values, width: int, minimum=None, maximum=None) -> list:
+    """
+    Cells of a sparkline of the latest values, one pixel column per value,
+    using one glyph per character.
+
+    :param width: The width of the sparkline, in characters.
+    :param minimum: The value at the bottom, defaults to the minimum value.
+    :param maximum: The value at the top, defaults to the maximum value.
+    """
+    values = list(values)[-width * COLUMNS :]
+    if not values:
+        return [" "] * width
+    if minimum is None:
+        minimum = min(values)
+    if maximum is None:
+        maximum = max(values)
+    span = (maximum - minimum) or 1.0
+
+    # Pixel heights, right-aligned such that the latest value is rightmost.
+    heights = [0] * (width * COLUMNS - len(values))
+    for value in values:
+        level = (min(max(value, minimum), maximum) - minimum) / span
+        heights.append(1 + round(level * (ROWS - 1)))
+
+    cells = []
+    for character in range(width):
+        rows = bytearray(ROWS)
+        for column in range(COLUMNS):
+            height = heights[character * COLUMNS + column]
+            bit = 1 << (COLUMNS - 1 - column)
+            for row in range(ROWS - height, ROWS):
+                rows[row] |= bit
+        cells.append(bytes(rows))
+    return cells
+
+
+def fallback(glyph: bytes) -> str:
+    """
+    The character of the character ROM closest to a glyph: a full block if at
+    least half of its pixels are set, otherwise a space.
+    """
+    pixels = sum(bin(row & 0x1F).count("1") for row in glyph)
+    return FULL_BLOCK if 2 * pixels >= ROWS * COLUMNS else " "
+
+
+class GlyphCache(object):
+    """
+    Assigns glyphs to CGRAM slots, with least recently used eviction.
+
+    :param upload: A function uploading a glyph into a slot, called as
+    `upload(slot, glyph)`.
+    """
+
+    def __init__(self, upload):
+        self._upload = upload
+        # Slots per glyph, least recently used first.
+        self._slots = OrderedDict()
+        # Glyphs that are on screen, and may not be evicted.
+        self._pinned = frozenset()
+
+        self.hits = 0
+        self.uploads = 0
+
+    def pin(self, glyphs):
+        """
+        Set the glyphs that are on screen. Their slots are not reused until
+        they are no longer pinned.
+        """
+        self._pinned = frozenset(glyphs)
+
+    def slot(self, glyph: bytes) -> int:
+        """
+        Get the character code of a glyph, uploading it if needed.
+
+        :raises ValueError: If all slots hold pinned glyphs.
+        """
+        slot = self._slots.get(glyph)
+        if slot is not None:
+            self._slots.move_to_end(glyph)
+            self.hits += 1
+            return slot
+
+        if len(self._slots) < SLOTS:
+            slot = len(self._slots)
+        else:
+            evicted = next(
+                (cached for cached in self._slots if cached not in self._pinned), None
+            )
+            if evicted is None:
+                raise ValueError(f"more than {SLOTS} custom glyphs on screen")
+            slot = self._slots.pop(evicted)
+
+        self._upload(slot, glyph)
+        self.uploads += 1
+        self._slots[glyph] = slot
+        return slot
+
+    def clear(self):
+        """
+        Forget the uploaded glyphs, e.g. after the display was reset.
+        """
+        self._slots.clear()
+        self._pinned = frozenset()
@@ -1,8 +1,13 @@
-import pigpio
 from astroplant_kit.peripheral import Actuator
 
+from . import hardware, metrics
+from .pwm import DEFAULT_HARDWARE_PWM_FREQUENCY, PwmOutputs, PwmRamps
 
+
+@metrics.instrument
 class LedPanel(Actuator):
+    RUNNABLE = True
+
     def __init__(self, *args, configuration):
         super().__init__(*args)
 
@@ -10,18 +15,33 @@ class LedPanel(Actuator):
         self._red_pin = configuration["gpioAddressRed"]
         self._far_red_pin = configuration["gpioAddressFarRed"]
 
-        self.pi = pigpio.pi()
-        self.pi.set_PWM_range(self._blue_pin, 100)
-        self.pi.set_PWM_range(self._red_pin, 100)
-        self.pi.set_PWM_range(self._far_red_pin, 100)
+        self.pi = hardware.pigpio(configuration).pi()
+        self.outputs = PwmOutputs(
+            self.pi,
+            [self._blue_pin, self._red_pin, self._far_red_pin],
+            hardware_pwm=configuration.get("hardwarePwm", False),
+            frequency=configuration.get("pwmFrequency", DEFAULT_HARDWARE_PWM_FREQUENCY),
+        )
+        self.ramps = PwmRamps(self.outputs)
+
+    async def run(self):
+        await self.ramps.run()
 
     async def clean_up(self):
+        self.outputs.stop()
         self.pi.stop()
 
     async def do(self, command):
+        # All channels are changed together, so colours do not tear
+        duty_cycles = {}
         if "blue" in command:
-            self.pi.set_PWM_dutycycle(self._blue_pin, command["blue"])
+            duty_cycles[self._blue_pin] = command["blue"]
         if "red" in command:
-            self.pi.set_PWM_dutycycle(self._red_pin, command["red"])
+            duty_cycles[self._red_pin] = command["red"]
         if "farRed" in command:
-            self.pi.set_PWM_dutycycle(self._far_red_pin, command["farRed"])
+            duty_cycles[self._far_red_pin] = command["farRed"]
+        await self.ramps.set(
+            duty_cycles,
+            ramp_seconds=command.get("rampSeconds", 0),
+            curve=command.get("curve", "linear"),
+        )
@@ -0,0 +1,411 @@
+"""
+Instrumentation of the peripheral drivers.
+
+Drivers are instrumented with the `instrument` class decorator, recording the
+latency and result (success, temporary error, fatal error) of `set_up`,
+`measure`, `do` and `clean_up`. I2C devices record transactions, bytes and
+the time the bus is held; work offloaded to threads through `run_sync`
+records its duration; drivers record the duration of their stages with
+`stage`.
+
+Metrics are recorded only when enabled, by calling `enable` or setting the
+ASTROPLANT_METRICS environment variable. When disabled, instrumented calls
+cost a flag check. The same wrapper also detects event loop stalls in debug
+mode, see `blocking`. The recorded metrics can be queried as a dict with
+`snapshot`, or in the Prometheus text exposition format with `prometheus`.
+"""
+
+import bisect
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import trio
+
+from . import blocking, timeline
+
+ENV = "ASTROPLANT_METRICS"
+
+# Upper bounds of histogram buckets, in seconds.
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# The peripheral methods wrapped by `instrument`.
+INSTRUMENTED_METHODS = ("set_up", "measure", "do", "clean_up")
+
+_enabled = os.environ.get(ENV, "") not in ("", "0")
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def sample(self):
+        return {"value": self.value}
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # Non-cumulative counts per bucket; the last is the +Inf bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+
+    def sample(self):
+        with self._lock:
+            counts = list(self.counts)
+            (count, total) = (self.count, self.sum)
+
+        cumulative = {}
+        running = 0
+        for (bound, bucket_count) in zip(self.buckets + (float("inf"),), counts):
+            running += bucket_count
+            cumulative[_format_value(bound)] = running
+        return {"count": count, "sum": total, "buckets": cumulative}
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels, extra=()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for (key, value) in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for (key, value) in escaped) + "}"
+
+
+class Registry(object):
+    """
+    A collection of metrics, each identified by name and labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Per name: (type, help, {labels: metric}).
+        self._metrics = {}
+        self._collectors = []
+
+    def _get(self, kind, factory, name, help, labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = (kind, help, {})
+            (existing_kind, _, metrics) = self._metrics[name]
+            if existing_kind != kind:
+                raise ValueError(f"metric {name} is a {existing_kind}")
+            if key not in metrics:
+                metrics[key] = factory()
+            return metrics[key]
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        return self._get("counter", Counter, name, help, labels)
+
+    def histogram(
+        self, name: str, help: str, buckets=DEFAULT_BUCKETS, **labels
+    ) -> Histogram:
+        return self._get(
+            "histogram", functools.partial(Histogram, buckets), name, help, labels
+        )
+
+    def add_collector(self, collector):
+        """
+        Add a function reporting gauges when metrics are queried, as an
+        iterable of (name, help, labels, value) tuples.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def _families(self):
+        with self._lock:
+            families = {
+                name: (kind, help, list(metrics.items()))
+                for (name, (kind, help, metrics)) in self._metrics.items()
+            }
+            collectors = list(self._collectors)
+
+        for collector in collectors:
+            for (name, help, labels, value) in collector():
+                gauge = Counter()
+                gauge.value = value
+                family = families.setdefault(name, ("gauge", help, []))
+                family[2].append((tuple(sorted(labels.items())), gauge))
+        return families
+
+    def snapshot(self) -> dict:
+        """
+        Get the current values of all metrics, per name a list of samples
+        with their labels.
+        """
+        return {
+            name: [
+                dict(labels=dict(key), **metric.sample()) for (key, metric) in samples
+            ]
+            for (name, (kind, help, samples)) in self._families().items()
+        }
+
+    def prometheus(self) -> str:
+        """
+        Format all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for (name, (kind, help, samples)) in sorted(self._families().items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (labels, metric) in samples:
+                sample = metric.sample()
+                if kind == "histogram":
+                    for (bound, count) in sample["buckets"].items():
+                        bucket_labels = _format_labels(labels, [("le", bound)])
+                        lines.append(f"{name}_bucket{bucket_labels} {count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {sample['sum']}")
+                    lines.append(
+                        f"{name}_count{_format_labels(labels)} {sample['count']}"
+                    )
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {sample['value']}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, **labels) -> Counter:
+    return REGISTRY.counter(name, help, **labels)
+
+
+def histogram(name: str, help: str, buckets=DEFAULT_BUCKETS, **labels) -> Histogram:
+    return REGISTRY.histogram(name, help, buckets, **labels)
+
+
+def add_collector(collector):
+    REGISTRY.add_collector(collector)
+
+
+def remove_collector(collector):
+    REGISTRY.remove_collector(collector)
+
+
+def snapshot() -> dict:
+    return REGISTRY.snapshot()
+
+
+def prometheus() -> str:
+    return REGISTRY.prometheus()
+
+
+def reset():
+    REGISTRY.reset()
+
+
+def _result(exception) -> str:
+    from astroplant_kit.peripheral import FatalPeripheralError, TemporaryPeripheralError
+
+    if exception is None:
+        return "success"
+    if isinstance(exception, TemporaryPeripheralError):
+        return "temporary_error"
+    if isinstance(exception, FatalPeripheralError):
+        return "fatal_error"
+    return "error"
+
+
+def peripheral_labels(peripheral) -> dict:
+    return {
+        "driver": type(peripheral).__name__,
+        "peripheral": getattr(peripheral, "name", ""),
+    }
+
+
+def _record_call(peripheral, method: str, duration: float, exception):
+    labels = peripheral_labels(peripheral)
+    histogram(
+        "astroplant_peripheral_call_seconds",
+        "Duration of peripheral driver calls.",
+        method=method,
+        **labels,
+    ).observe(duration)
+    counter(
+        "astroplant_peripheral_calls_total",
+        "Peripheral driver calls, by result.",
+        method=method,
+        result=_result(exception),
+        **labels,
+    ).inc()
+
+
+def _instrument_method(name, fn):
+    @functools.wraps(fn)
+    async def wrapper(self, *args, **kwargs):
+        if not _enabled and not blocking.enabled() and not timeline.enabled():
+            return await fn(self, *args, **kwargs)
+
+        label = f"{type(self).__name__}.{name}"
+        call = fn(self, *args, **kwargs)
+        if blocking.enabled():
+            call = blocking.monitor(call, label)
+
+        with timeline.span(label, "driver"):
+            if not _enabled:
+                return await call
+
+            start = time.perf_counter()
+            try:
+                result = await call
+            except Exception as e:
+                _record_call(self, name, time.perf_counter() - start, e)
+                raise
+            _record_call(self, name, time.perf_counter() - start, None)
+            return result
+
+    return wrapper
+
+
+def instrument(cls):
+    """
+    Class decorator instrumenting the `INSTRUMENTED_METHODS` a peripheral
+    driver defines, for metrics and detection of event loop stalls.
+    """
+    for name in INSTRUMENTED_METHODS:
+        if name in cls.__dict__:
+            setattr(cls, name, _instrument_method(name, cls.__dict__[name]))
+    return cls
+
+
+@contextmanager
+def stage(driver: str, name: str):
+    """
+    Record the duration of a stage of a driver's work.
+    """
+    if not _enabled:
+        with timeline.span(f"{driver} {name}", "stage"):
+            yield
+        return
+
+    start = time.perf_counter()
+    try:
+        with timeline.span(f"{driver} {name}", "stage"):
+            yield
+    finally:
+        histogram(
+            "astroplant_stage_seconds",
+            "Duration of stages of peripheral driver work.",
+            driver=driver,
+            stage=name,
+        ).observe(time.perf_counter() - start)
+
+
+async def run_sync(fn, *args, limiter=None):
+    """
+    Run a blocking function in a worker thread, like `trio.to_thread.run_sync`,
+    recording the time spent in the thread and waiting for it.
+    """
+    if not _enabled and not timeline.enabled():
+        return await trio.to_thread.run_sync(fn, *args, limiter=limiter)
+
+    function = getattr(fn, "__qualname__", repr(fn))
+    queued = time.perf_counter()
+    started = None
+
+    def _run():
+        nonlocal started
+        started = time.perf_counter()
+        with timeline.span(function, "thread"):
+            return fn(*args)
+
+    if not _enabled:
+        return await trio.to_thread.run_sync(_run, limiter=limiter)
+
+    try:
+        return await trio.to_thread.run_sync(_run, limiter=limiter)
+    finally:
+        end = time.perf_counter()
+        if started is not None:
+            histogram(
+                "astroplant_thread_wait_seconds",
+                "Time offloaded work waited for a worker thread.",
+                function=function,
+            ).observe(started - queued)
+            histogram(
+                "astroplant_thread_run_seconds",
+                "Time offloaded work ran in a worker thread.",
+                function=function,
+            ).observe(end - started)
+
+
+def record_i2c(bus: int, address: int, size: int, held: float, failed: bool):
+    """
+    Record an I2C transaction.
+
+    :param size: The number of bytes transferred, excluding addressing.
+    :param held: The time the bus was held, in seconds.
+    """
+    labels = {"bus": bus, "address": f"{address:#04x}"}
+    counter(
+        "astroplant_i2c_transactions_total",
+        "I2C transactions, by result.",
+        result="error" if failed else "success",
+        **labels,
+    ).inc()
+    counter("astroplant_i2c_bytes_total", "Bytes transferred over I2C.", **labels).inc(
+        size
+    )
+    histogram(
+        "astroplant_i2c_bus_seconds",
+        "Time the bus was held per I2C transaction.",
+        **labels,
+    ).observe(held)
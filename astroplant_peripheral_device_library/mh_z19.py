@@ -1,21 +1,165 @@
 # http://eleparts.co.kr/data/design/product_file/SENSOR/gas/MH-Z19_CO2%20Manual%20V2.pdf
 # http://qiita.com/UedaTakeyuki/items/c5226960a7328155635f
-import serial
-from astroplant_kit.peripheral import Sensor, TemporaryPeripheralError
+from collections import namedtuple
 
+from astroplant_kit.peripheral import (
+    FatalPeripheralError,
+    Sensor,
+    TemporaryPeripheralError,
+)
 
-class MhZ19(Sensor):
+from . import hardware, metrics, workers
+from .sampling import SampledSensor
+
+FRAME_LENGTH = 9
+START_BYTE = 0xFF
+SENSOR_NUMBER = 0x01
+
+## Commands
+CMD_READ_CONCENTRATION = 0x86
+CMD_ZERO_POINT_CALIBRATION = 0x87
+CMD_SPAN_POINT_CALIBRATION = 0x88
+CMD_SELF_CALIBRATION = 0x79
+CMD_DETECTION_RANGE = 0x99
+
+## Self calibration (ABC) flags
+SELF_CALIBRATION_ON = 0xA0
+SELF_CALIBRATION_OFF = 0x00
+
+# Commands the sensor is known to answer; used to recognize frame starts.
+RESPONSE_COMMANDS = frozenset(
+    [
+        CMD_READ_CONCENTRATION,
+        CMD_ZERO_POINT_CALIBRATION,
+        CMD_SPAN_POINT_CALIBRATION,
+        CMD_SELF_CALIBRATION,
+        CMD_DETECTION_RANGE,
+    ]
+)
+
+Frame = namedtuple("Frame", ["command", "payload"])
+
+# `temperature` and `status` are undocumented fields of the concentration
+# response. The temperature is rough (whole degrees, sensor-internal).
+Reading = namedtuple("Reading", ["co2_concentration", "temperature", "status"])
+
+
+def checksum(data) -> int:
+    """
+    Calculate the checksum of a frame.
+
+    :param data: The frame, including the start byte. The checksum byte itself
+    (if present) is ignored.
+    """
+    return (0xFF - (sum(data[1:8]) & 0xFF) + 1) & 0xFF
+
+
+def encode_command(command: int, payload=(0, 0, 0, 0, 0)) -> bytes:
+    """
+    Encode a command frame to send to the sensor.
+
+    :param command: The command byte.
+    :param payload: The five data bytes following the command byte.
+    """
+    frame = bytearray([START_BYTE, SENSOR_NUMBER, command, *payload, 0])
+    frame[8] = checksum(frame)
+    return bytes(frame)
+
+
+def decode_reading(frame: Frame) -> Reading:
+    """
+    Decode a concentration response frame.
+    """
+    payload = frame.payload
+    return Reading(
+        co2_concentration=payload[0] * 256 + payload[1],
+        temperature=payload[2] - 40,
+        status=payload[3],
+    )
+
+
+class FrameParser(object):
+    """
+    Incremental parser for the response frames of the sensor.
+
+    Bytes are fed in as they are read from the serial port, in chunks of any
+    size. Complete frames with a valid checksum are returned; anything else
+    (line noise, partial frames after a dropped byte, corrupted frames) is
+    discarded by resynchronizing on the next frame start.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.discarded = 0
+
+    def feed(self, data) -> list:
+        """
+        Feed received bytes into the parser.
+
+        :param data: The received bytes.
+        :return: A list of `Frame`s completed by these bytes.
+        """
+        self._buffer += data
+        frames = []
+
+        while True:
+            start = self._find_start()
+            if start < 0:
+                # Keep a trailing start byte, as its command byte may still arrive
+                keep = 1 if self._buffer[-1:] == bytes([START_BYTE]) else 0
+                self._discard(len(self._buffer) - keep)
+                break
+
+            self._discard(start)
+            if len(self._buffer) < FRAME_LENGTH:
+                break
+
+            frame = self._buffer[:FRAME_LENGTH]
+            if frame[8] == checksum(frame):
+                frames.append(Frame(command=frame[1], payload=bytes(frame[2:8])))
+                del self._buffer[:FRAME_LENGTH]
+            else:
+                # Not a real frame start, resynchronize from the next byte
+                self._discard(1)
+
+        return frames
+
+    def _find_start(self) -> int:
+        idx = self._buffer.find(START_BYTE)
+        while idx >= 0:
+            if (
+                idx + 1 >= len(self._buffer)
+                or self._buffer[idx + 1] in RESPONSE_COMMANDS
+            ):
+                return idx
+            idx = self._buffer.find(START_BYTE, idx + 1)
+        return -1
+
+    def _discard(self, count: int):
+        if count > 0:
+            del self._buffer[:count]
+            self.discarded += count
+
+
+@metrics.instrument
+class MhZ19(SampledSensor, Sensor):
     def __init__(self, *args, configuration):
         super().__init__(*args)
 
         self.measurement_interval = configuration["intervals"]["measurementInterval"]
         self.aggregate_interval = configuration["intervals"]["aggregateInterval"]
+        self.set_up_sampling(configuration)
+
+        self.detection_range = configuration.get("detectionRange")
+        self.self_calibration = configuration.get("selfCalibration")
+        self.measure_temperature = configuration.get("measureTemperature", False)
 
         file_name = (
             configuration["serialFile"]
             if "serialFile" in configuration
             else "/dev/ttyS0"
         )
+        serial = hardware.serial(configuration)
         self.serial = serial.Serial(
             file_name,
             baudrate=9600,
@@ -25,23 +169,106 @@ class MhZ19(Sensor):
             timeout=1.0,
         )
 
-    async def measure(self):
-        command = "\xff\x01\x86\x00\x00\x00\x00\x00\x79"
+        self.parser = FrameParser()
+        # The number of concentration requests sent, but not yet answered.
+        self._pending_requests = 0
+
+        self.reading = None
 
+    async def set_up(self):
         try:
-            self.serial.write(bytes(command, "latin1"))
+            if self.detection_range is not None:
+                self.set_detection_range(self.detection_range)
+            if self.self_calibration is not None:
+                self.set_self_calibration(self.self_calibration)
+        except Exception as e:
+            raise FatalPeripheralError("could not configure sensor (MH-Z19)") from e
+
+    async def clean_up(self):
+        self.serial.close()
+
+    @property
+    def temperature(self):
+        """Return the temperature of the last reading."""
+        return self.reading.temperature if self.reading is not None else None
+
+    @property
+    def status(self):
+        """Return the status byte of the last reading."""
+        return self.reading.status if self.reading is not None else None
+
+    def _send(self, command: int, payload=(0, 0, 0, 0, 0)):
+        self.serial.write(encode_command(command, payload))
+
+    def set_detection_range(self, ppm: int):
+        """
+        Set the detection range of the sensor (e.g. 2000 or 5000 ppm).
+        """
+        self._send(CMD_DETECTION_RANGE, (0, 0, 0, (ppm >> 8) & 0xFF, ppm & 0xFF))
+
+    def set_self_calibration(self, enabled: bool):
+        """
+        Turn automatic baseline correction (ABC) on or off.
+        """
+        flag = SELF_CALIBRATION_ON if enabled else SELF_CALIBRATION_OFF
+        self._send(CMD_SELF_CALIBRATION, (flag, 0, 0, 0, 0))
+
+    def calibrate_zero_point(self):
+        """
+        Calibrate the current concentration as 400 ppm. The sensor must have
+        been in fresh air for at least 20 minutes.
+        """
+        self._send(CMD_ZERO_POINT_CALIBRATION)
+
+    def request_reading(self):
+        """
+        Request a concentration reading. Multiple requests may be in flight;
+        their responses are picked up by `read_responses`.
+        """
+        self._send(CMD_READ_CONCENTRATION)
+        self._pending_requests += 1
+
+    def read_responses(self):
+        """
+        Read responses until all pending concentration requests are answered,
+        or until the serial port times out.
+
+        :return: The most recent reading received, or None.
+        """
+        reading = None
+        while self._pending_requests > 0:
+            data = self.serial.read(max(FRAME_LENGTH, self.serial.in_waiting))
+            if not data:
+                # Timed out; any outstanding responses are lost.
+                self._pending_requests = 0
+                break
+
+            for frame in self.parser.feed(data):
+                if frame.command == CMD_READ_CONCENTRATION:
+                    self._pending_requests = max(self._pending_requests - 1, 0)
+                    reading = decode_reading(frame)
+
+        if reading is not None:
+            self.reading = reading
+        return reading
+
+    async def sample(self):
+        try:
+            self.request_reading()
         except Exception as e:
             raise TemporaryPeripheralError("could not write to sensor") from e
 
         try:
-            s = self.serial.read(9)
-            s = s.decode("latin1")
-            co2_concentration = ord(s[2]) * 256 + ord(s[3])
+            # Reading blocks until the sensor responds, or the port times out
+            reading = await workers.run_sync(self.read_responses, group="MhZ19")
         except Exception as e:
             raise TemporaryPeripheralError("could not read from sensor") from e
 
-        measurement = self.create_raw_measurement(
-            "Concentration", "Parts per million", co2_concentration
-        )
+        if reading is None:
+            raise TemporaryPeripheralError("sensor did not respond (MH-Z19)")
+
+        samples = [("Concentration", "Parts per million", reading.co2_concentration)]
+        if self.measure_temperature:
+            samples.append(("Temperature", "Degrees Celsius", reading.temperature))
 
-        return measurement
+        return samples
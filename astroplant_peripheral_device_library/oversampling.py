@@ -0,0 +1,229 @@
+"""
+Software oversampling of sensors, with robust rejection of outliers.
+
+A sensor configured with an "oversampling" object takes several samples per
+measurement, filters outliers per channel, and measures the mean of the
+remaining samples:
+
+    "oversampling": {
+        "samples": 5,
+        "spacing": 0.1,
+        "filter": "mad",
+        "threshold": 3.0
+    }
+
+Samples are started on a fixed schedule, `spacing` seconds apart, rather than
+`spacing` seconds after the previous sample completed, such that conversion
+waits count towards the spacing instead of adding to it. Sensors whose
+samples may overlap can run more than one at a time with "concurrency".
+Sensors implementing `trigger_sample` and `read_sample` (see `groups`) are
+sampled through them, and overlap their samples by default. Only their
+conversions are taken one at a time, as a new trigger would restart the
+conversion in flight: the next sample is triggered as soon as the previous
+result has been read and its start time has come.
+
+Each measured value comes with the number of samples taken for it and the
+number rejected (left out or replaced) by the filter.
+
+Filters:
+
+- "mad": reject samples further than `threshold` scaled median absolute
+  deviations from the median;
+- "hampel": replace samples further than `threshold` scaled median absolute
+  deviations from the median of their neighbours (`window` samples on either
+  side) by that median;
+- "none": keep all samples.
+"""
+
+import statistics
+from collections import namedtuple
+
+import trio
+from astroplant_kit.peripheral import TemporaryPeripheralError
+
+from . import metrics
+
+# Scales the median absolute deviation to the standard deviation, for normally
+# distributed samples.
+MAD_SCALE = 1.4826
+
+Oversampled = namedtuple(
+    "Oversampled",
+    ["physical_quantity", "physical_unit", "value", "samples", "rejected"],
+)
+
+
+def _median_absolute_deviation(values, median):
+    return statistics.median([abs(value - median) for value in values])
+
+
+def reject_outliers(values, threshold=3.0) -> list:
+    """
+    Reject the values further than `threshold` scaled median absolute
+    deviations from the median. If no value is that close, e.g. with a small
+    threshold, the median is kept.
+    """
+    median = statistics.median(values)
+    limit = threshold * MAD_SCALE * _median_absolute_deviation(values, median)
+    kept = [value for value in values if abs(value - median) <= limit]
+    return kept or [median]
+
+
+def hampel(values, window=2, threshold=3.0) -> list:
+    """
+    Replace the values further than `threshold` scaled median absolute
+    deviations from the median of the `window` values on either side by that
+    median.
+    """
+    filtered = []
+    for (index, value) in enumerate(values):
+        neighbourhood = values[max(index - window, 0) : index + window + 1]
+        median = statistics.median(neighbourhood)
+        limit = (
+            threshold * MAD_SCALE * _median_absolute_deviation(neighbourhood, median)
+        )
+        filtered.append(value if abs(value - median) <= limit else median)
+    return filtered
+
+
+FILTERS = {
+    "mad": lambda values, options: reject_outliers(
+        values, options.get("threshold", 3.0)
+    ),
+    "hampel": lambda values, options: hampel(
+        values, options.get("window", 2), options.get("threshold", 3.0)
+    ),
+    "none": lambda values, options: values,
+}
+
+
+def _rejected(values, filtered) -> int:
+    """
+    The number of values left out or replaced by a filter.
+    """
+    if len(filtered) != len(values):
+        return len(values) - len(filtered)
+    return sum(1 for (value, kept) in zip(values, filtered) if value != kept)
+
+
+def _triggered(peripheral) -> bool:
+    return hasattr(peripheral, "trigger_sample") and hasattr(peripheral, "read_sample")
+
+
+class Oversampling(object):
+    """
+    Oversampling of a sensor, configured by the "oversampling" configuration
+    option. Without it, every measurement takes a single sample.
+
+    The numbers of samples taken and kept per channel are recorded as
+    metrics.
+
+    :param peripheral: The sensor, used in metrics, and sampled through its
+    `trigger_sample` and `read_sample` if it implements them.
+    """
+
+    def __init__(self, configuration, peripheral=None):
+        self.labels = metrics.peripheral_labels(peripheral)
+        self.options = configuration.get("oversampling", {})
+        self.samples = self.options.get("samples", 1)
+        self.spacing = self.options.get("spacing", 0.0)
+
+        filter_name = self.options.get("filter", "mad")
+        if filter_name not in FILTERS:
+            raise ValueError(f"unknown oversampling filter: {filter_name}")
+        self._filter = FILTERS[filter_name]
+
+        self._triggered = peripheral if _triggered(peripheral) else None
+        concurrency = self.options.get(
+            "concurrency", self.samples if self._triggered else 1
+        )
+        self._limiter = trio.CapacityLimiter(max(concurrency, 1))
+        # Held from the trigger of a conversion until its result is read.
+        self._conversion = trio.StrictFIFOLock()
+
+        # The filtered values of the last measurement.
+        self.latest = []
+
+    async def sample(self, take_sample):
+        """
+        Take the configured number of samples, and filter them per channel.
+
+        Samples failing with a `TemporaryPeripheralError` are left out; if all
+        samples fail, the last error is raised.
+
+        :param take_sample: An async function returning a list of (physical
+        quantity, physical unit, value) tuples. Not used for sensors sampled
+        through `trigger_sample` and `read_sample`.
+        :return: A list of `Oversampled` tuples, with the filtered value and
+        the numbers of samples taken and rejected per channel.
+        """
+        if self._triggered:
+            take_sample = self._take_triggered
+        if self.samples <= 1:
+            return [
+                Oversampled(quantity, unit, value, 1, 0)
+                for (quantity, unit, value) in await take_sample()
+            ]
+
+        results = [None] * self.samples
+        errors = []
+        start = trio.current_time()
+
+        async def _sample(index):
+            await trio.sleep_until(start + index * self.spacing)
+            async with self._limiter:
+                try:
+                    results[index] = await take_sample()
+                except TemporaryPeripheralError as e:
+                    errors.append(e)
+
+        async with trio.open_nursery() as nursery:
+            for index in range(self.samples):
+                nursery.start_soon(_sample, index)
+
+        # Values per (physical quantity, physical unit), in sample order.
+        channels = {}
+        for result in results:
+            if result is None:
+                continue
+            for (quantity, unit, value) in result:
+                channels.setdefault((quantity, unit), []).append(value)
+
+        if not channels:
+            raise errors[-1]
+
+        self.latest = []
+        for ((quantity, unit), values) in channels.items():
+            filtered = self._filter(values, self.options)
+            self.latest.append(
+                Oversampled(
+                    quantity,
+                    unit,
+                    statistics.fmean(filtered),
+                    len(values),
+                    _rejected(values, filtered),
+                )
+            )
+        if metrics.enabled():
+            self._record_metrics()
+        return self.latest
+
+    async def _take_triggered(self):
+        async with self._conversion:
+            ready_at = await self._triggered.trigger_sample()
+            await trio.sleep_until(ready_at)
+            return await self._triggered.read_sample()
+
+    def _record_metrics(self):
+        for oversampled in self.latest:
+            labels = dict(self.labels, quantity=oversampled.physical_quantity)
+            metrics.counter(
+                "astroplant_oversampling_samples_total",
+                "Samples taken by oversampling sensors.",
+                **labels,
+            ).inc(oversampled.samples)
+            metrics.counter(
+                "astroplant_oversampling_samples_kept_total",
+                "Samples kept by the outlier filters of oversampling sensors.",
+                **labels,
+            ).inc(oversampled.samples - oversampled.rejected)
@@ -10,17 +10,20 @@ needed.
 
 import io
 import logging
-from typing import Iterable
+from typing import TYPE_CHECKING, Iterable
 
 import numpy as np
-import picamera2
 import schedule
 import trio
 from astroplant_kit.peripheral import Data, Peripheral, PeripheralCommandResult
 from PIL import Image
 
+from . import frame_archive, hardware, metrics, timeline, workers
 from .led_panel import LedPanel
 
+if TYPE_CHECKING:
+    import picamera2
+
 logger = logging.getLogger("astroplant_peripheral_device_library.pi_camera_v2")
 
 # requires:
@@ -49,7 +52,7 @@ def _find_led_panel(peripherals: Iterable[Peripheral]):
             return peripheral
 
 
-def _capture(camera: picamera2.Picamera2) -> bytes:
+def _capture(camera: "picamera2.Picamera2") -> bytes:
     """
     Capture an image to png.
     """
@@ -59,18 +62,25 @@ def _capture(camera: picamera2.Picamera2) -> bytes:
     return bytes_stream.read()
 
 
-async def _capture_uncontrolled(camera: picamera2.Picamera2) -> bytes:
+async def _set_lighting(led_panel_control, lighting, seconds) -> None:
+    with metrics.stage("PiCameraV2", "lighting"):
+        await led_panel_control(lighting)
+        await trio.sleep(seconds)
+
+
+async def _capture_uncontrolled(camera: "picamera2.Picamera2") -> bytes:
     await trio.sleep(2)
-    return await trio.to_thread.run_sync(_capture, camera)
+    with metrics.stage("PiCameraV2", "capture"):
+        return await workers.run_sync(_capture, camera, group="PiCameraV2")
 
 
-async def _capture_regular(camera: picamera2.Picamera2, led_panel_control) -> bytes:
-    await led_panel_control({"blue": 75, "red": 75, "farRed": 0})
-    await trio.sleep(4)
-    return await trio.to_thread.run_sync(_capture, camera)
+async def _capture_regular(camera: "picamera2.Picamera2", led_panel_control) -> bytes:
+    await _set_lighting(led_panel_control, {"blue": 75, "red": 75, "farRed": 0}, 4)
+    with metrics.stage("PiCameraV2", "capture"):
+        return await workers.run_sync(_capture, camera, group="PiCameraV2")
 
 
-def _capture_np_unencoded(camera: picamera2.Picamera2, resolution, format="rgb"):
+def _capture_np_unencoded(camera: "picamera2.Picamera2", resolution, format="rgb"):
     # Camera rounds up to nearest 32 horizontal pixels, and nearest 16 vertical.
     (x, y) = resolution
     x_orig = x
@@ -85,24 +95,66 @@ def _capture_np_unencoded(camera: picamera2.Picamera2, resolution, format="rgb")
     return buffer[:y_orig, :x_orig, :]
 
 
-async def _capture_nir(camera: picamera2.Picamera2, led_panel_control) -> bytes:
-    await led_panel_control({"blue": 0, "red": 0, "farRed": 75})
-    await trio.sleep(4)
-    nir_rgb = await trio.to_thread.run_sync(_capture_np_unencoded, camera, (1640, 1232))
+async def _archive(archive, frames: dict, command: str):
+    """
+    Archive the raw frames of a capture. Archiving failures are logged, rather
+    than failing the capture.
+    """
+    try:
+        with metrics.stage("PiCameraV2", "archive"):
+            await workers.run_sync(
+                archive.add_capture,
+                frames,
+                command,
+                group="PiCameraV2",
+                priority=workers.PRIORITY_LOW,
+            )
+    except Exception as e:
+        logger.warning(f"could not archive {command} capture: {e}")
 
-    im = Image.fromarray(nir_rgb[:, :, 0])
-    bytes_stream = io.BytesIO()
-    im.save(bytes_stream, format="png")
-    bytes_stream.seek(0)
-    return bytes_stream.read()
 
+async def _capture_nir(
+    camera: "picamera2.Picamera2", led_panel_control, frames=None
+) -> bytes:
+    """
+    :param frames: A dict to put the raw frames in, by kind, e.g. to archive
+    them.
+    """
+
+    def process(nir_rgb) -> bytes:
+        im = Image.fromarray(nir_rgb[:, :, 0])
+        bytes_stream = io.BytesIO()
+        im.save(bytes_stream, format="png")
+        bytes_stream.seek(0)
+        return bytes_stream.read()
+
+    await _set_lighting(led_panel_control, {"blue": 0, "red": 0, "farRed": 75}, 4)
+    with metrics.stage("PiCameraV2", "capture"):
+        nir_rgb = await workers.run_sync(
+            _capture_np_unencoded, camera, (1640, 1232), group="PiCameraV2"
+        )
+    if frames is not None:
+        frames["nir"] = nir_rgb
+
+    with metrics.stage("PiCameraV2", "process"):
+        return await workers.run_sync(
+            process, nir_rgb, group="PiCameraV2", priority=workers.PRIORITY_LOW
+        )
+
+
+async def _capture_ndvi(
+    camera: "picamera2.Picamera2", led_panel_control, frames=None
+) -> bytes:
+    """
+    :param frames: A dict to put the raw frames in, by kind, e.g. to archive
+    them.
+    """
 
-async def _capture_ndvi(camera: picamera2.Picamera2, led_panel_control) -> bytes:
     def process(red_rgb, nir_rgb) -> bytes:
-        red_r = (red_rgb[:, :, 0]).astype(np.float)
+        red_r = (red_rgb[:, :, 0]).astype(np.float64)
         del red_rgb
 
-        nir_r = (nir_rgb[:, :, 0]).astype(np.float)
+        nir_r = (nir_rgb[:, :, 0]).astype(np.float64)
         del nir_rgb
 
         ndvi = (nir_r - red_r) / (nir_r + red_r)
@@ -117,17 +169,28 @@ async def _capture_ndvi(camera: picamera2.Picamera2, led_panel_control) -> bytes
         bytes_stream.seek(0)
         return bytes_stream.read()
 
-    await led_panel_control({"blue": 0, "red": 75, "farRed": 0})
-    await trio.sleep(4)
-    red_rgb = await trio.to_thread.run_sync(_capture_np_unencoded, camera, (1640, 1232))
+    await _set_lighting(led_panel_control, {"blue": 0, "red": 75, "farRed": 0}, 4)
+    with metrics.stage("PiCameraV2", "capture"):
+        red_rgb = await workers.run_sync(
+            _capture_np_unencoded, camera, (1640, 1232), group="PiCameraV2"
+        )
 
-    await led_panel_control({"blue": 0, "red": 0, "farRed": 75})
-    await trio.sleep(4)
-    nir_rgb = await trio.to_thread.run_sync(_capture_np_unencoded, camera, (1640, 1232))
+    await _set_lighting(led_panel_control, {"blue": 0, "red": 0, "farRed": 75}, 4)
+    with metrics.stage("PiCameraV2", "capture"):
+        nir_rgb = await workers.run_sync(
+            _capture_np_unencoded, camera, (1640, 1232), group="PiCameraV2"
+        )
+    if frames is not None:
+        frames["red"] = red_rgb
+        frames["nir"] = nir_rgb
 
-    return await trio.to_thread.run_sync(process, red_rgb, nir_rgb)
+    with metrics.stage("PiCameraV2", "process"):
+        return await workers.run_sync(
+            process, red_rgb, nir_rgb, group="PiCameraV2", priority=workers.PRIORITY_LOW
+        )
 
 
+@metrics.instrument
 class PiCameraV2(Peripheral):
     COMMANDS = True
     RUNNABLE = True
@@ -138,7 +201,7 @@ class PiCameraV2(Peripheral):
         self._nursery = None
 
         if configuration["camera"] == "piCameraV2":
-            self.camera = picamera2.Picamera2()
+            self.camera = hardware.picamera2(configuration).Picamera2()
             config = self.camera.create_still_configuration(main={"size": (1640, 1232)})
             self.camera.configure(config)
         else:
@@ -146,6 +209,15 @@ class PiCameraV2(Peripheral):
 
         self.schedule = configuration["schedule"]
 
+        archive = configuration.get("frameArchive")
+        if archive is not None:
+            self.frame_archive = frame_archive.FrameArchive(
+                archive["directory"],
+                max_bytes=archive.get("maxBytes", frame_archive.DEFAULT_MAX_BYTES),
+            )
+        else:
+            self.frame_archive = None
+
     async def set_up(self):
         self.camera.start()
 
@@ -175,7 +247,8 @@ class PiCameraV2(Peripheral):
 
         # Block until nothing can call `do` anymore.
         async with self.manager.control(self):
-            return await self._handle_command(cmd)
+            with timeline.span("control PiCameraV2", "control"):
+                return await self._handle_command(cmd)
 
     async def _handle_command(self, command: Command):
         led_control_required = command in [Command.REGULAR, Command.NDVI, Command.NIR]
@@ -190,22 +263,26 @@ class PiCameraV2(Peripheral):
                 "Could not find controllable LED panel, but control was required for requested command."
             )
 
+        # Raw frames to archive, by kind
+        frames = {}
+
         if led_control_required:
             async with led_panel_control as control:
-                logger.debug("got LED panel control")
-                led_panel_control.reset_on_exit = True
-
-                if command is Command.REGULAR:
-                    result = await _capture_regular(self.camera, control)
-                    file_name = "regular.png"
-                elif command is Command.NIR:
-                    result = await _capture_nir(self.camera, control)
-                    file_name = "nir.png"
-                elif command is Command.NDVI:
-                    result = await _capture_ndvi(self.camera, control)
-                    file_name = "ndvi.png"
-
-                media = self.create_media(file_name, "image/png", result, None)
+                with timeline.span("control LedPanel", "control"):
+                    logger.debug("got LED panel control")
+                    led_panel_control.reset_on_exit = True
+
+                    if command is Command.REGULAR:
+                        result = await _capture_regular(self.camera, control)
+                        file_name = "regular.png"
+                    elif command is Command.NIR:
+                        result = await _capture_nir(self.camera, control, frames)
+                        file_name = "nir.png"
+                    elif command is Command.NDVI:
+                        result = await _capture_ndvi(self.camera, control, frames)
+                        file_name = "ndvi.png"
+
+                    media = self.create_media(file_name, "image/png", result, None)
         else:
             if command is Command.UNCONTROLLED:
                 result = await _capture_uncontrolled(self.camera)
@@ -213,8 +290,19 @@ class PiCameraV2(Peripheral):
 
             media = self.create_media(file_name, "image/png", result, None)
 
+        if frames and self.frame_archive is not None:
+            # Archive once the LED panel is released, in the background if
+            # running
+            if self._nursery is not None:
+                self._nursery.start_soon(
+                    _archive, self.frame_archive, frames, command.lower()
+                )
+            else:
+                await _archive(self.frame_archive, frames, command.lower())
+
         if media is not None:
-            await self._publish_data(Data(media))
+            with metrics.stage("PiCameraV2", "publish"):
+                await self._publish_data(Data(media))
             return media
 
     async def run(self):
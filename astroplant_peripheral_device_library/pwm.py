@@ -1,17 +1,368 @@
-import pigpio
+import logging
+import time
+
+import trio
 from astroplant_kit.peripheral import Actuator
 
+from . import hardware, metrics
+
+logger = logging.getLogger("astroplant_peripheral_device_library.pwm")
+
+# Pins that can be driven by the hardware PWM peripheral, with their PWM
+# channel. Pins sharing a channel always output the same duty cycle.
+HARDWARE_PWM_CHANNELS = {12: 0, 18: 0, 13: 1, 19: 1}
+HARDWARE_PWM_PINS = frozenset(HARDWARE_PWM_CHANNELS)
+HARDWARE_PWM_RANGE = 1000000
+DEFAULT_HARDWARE_PWM_FREQUENCY = 10000
+
+SOFTWARE_PWM_RANGE = 100
+
+# Sets up to five pins (p0, p2, ...) to duty cycles (p1, p3, ...) within one
+# pigpio transaction. Unused pairs repeat the last pair.
+BATCH_SCRIPT = "pwm p0 p1 pwm p2 p3 pwm p4 p5 pwm p6 p7 pwm p8 p9"
+BATCH_SCRIPT_PAIRS = 5
+
+# pigpio script statuses.
+PI_SCRIPT_INITING = 0
+PI_SCRIPT_HALTED = 1
+PI_SCRIPT_RUNNING = 2
+PI_SCRIPT_FAILED = 4
+
+# The maximum time to wait for a run of the batch script to finish.
+SCRIPT_RUN_TIMEOUT = 0.1
+
+
+class PwmOutputs(object):
+    """
+    A set of PWM output pins driven through one pigpio connection.
+
+    The last duty cycle written to each pin is cached, and writes that would
+    not change a pin are skipped. Updates changing multiple pins are applied
+    through a pigpio script, such that all pins change at the same time.
+
+    If hardware PWM is enabled, capable pins are driven by the hardware PWM
+    peripheral, at a higher frequency and resolution. These pins are written
+    individually. Of pins sharing a PWM channel, only the first is driven by
+    hardware; the others fall back to software PWM.
+    """
+
+    def __init__(
+        self, pi, pins, hardware_pwm=False, frequency=DEFAULT_HARDWARE_PWM_FREQUENCY
+    ):
+        self.pi = pi
+        self.pins = list(dict.fromkeys(pins))
+        self.frequency = frequency
+
+        self.hardware_pins = set()
+        if hardware_pwm:
+            self.hardware_pins = self._hardware_pins()
+        self.software_pins = [pin for pin in self.pins if pin not in self.hardware_pins]
+
+        # Duty cycle per pin, in the pin's range; None means unknown.
+        self._duty_cycles = {pin: None for pin in self.pins}
+
+        for pin in self.software_pins:
+            self.pi.set_PWM_range(pin, SOFTWARE_PWM_RANGE)
+
+        self._script = None
+        # Whether the script has been initialized by pigpio.
+        self._script_initialized = False
+        if len(self.software_pins) > 1:
+            try:
+                self._script = self.pi.store_script(BATCH_SCRIPT.encode("ascii"))
+            except Exception:
+                # Fall back to setting pins one by one
+                pass
+
+    def _hardware_pins(self):
+        pins = {}
+        for pin in self.pins:
+            if pin not in HARDWARE_PWM_CHANNELS:
+                continue
+            channel = HARDWARE_PWM_CHANNELS[pin]
+            if channel in pins:
+                logger.warning(
+                    f"pin {pin} shares PWM channel {channel} with pin "
+                    f"{pins[channel]}, falling back to software PWM"
+                )
+                continue
+            pins[channel] = pin
+        return set(pins.values())
+
+    def stop(self):
+        """
+        Release resources.
+        """
+        if self._script is not None:
+            try:
+                self.pi.delete_script(self._script)
+            except Exception:
+                pass
+            self._script = None
+
+    def _range(self, pin):
+        return HARDWARE_PWM_RANGE if pin in self.hardware_pins else SOFTWARE_PWM_RANGE
+
+    def quantize(self, pin, duty_cycle):
+        """
+        Convert a duty cycle (0-100) to the value written to the pin.
+        """
+        duty_cycle = min(max(duty_cycle, 0), 100)
+        return int(duty_cycle * self._range(pin) / 100)
+
+    def duty_cycle(self, pin):
+        """
+        Return the duty cycle (0-100) last written to a pin, or None if
+        unknown.
+        """
+        value = self._duty_cycles[pin]
+        if value is None:
+            return None
+        return value * 100 / self._range(pin)
+
+    def update(self, duty_cycles: dict):
+        """
+        Set the duty cycles of pins. Pins already at the requested duty cycle
+        are not written to.
+
+        :param duty_cycles: A dict mapping pins to duty cycles (0-100).
+        """
+        changed = {}
+        for (pin, duty_cycle) in duty_cycles.items():
+            value = self.quantize(pin, duty_cycle)
+            if self._duty_cycles[pin] != value:
+                changed[pin] = value
+
+        if not changed:
+            return
+
+        try:
+            software = {}
+            for (pin, value) in changed.items():
+                if pin in self.hardware_pins:
+                    self.pi.hardware_PWM(pin, self.frequency, value)
+                else:
+                    software[pin] = value
+
+            if len(software) > 1 and self._script_ready():
+                self._run_batch(software)
+            else:
+                for (pin, value) in software.items():
+                    self.pi.set_PWM_dutycycle(pin, value)
+        except Exception:
+            # The state of the pins is unknown, force them to be rewritten
+            for pin in changed:
+                self._duty_cycles[pin] = None
+            raise
+
+        self._duty_cycles.update(changed)
 
+    def _script_ready(self):
+        if self._script is None:
+            return False
+        if self._script_initialized:
+            return True
+
+        (status, _) = self.pi.script_status(self._script)
+        if status == PI_SCRIPT_FAILED:
+            # Fall back to setting pins one by one
+            self.stop()
+        elif status != PI_SCRIPT_INITING:
+            # Once initialized, the script stays ready: do not ask pigpio again
+            # on every update.
+            self._script_initialized = True
+        return self._script_initialized
+
+    def _wait_script(self):
+        """
+        Wait for the running batch script to halt, such that it can be run
+        again.
+        """
+        deadline = time.monotonic() + SCRIPT_RUN_TIMEOUT
+        while True:
+            (status, _) = self.pi.script_status(self._script)
+            if status != PI_SCRIPT_RUNNING:
+                return
+            if time.monotonic() > deadline:
+                raise TimeoutError("PWM batch script did not finish")
+
+    def _run_batch(self, changed: dict):
+        pairs = list(changed.items())
+        for idx in range(0, len(pairs), BATCH_SCRIPT_PAIRS):
+            if idx > 0:
+                # The script runs with one set of parameters at a time, the
+                # previous chunk has to be done first.
+                self._wait_script()
+            chunk = pairs[idx : idx + BATCH_SCRIPT_PAIRS]
+            chunk += [chunk[-1]] * (BATCH_SCRIPT_PAIRS - len(chunk))
+            self.pi.run_script(
+                self._script, [value for pair in chunk for value in pair]
+            )
+
+
+def _interpolate_linear(start, end, fraction):
+    return start + (end - start) * fraction
+
+
+def _interpolate_gamma(start, end, fraction, gamma=2.2):
+    # Interpolate perceived brightness, rather than the duty cycle.
+    start = (start / 100) ** (1 / gamma)
+    end = (end / 100) ** (1 / gamma)
+    return 100 * (start + (end - start) * fraction) ** gamma
+
+
+CURVES = {
+    "linear": _interpolate_linear,
+    "gamma": _interpolate_gamma,
+}
+
+# Minimum time between two steps of a ramp.
+RAMP_STEP_INTERVAL = 0.02
+
+
+def ramp_table(
+    outputs: PwmOutputs, start: dict, end: dict, seconds, curve="linear", transform=None
+):
+    """
+    Precompute the steps of a duty cycle ramp. Steps at which no pin would
+    change are left out.
+
+    :param outputs: The outputs the ramp is for.
+    :param start: A dict mapping pins to their duty cycles at the start.
+    :param end: A dict mapping pins to their duty cycles at the end.
+    :param seconds: The duration of the ramp.
+    :param curve: The name of the interpolation curve, see `CURVES`.
+    :param transform: A function mapping the interpolated values of every
+    step to duty cycles.
+    :return: A list of (time offset, duty cycles) tuples.
+    """
+    if curve not in CURVES:
+        raise ValueError(f"unknown ramp curve: {curve}")
+    interpolate = CURVES[curve]
+
+    num_steps = max(int(seconds / RAMP_STEP_INTERVAL), 1)
+    table = []
+    previous = None
+    for step in range(1, num_steps + 1):
+        fraction = step / num_steps
+        duty_cycles = {pin: interpolate(start[pin], end[pin], fraction) for pin in end}
+        if transform is not None:
+            duty_cycles = {
+                pin: transform(duty_cycle) for (pin, duty_cycle) in duty_cycles.items()
+            }
+        quantized = {
+            pin: outputs.quantize(pin, duty_cycle)
+            for (pin, duty_cycle) in duty_cycles.items()
+        }
+        if quantized != previous:
+            table.append((fraction * seconds, duty_cycles))
+            previous = quantized
+    return table
+
+
+class PwmRamps(object):
+    """
+    Sets duty cycles on PwmOutputs, optionally ramping towards them over time.
+
+    Ramps run as tasks in the nursery opened by `run`; if that is not running,
+    ramps are awaited directly. A new command for a pin takes over that pin
+    from any ramp still running on it.
+    """
+
+    def __init__(self, outputs: PwmOutputs):
+        self.outputs = outputs
+        self._nursery = None
+        # The command currently controlling each pin.
+        self._owners = {}
+
+    async def run(self):
+        async with trio.open_nursery() as nursery:
+            self._nursery = nursery
+            try:
+                await trio.sleep_forever()
+            finally:
+                self._nursery = None
+
+    async def set(
+        self, duty_cycles: dict, ramp_seconds=0, curve="linear", transform=None
+    ):
+        """
+        Set the duty cycles of pins.
+
+        :param duty_cycles: A dict mapping pins to duty cycles (0-100).
+        :param ramp_seconds: The time to ramp towards the duty cycles.
+        :param curve: The name of the interpolation curve, see `CURVES`.
+        :param transform: A function mapping values to duty cycles, applied
+        to every step of the ramp rather than only to its target. The
+        current duty cycles are taken as the start values.
+        """
+        table = None
+        if ramp_seconds > 0:
+            start = {}
+            for pin in duty_cycles:
+                duty_cycle = self.outputs.duty_cycle(pin)
+                start[pin] = duty_cycle if duty_cycle is not None else 0
+            table = ramp_table(
+                self.outputs, start, duty_cycles, ramp_seconds, curve, transform
+            )
+        elif transform is not None:
+            duty_cycles = {
+                pin: transform(duty_cycle) for (pin, duty_cycle) in duty_cycles.items()
+            }
+
+        token = object()
+        for pin in duty_cycles:
+            self._owners[pin] = token
+
+        if table is None:
+            self.outputs.update(duty_cycles)
+        elif self._nursery is not None:
+            self._nursery.start_soon(self._run_ramp, token, table)
+        else:
+            await self._run_ramp(token, table)
+
+    async def _run_ramp(self, token, table):
+        start = trio.current_time()
+        for (offset, duty_cycles) in table:
+            await trio.sleep_until(start + offset)
+
+            owned = {
+                pin: duty_cycle
+                for (pin, duty_cycle) in duty_cycles.items()
+                if self._owners.get(pin) is token
+            }
+            if not owned:
+                return
+
+            try:
+                self.outputs.update(owned)
+            except Exception:
+                logger.exception("duty cycle ramp failed")
+                return
+
+
+@metrics.instrument
 class Pwm(Actuator):
+    RUNNABLE = True
+
     def __init__(self, *args, configuration):
         super().__init__(*args)
 
         self.pins = configuration["gpioAddresses"]
-        self.pi = pigpio.pi()
-        for pin in self.pins:
-            self.pi.set_PWM_range(pin, 100)
+        self.pi = hardware.pigpio(configuration).pi()
+        self.outputs = PwmOutputs(
+            self.pi,
+            self.pins,
+            hardware_pwm=configuration.get("hardwarePwm", False),
+            frequency=configuration.get("pwmFrequency", DEFAULT_HARDWARE_PWM_FREQUENCY),
+        )
+        self.ramps = PwmRamps(self.outputs)
+
+    async def run(self):
+        await self.ramps.run()
 
     async def clean_up(self):
+        self.outputs.stop()
         self.pi.stop()
 
     def _intensity_transform(self, intensity):
@@ -19,9 +370,13 @@ class Pwm(Actuator):
 
     async def do(self, command):
         if "intensity" in command:
-            intensity = command["intensity"]
-            for pin in self.pins:
-                self.pi.set_PWM_dutycycle(pin, self._intensity_transform(intensity))
+            # Ramps interpolate intensities, transforming every step.
+            await self.ramps.set(
+                {pin: command["intensity"] for pin in self.pins},
+                ramp_seconds=command.get("rampSeconds", 0),
+                curve=command.get("curve", "linear"),
+                transform=self._intensity_transform,
+            )
 
 
 class Fans(Pwm):
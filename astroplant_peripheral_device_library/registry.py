@@ -0,0 +1,128 @@
+"""
+Registry of peripheral drivers, imported on first use.
+
+Drivers are looked up by name, such that a kit only imports the modules (and
+their dependencies, e.g. NumPy for the camera) of the peripherals it has
+configured:
+
+    from astroplant_peripheral_device_library import registry
+
+    Bme280 = registry.get("Bme280")
+
+Third-party packages can provide drivers through the
+`astroplant_peripheral_device_library.drivers` entry point group, e.g. in
+setup.py:
+
+    entry_points={
+        "astroplant_peripheral_device_library.drivers": [
+            "Scd30 = astroplant_scd30.driver:Scd30",
+        ],
+    },
+
+Built-in drivers take precedence over entry points with the same name.
+"""
+
+import importlib
+import threading
+
+ENTRY_POINT_GROUP = "astroplant_peripheral_device_library.drivers"
+
+# Built-in drivers, as "module:class" relative to this package.
+DRIVERS = {
+    "Bh1750": ".bh1750:Bh1750",
+    "Bme280": ".bme280:Bme280",
+    "Dht22": ".dht22:Dht22",
+    "Ds18b20": ".ds18b20:Ds18b20",
+    "Fans": ".pwm:Fans",
+    "LCD": ".lcd:LCD",
+    "LedPanel": ".led_panel:LedPanel",
+    "MhZ19": ".mh_z19:MhZ19",
+    "PiCameraV2": ".pi_camera_v2:PiCameraV2",
+    "Pwm": ".pwm:Pwm",
+}
+
+
+class UnknownDriverError(LookupError):
+    pass
+
+
+_lock = threading.Lock()
+# Driver classes per name, once imported or registered.
+_loaded = {}
+# Names of the drivers registered as classes.
+_registered = set()
+_entry_points = None
+
+
+def _discover_entry_points() -> dict:
+    """
+    Find the drivers provided through entry points. Discovery scans the
+    installed packages, so it is only done when a name is not built in.
+    """
+    global _entry_points
+    with _lock:
+        if _entry_points is None:
+            from importlib.metadata import entry_points
+
+            try:
+                found = entry_points(group=ENTRY_POINT_GROUP)
+            except TypeError:
+                # Python < 3.10
+                found = entry_points().get(ENTRY_POINT_GROUP, [])
+            _entry_points = {entry_point.name: entry_point for entry_point in found}
+        return _entry_points
+
+
+def _import(target: str):
+    (module_name, _, class_name) = target.partition(":")
+    module = importlib.import_module(module_name, __package__)
+    return getattr(module, class_name)
+
+
+def names() -> list:
+    """
+    Get the names of all available drivers.
+    """
+    return sorted(set(DRIVERS) | _registered | set(_discover_entry_points()))
+
+
+def get(name: str):
+    """
+    Get a driver class by name, importing its module if needed.
+
+    :param name: The name of a built-in or entry point driver, or a
+    "module:class" path.
+    """
+    driver = _loaded.get(name)
+    if driver is not None:
+        return driver
+
+    if name in DRIVERS:
+        driver = _import(DRIVERS[name])
+    elif ":" in name:
+        driver = _import(name)
+    else:
+        entry_point = _discover_entry_points().get(name)
+        if entry_point is None:
+            raise UnknownDriverError(f"unknown peripheral driver: {name}")
+        driver = entry_point.load()
+
+    _loaded[name] = driver
+    return driver
+
+
+def register(name: str, target):
+    """
+    Register a driver.
+
+    :param target: The driver class, or a "module:class" path to import on
+    first use.
+    """
+    with _lock:
+        if isinstance(target, str):
+            DRIVERS[name] = target
+            _registered.discard(name)
+            _loaded.pop(name, None)
+        else:
+            _registered.add(name)
+            _loaded[name] = target
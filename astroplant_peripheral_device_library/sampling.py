@@ -0,0 +1,52 @@
+"""
+The measurement pipeline shared by the sensor drivers.
+
+A measurement takes the configured number of samples (see `oversampling`)
+through the sensor's circuit breaker (see `breaker`), and passes the
+filtered samples through local aggregation (see `aggregation`). Raw
+measurements carry the numbers of samples taken and rejected for them as
+`samples` and `rejected`. Sensors implement `sample`, returning a list of
+(quantity, unit, value) tuples:
+
+    @metrics.instrument
+    class Bme280(SampledSensor, Sensor):
+        def __init__(self, *args, configuration):
+            super().__init__(*args)
+            self.set_up_sampling(configuration)
+
+        async def sample(self):
+            ...
+"""
+
+import abc
+
+from . import aggregation, breaker, metrics, oversampling
+
+
+@metrics.instrument
+class SampledSensor(abc.ABC):
+    """
+    Mixin for sensors measuring through oversampling, a circuit breaker and
+    local aggregation. Sensors not implementing `sample` cannot be created.
+    """
+
+    def set_up_sampling(self, configuration):
+        """
+        Set up the pipeline from the peripheral's configuration. Call this
+        from the constructor.
+        """
+        self.aggregation = aggregation.LocalAggregation(self, configuration)
+        self.oversampling = oversampling.Oversampling(configuration, self)
+        self.breaker = breaker.configured(self, configuration)
+
+    @abc.abstractmethod
+    async def sample(self):
+        """
+        Take a single sample.
+
+        :return: A list of (quantity, unit, value) tuples.
+        """
+
+    async def measure(self):
+        samples = await self.breaker.call(self.oversampling.sample, self.sample)
+        return self.aggregation.measurements(samples)
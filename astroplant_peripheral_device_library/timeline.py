@@ -0,0 +1,201 @@
+"""
+Timelines of driver activity in the Chrome trace event format.
+
+When enabled, spans of driver calls, driver stages, peripheral control
+holds, I2C transactions, work offloaded to threads and LCD redraws are
+written as trace events to a JSON file, which can be loaded in Perfetto
+(https://ui.perfetto.dev) or chrome://tracing.
+
+Events are written by a background thread as they are emitted. At most
+`buffer_size` events wait to be written; further events are dropped and
+counted, such that a slow disk never stalls the drivers.
+
+Enable the timeline by calling `start`, or by setting the ASTROPLANT_TIMELINE
+environment variable to the path of the file to write. Spans emitted in trio
+tasks are shown per task, others per thread.
+"""
+
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+import trio
+
+ENV = "ASTROPLANT_TIMELINE"
+
+DEFAULT_BUFFER_SIZE = 10000
+
+_STOP = object()
+
+
+class TimelineWriter(object):
+    """
+    Write trace events to a file, in a background thread.
+    """
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE):
+        self._file = open(path, "w")
+        self._file.write("[\n")
+        self._first = True
+        self._queue = queue.Queue(maxsize=buffer_size)
+        self.dropped = 0
+
+        self._start = time.perf_counter()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        # Track ids per trio task or thread.
+        self._tracks = {}
+
+        self._thread = threading.Thread(
+            target=self._run, name="timeline writer", daemon=True
+        )
+        self._thread.start()
+
+    def now(self) -> float:
+        """
+        The current time in microseconds since the start of the timeline.
+        """
+        return (time.perf_counter() - self._start) * 1e6
+
+    def _track(self) -> int:
+        try:
+            task = trio.lowlevel.current_task()
+            (key, name) = (id(task), f"task {task.name}")
+        except RuntimeError:
+            thread = threading.current_thread()
+            (key, name) = (thread.ident, f"thread {thread.name}")
+
+        track = self._tracks.get(key)
+        if track is None:
+            with self._lock:
+                track = self._tracks.setdefault(key, len(self._tracks) + 1)
+            self.emit(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self._pid,
+                    "tid": track,
+                    "args": {"name": name},
+                }
+            )
+        return track
+
+    def complete(self, name: str, category: str, start: float, args=None):
+        """
+        Emit a span from `start` (see `now`) until now.
+        """
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start,
+            "dur": self.now() - start,
+            "pid": self._pid,
+            "tid": self._track(),
+        }
+        if args:
+            event["args"] = args
+        self.emit(event)
+
+    def emit(self, event: dict):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is _STOP:
+                return
+            if not self._first:
+                self._file.write(",\n")
+            self._first = False
+            self._file.write(json.dumps(event, default=str))
+
+    def close(self):
+        if self.dropped:
+            self.emit(
+                {
+                    "name": "dropped events",
+                    "ph": "i",
+                    "s": "g",
+                    "ts": self.now(),
+                    "pid": self._pid,
+                    "tid": 0,
+                    "args": {"count": self.dropped},
+                }
+            )
+        # The writer must get the stop marker, even when the buffer is full
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._file.write("\n]\n")
+        self._file.close()
+
+
+_writer = None
+
+
+def start(path, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Start writing a timeline to a file, until `stop` is called or the
+    process exits.
+
+    :param buffer_size: The number of events that may wait to be written.
+    """
+    global _writer
+    stop()
+    _writer = TimelineWriter(path, buffer_size=buffer_size)
+
+
+def stop():
+    global _writer
+    if _writer is not None:
+        writer = _writer
+        _writer = None
+        writer.close()
+
+
+def enabled() -> bool:
+    return _writer is not None
+
+
+class span(object):
+    """
+    Context manager emitting a span covering its body, if the timeline is
+    enabled.
+
+    :param name: The name of the span.
+    :param category: The category of the span, e.g. "driver" or "i2c".
+    :param args: Arguments shown with the span.
+    """
+
+    __slots__ = ("name", "category", "args", "_writer", "_start")
+
+    def __init__(self, name: str, category: str, **args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self._writer = _writer
+
+    def __enter__(self):
+        if self._writer is not None:
+            self._start = self._writer.now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._writer is not None:
+            args = self.args
+            if exc_type is not None:
+                args = dict(args, error=exc_type.__name__)
+            self._writer.complete(self.name, self.category, self._start, args)
+        return False
+
+
+atexit.register(stop)
+
+if os.environ.get(ENV):
+    start(os.environ[ENV])
@@ -0,0 +1,678 @@
+"""
+Record the traffic between the drivers and the hardware, and replay it.
+
+While recording, every I2C backend operation, GPIO mode change, write and
+callback edge, and serial read and write is logged with its monotonic
+timestamp to a compact binary trace file. While replaying, I2C devices, pigpio
+and serial ports are replaced by stand-ins answering from a trace, such that
+the drivers decode exactly the traffic that was recorded.
+
+Start recording or replaying before the peripherals are created, by calling
+`record` or `replay`, or by setting the ASTROPLANT_TRACE_RECORD or
+ASTROPLANT_TRACE_REPLAY environment variable to the path of the trace file.
+
+A trace file starts with `MAGIC`, followed by records. Each record is a
+`RECORD_HEADER` (kind, seconds since the start of the recording, channel and
+payload length) followed by the payload:
+
+- `KIND_I2C`: channel is bus << 7 | address. The payload is an `I2C_HEADER`
+  (operation, register and length of the data written), the data written and
+  the data read. Failed operations have `I2C_FAILED` set in the operation.
+- `KIND_GPIO_EDGE`: channel is the GPIO. The payload is a `GPIO_EDGE`
+  (level and pigpio tick) delivered to callbacks.
+- `KIND_GPIO_MODE`, `KIND_GPIO_WRITE`: channel is the GPIO. The payload is
+  the mode or level set by the host.
+- `KIND_SERIAL_OPEN`: channel is a new serial channel, the payload the name
+  of the port.
+- `KIND_SERIAL_WRITE`, `KIND_SERIAL_READ`: the bytes written to or read from
+  the serial channel.
+"""
+
+import atexit
+import collections
+import os
+import struct
+import threading
+import time
+
+MAGIC = b"APTRACE1"
+
+RECORD_HEADER = struct.Struct("<BdHI")
+I2C_HEADER = struct.Struct("<BBH")
+GPIO_EDGE = struct.Struct("<BI")
+
+KIND_I2C = 1
+KIND_GPIO_EDGE = 2
+KIND_GPIO_MODE = 3
+KIND_GPIO_WRITE = 4
+KIND_SERIAL_OPEN = 5
+KIND_SERIAL_WRITE = 6
+KIND_SERIAL_READ = 7
+
+## I2C backend operations
+I2C_READ_BYTE = 1
+I2C_WRITE_BYTE = 2
+I2C_READ_DEVICE = 3
+I2C_READ_BYTE_DATA = 4
+I2C_WRITE_BYTE_DATA = 5
+I2C_READ_WORD_DATA = 6
+I2C_WRITE_WORD_DATA = 7
+I2C_READ_I2C_BLOCK_DATA = 8
+I2C_WRITE_I2C_BLOCK_DATA = 9
+I2C_TRANSACTION = 10
+
+I2C_FAILED = 0x80
+
+RECORD_ENV = "ASTROPLANT_TRACE_RECORD"
+REPLAY_ENV = "ASTROPLANT_TRACE_REPLAY"
+
+# pigpio's INPUT mode.
+_GPIO_INPUT = 0
+
+
+class TraceError(Exception):
+    pass
+
+
+class TraceMismatchError(TraceError):
+    """
+    The drivers asked for traffic that differs from the trace.
+    """
+
+    pass
+
+
+def i2c_channel(bus: int, address: int) -> int:
+    return bus << 7 | address
+
+
+class TraceWriter(object):
+    """
+    Write records to a trace file. Safe to use from multiple threads.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._serial_channels = 0
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def write(self, kind: int, channel: int, payload=b""):
+        timestamp = time.monotonic() - self._start
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(RECORD_HEADER.pack(kind, timestamp, channel, len(payload)))
+            self._file.write(payload)
+
+    def open_serial(self, port: str) -> int:
+        """
+        Allocate a channel for a serial port.
+        """
+        with self._lock:
+            channel = self._serial_channels
+            self._serial_channels += 1
+        self.write(KIND_SERIAL_OPEN, channel, str(port).encode("utf-8"))
+        return channel
+
+
+def read_trace(path):
+    """
+    Iterate over the (kind, timestamp, channel, payload) records of a trace
+    file.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise TraceError(f"not a trace file: {path}")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                raise TraceError("truncated trace record")
+            (kind, timestamp, channel, length) = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                raise TraceError("truncated trace record")
+            yield (kind, timestamp, channel, payload)
+
+
+class Trace(object):
+    """
+    A trace loaded for replay.
+
+    :param realtime: Whether to reproduce the recorded timing, by waiting
+    until each record is due. Otherwise, traffic is replayed as fast as the
+    drivers consume it.
+    """
+
+    def __init__(self, path, realtime=False):
+        self.realtime = realtime
+        self._start = None
+        self._lock = threading.Lock()
+
+        # Per channel, queues of (timestamp, operation, data read).
+        self.i2c = collections.defaultdict(collections.deque)
+        # Per GPIO, queues of edge bursts following the host releasing the
+        # GPIO (setting it to input), as lists of (level, tick).
+        self.gpio_bursts = collections.defaultdict(collections.deque)
+        # Per port, queues of (timestamp, data read).
+        self.serial = collections.OrderedDict()
+
+        serial_ports = {}
+        for (kind, timestamp, channel, payload) in read_trace(path):
+            if kind == KIND_I2C:
+                (operation, _, written) = I2C_HEADER.unpack_from(payload)
+                read = payload[I2C_HEADER.size + written :]
+                self.i2c[channel].append((timestamp, operation, read))
+            elif kind == KIND_GPIO_MODE:
+                if payload[0] == _GPIO_INPUT:
+                    self.gpio_bursts[channel].append([])
+            elif kind == KIND_GPIO_EDGE:
+                bursts = self.gpio_bursts[channel]
+                if bursts:
+                    bursts[-1].append(GPIO_EDGE.unpack(payload))
+            elif kind == KIND_SERIAL_OPEN:
+                port = payload.decode("utf-8")
+                serial_ports[channel] = port
+                self.serial.setdefault(port, collections.deque())
+            elif kind == KIND_SERIAL_READ:
+                self.serial[serial_ports[channel]].append((timestamp, payload))
+
+    def wait(self, timestamp: float):
+        """
+        In realtime replay, block until a record is due.
+        """
+        if not self.realtime:
+            return
+        with self._lock:
+            if self._start is None:
+                self._start = time.monotonic() - timestamp
+        remaining = self._start + timestamp - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def next_i2c(self, bus: int, address: int, operation: int):
+        """
+        Get the data read by the next I2C operation on a device.
+        """
+        queue = self.i2c.get(i2c_channel(bus, address))
+        if not queue:
+            raise TraceMismatchError(
+                f"no more I2C traffic recorded for bus {bus}, address {address:#04x}"
+            )
+        (timestamp, recorded, read) = queue.popleft()
+        self.wait(timestamp)
+        if recorded & ~I2C_FAILED != operation:
+            raise TraceMismatchError(
+                f"expected I2C operation {recorded & ~I2C_FAILED}, got {operation}"
+            )
+        if recorded & I2C_FAILED:
+            raise OSError(f"replayed I2C failure on address {address:#04x}")
+        return read
+
+    def next_gpio_burst(self, gpio: int):
+        """
+        Get the edges following the host releasing a GPIO, or an empty list
+        if none were recorded.
+        """
+        bursts = self.gpio_bursts.get(gpio)
+        if not bursts:
+            return []
+        return bursts.popleft()
+
+    def next_serial_read(self, port: str) -> bytes:
+        if port not in self.serial:
+            if not self.serial:
+                raise TraceMismatchError("no serial traffic recorded")
+            # Fall back to the first port recorded
+            port = next(iter(self.serial))
+        queue = self.serial[port]
+        if not queue:
+            raise TraceMismatchError(f"no more serial traffic recorded for {port}")
+        (timestamp, data) = queue.popleft()
+        self.wait(timestamp)
+        return data
+
+
+## I2C
+def _encode_i2c(operation, register=0, written=b"", read=b""):
+    header = I2C_HEADER.pack(operation, register, len(written))
+    return header + bytes(written) + bytes(read)
+
+
+class RecordingBackend(object):
+    """
+    Wraps an I2C backend (see `i2c_backends`), recording its operations.
+    """
+
+    def __init__(self, backend, writer: TraceWriter, bus: int, address: int):
+        self.backend = backend
+        self.writer = writer
+        self.channel = i2c_channel(bus, address)
+
+    def close(self):
+        self.backend.close()
+
+    def _record(self, operation, fn, register=0, written=b"", encode=None):
+        try:
+            result = fn()
+        except Exception:
+            self.writer.write(
+                KIND_I2C,
+                self.channel,
+                _encode_i2c(operation | I2C_FAILED, register, written),
+            )
+            raise
+        read = b"" if encode is None else encode(result)
+        self.writer.write(
+            KIND_I2C, self.channel, _encode_i2c(operation, register, written, read)
+        )
+        return result
+
+    def read_byte(self):
+        return self._record(
+            I2C_READ_BYTE, self.backend.read_byte, encode=lambda b: bytes([b])
+        )
+
+    def write_byte(self, byte: int):
+        self._record(
+            I2C_WRITE_BYTE, lambda: self.backend.write_byte(byte), written=bytes([byte])
+        )
+
+    def read_device(self, count: int):
+        return self._record(
+            I2C_READ_DEVICE, lambda: self.backend.read_device(count), encode=bytes
+        )
+
+    def read_byte_data(self, register: int):
+        return self._record(
+            I2C_READ_BYTE_DATA,
+            lambda: self.backend.read_byte_data(register),
+            register=register,
+            encode=lambda b: bytes([b]),
+        )
+
+    def write_byte_data(self, register: int, data: int):
+        self._record(
+            I2C_WRITE_BYTE_DATA,
+            lambda: self.backend.write_byte_data(register, data),
+            register=register,
+            written=bytes([data]),
+        )
+
+    def read_word_data(self, register: int):
+        return self._record(
+            I2C_READ_WORD_DATA,
+            lambda: self.backend.read_word_data(register),
+            register=register,
+            encode=lambda w: struct.pack("<H", w),
+        )
+
+    def write_word_data(self, register: int, data: int):
+        self._record(
+            I2C_WRITE_WORD_DATA,
+            lambda: self.backend.write_word_data(register, data),
+            register=register,
+            written=struct.pack("<H", data),
+        )
+
+    def read_i2c_block_data(self, register: int, count: int):
+        return self._record(
+            I2C_READ_I2C_BLOCK_DATA,
+            lambda: self.backend.read_i2c_block_data(register, count),
+            register=register,
+            encode=bytes,
+        )
+
+    def write_i2c_block_data(self, register: int, data):
+        self._record(
+            I2C_WRITE_I2C_BLOCK_DATA,
+            lambda: self.backend.write_i2c_block_data(register, data),
+            register=register,
+            written=bytes(data),
+        )
+
+    def transaction(self, messages):
+        written = b"".join(
+            bytes(payload) for (is_read, payload) in messages if not is_read
+        )
+        return self._record(
+            I2C_TRANSACTION,
+            lambda: self.backend.transaction(messages),
+            written=written,
+            encode=bytes,
+        )
+
+
+class ReplayBackend(object):
+    """
+    An I2C backend answering from the trace being replayed.
+    """
+
+    def __init__(self, bus: int, address: int):
+        if _replay is None:
+            raise TraceError("no trace is being replayed")
+        self.trace = _replay
+        self.bus = bus
+        self.address = address
+
+    def close(self):
+        pass
+
+    def _next(self, operation):
+        return self.trace.next_i2c(self.bus, self.address, operation)
+
+    def read_byte(self):
+        return self._next(I2C_READ_BYTE)[0]
+
+    def write_byte(self, byte: int):
+        self._next(I2C_WRITE_BYTE)
+
+    def read_device(self, count: int):
+        return bytearray(self._next(I2C_READ_DEVICE))
+
+    def read_byte_data(self, register: int):
+        return self._next(I2C_READ_BYTE_DATA)[0]
+
+    def write_byte_data(self, register: int, data: int):
+        self._next(I2C_WRITE_BYTE_DATA)
+
+    def read_word_data(self, register: int):
+        return struct.unpack("<H", self._next(I2C_READ_WORD_DATA))[0]
+
+    def write_word_data(self, register: int, data: int):
+        self._next(I2C_WRITE_WORD_DATA)
+
+    def read_i2c_block_data(self, register: int, count: int):
+        return bytearray(self._next(I2C_READ_I2C_BLOCK_DATA))
+
+    def write_i2c_block_data(self, register: int, data):
+        self._next(I2C_WRITE_I2C_BLOCK_DATA)
+
+    def transaction(self, messages):
+        return bytearray(self._next(I2C_TRANSACTION))
+
+
+## pigpio
+class _ModuleProxy(object):
+    """
+    A module with some attributes replaced.
+    """
+
+    def __init__(self, module, **attributes):
+        self._module = module
+        self.__dict__.update(attributes)
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+class RecordingPi(object):
+    """
+    Wraps a pigpio.pi, recording GPIO mode changes, writes and callback
+    edges.
+    """
+
+    def __init__(self, pi, writer: TraceWriter):
+        self._pi = pi
+        self._writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self._pi, name)
+
+    def set_mode(self, gpio, mode):
+        self._writer.write(KIND_GPIO_MODE, gpio, bytes([mode]))
+        return self._pi.set_mode(gpio, mode)
+
+    def write(self, gpio, level):
+        self._writer.write(KIND_GPIO_WRITE, gpio, bytes([level]))
+        return self._pi.write(gpio, level)
+
+    def callback(self, user_gpio, edge=0, func=None):
+        writer = self._writer
+
+        def _func(gpio, level, tick):
+            writer.write(KIND_GPIO_EDGE, gpio, GPIO_EDGE.pack(level, tick))
+            if func is not None:
+                func(gpio, level, tick)
+
+        return self._pi.callback(user_gpio, edge, _func)
+
+
+class _ReplayCallback(object):
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        if self in self.pi._callbacks:
+            self.pi._callbacks.remove(self)
+
+
+class ReplayPi(object):
+    """
+    A pigpio.pi delivering recorded edges to callbacks. When the host
+    releases a GPIO (sets it to input), the edges recorded after the same
+    event are delivered, as a sensor would respond to a trigger.
+
+    Outputs are accepted and ignored.
+    """
+
+    def __init__(self, pigpio, trace: Trace):
+        self._pigpio = pigpio
+        self._trace = trace
+        self._callbacks = []
+        self.connected = True
+
+    def stop(self):
+        self._callbacks = []
+        self.connected = False
+
+    def set_mode(self, gpio, mode):
+        if mode == self._pigpio.INPUT:
+            for (level, tick) in self._trace.next_gpio_burst(gpio):
+                self._emit(gpio, level, tick)
+        return 0
+
+    def _emit(self, gpio, level, tick):
+        for callback in list(self._callbacks):
+            if callback.gpio != gpio:
+                continue
+            if (
+                level == self._pigpio.TIMEOUT
+                or callback.edge == self._pigpio.EITHER_EDGE
+                or (callback.edge == self._pigpio.RISING_EDGE and level == 1)
+                or (callback.edge == self._pigpio.FALLING_EDGE and level == 0)
+            ):
+                callback.func(gpio, level, tick)
+
+    def callback(self, user_gpio, edge=0, func=None):
+        callback = _ReplayCallback(self, user_gpio, edge, func or (lambda *args: None))
+        self._callbacks.append(callback)
+        return callback
+
+    def write(self, gpio, level):
+        return 0
+
+    def set_pull_up_down(self, gpio, pud):
+        return 0
+
+    def set_watchdog(self, user_gpio, wdog_timeout):
+        return 0
+
+    def set_PWM_range(self, user_gpio, range_):
+        return 0
+
+    def set_PWM_dutycycle(self, user_gpio, dutycycle):
+        return 0
+
+    def hardware_PWM(self, gpio, PWMfreq, PWMduty):
+        return 0
+
+    def store_script(self, script):
+        raise self._pigpio.error("scripts are not replayed")
+
+
+## Serial
+class RecordingSerial(object):
+    """
+    Wraps a serial.Serial, recording the bytes written and read.
+    """
+
+    def __init__(self, serial, writer: TraceWriter, port):
+        self._serial = serial
+        self._writer = writer
+        self._channel = writer.open_serial(port)
+
+    def __getattr__(self, name):
+        return getattr(self._serial, name)
+
+    def write(self, data):
+        self._writer.write(KIND_SERIAL_WRITE, self._channel, bytes(data))
+        return self._serial.write(data)
+
+    def read(self, size=1):
+        data = self._serial.read(size)
+        self._writer.write(KIND_SERIAL_READ, self._channel, bytes(data))
+        return data
+
+
+class ReplaySerial(object):
+    """
+    A serial.Serial returning the recorded reads, in order. Every read
+    returns what the corresponding recorded read returned.
+    """
+
+    def __init__(self, trace: Trace, port=None, **kwargs):
+        self._trace = trace
+        self.port = port
+        self.in_waiting = 0
+
+    def write(self, data):
+        return len(data)
+
+    def read(self, size=1):
+        return self._trace.next_serial_read(self.port)
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def replay_pigpio():
+    """
+    Get a pigpio module replaying the trace.
+    """
+    from .emulation import pigpio
+
+    trace = _replay
+    return _ModuleProxy(pigpio, pi=lambda *args, **kwargs: ReplayPi(pigpio, trace))
+
+
+def replay_serial():
+    """
+    Get a pyserial module replaying the trace.
+    """
+    from .emulation import serial
+
+    trace = _replay
+    return _ModuleProxy(
+        serial, Serial=lambda port=None, *args, **kwargs: ReplaySerial(trace, port)
+    )
+
+
+def record_pigpio(pigpio):
+    """
+    Wrap the pigpio module (or its emulation) for recording, if active.
+    """
+    if _writer is None:
+        return pigpio
+
+    writer = _writer
+    return _ModuleProxy(
+        pigpio,
+        pi=lambda *args, **kwargs: RecordingPi(pigpio.pi(*args, **kwargs), writer),
+    )
+
+
+def record_serial(serial):
+    """
+    Wrap the pyserial module (or its emulation) for recording, if active.
+    """
+    if _writer is None:
+        return serial
+
+    writer = _writer
+
+    def _serial(port=None, *args, **kwargs):
+        return RecordingSerial(serial.Serial(port, *args, **kwargs), writer, port)
+
+    return _ModuleProxy(serial, Serial=_serial)
+
+
+def record_backend(backend, bus: int, address: int):
+    """
+    Wrap an I2C backend for recording, if active.
+    """
+    if _writer is not None:
+        return RecordingBackend(backend, _writer, bus, address)
+    return backend
+
+
+_writer = None
+_replay = None
+
+
+def record(path):
+    """
+    Record traffic to a trace file, until `stop` is called or the process
+    exits.
+    """
+    global _writer
+    stop()
+    _writer = TraceWriter(path)
+
+
+def replay(path, realtime=False):
+    """
+    Replay traffic from a trace file to peripherals created from now on.
+
+    :param realtime: Whether to reproduce the recorded timing.
+    """
+    global _replay
+    stop()
+    _replay = Trace(path, realtime=realtime)
+
+
+def replaying() -> bool:
+    return _replay is not None
+
+
+def stop():
+    """
+    Stop recording or replaying.
+    """
+    global _writer, _replay
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+    _replay = None
+
+
+atexit.register(stop)
+
+if os.environ.get(REPLAY_ENV):
+    replay(os.environ[REPLAY_ENV])
+elif os.environ.get(RECORD_ENV):
+    record(os.environ[RECORD_ENV])
@@ -0,0 +1,170 @@
+"""
+The shared pool of worker threads running blocking driver work.
+
+All blocking work offloaded by drivers (I2C transactions, w1thermsensor and
+serial reads, DHT22 triggers, camera captures and processing) runs through
+`run_sync`. Work is limited twice:
+
+- per group, typically a driver class or an I2C bus, such that a burst of
+  slow work of one driver cannot take all threads;
+- library-wide, with waiting work granted a thread in order of priority,
+  then in order of arrival.
+
+The number of waiting calls and the time they waited are recorded as
+metrics.
+"""
+
+import heapq
+import itertools
+import time
+
+import trio
+
+from . import metrics
+
+## Priorities, lower is more urgent. These match the I2C transaction
+## priorities of `i2c_bus`.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+# The number of worker threads shared by all drivers.
+DEFAULT_CAPACITY = 8
+
+# The number of worker threads per group, by group.
+DEFAULT_GROUP_CAPACITY = 2
+GROUP_CAPACITIES = {
+    "Ds18b20": 2,
+    "Dht22": 1,
+    "MhZ19": 1,
+    "PiCameraV2": 1,
+}
+
+
+class PriorityLimiter(object):
+    """
+    Limits the number of concurrent tasks, granting waiting tasks in order of
+    priority, then in order of arrival.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.borrowed = 0
+        # Tickets of waiting tasks, as [priority, arrival, event]. The event of
+        # a cancelled ticket is set to None.
+        self._waiting = []
+        self._arrivals = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for ticket in self._waiting if ticket[2] is not None)
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        if self.borrowed < self.capacity and self.waiting == 0:
+            self.borrowed += 1
+            await trio.lowlevel.checkpoint()
+            return
+
+        event = trio.Event()
+        ticket = [priority, next(self._arrivals), event]
+        heapq.heappush(self._waiting, ticket)
+        try:
+            await event.wait()
+        except BaseException:
+            if event.is_set():
+                # Granted while being cancelled: pass it on.
+                self.release()
+            else:
+                ticket[2] = None
+            raise
+
+    def release(self):
+        while self._waiting:
+            (_, _, event) = heapq.heappop(self._waiting)
+            if event is not None:
+                # Hand the slot over to the waiting task.
+                event.set()
+                return
+        self.borrowed -= 1
+
+
+_pool = PriorityLimiter(DEFAULT_CAPACITY)
+_group_limiters = {}
+
+
+def configure(capacity=None, group_capacities=None):
+    """
+    Configure the pool. Must be called before any work is run.
+
+    :param capacity: The number of worker threads shared by all drivers.
+    :param group_capacities: The number of worker threads per group, by
+    group.
+    """
+    global _pool
+    if capacity is not None:
+        _pool = PriorityLimiter(capacity)
+    if group_capacities is not None:
+        GROUP_CAPACITIES.update(group_capacities)
+        _group_limiters.clear()
+
+
+def group_limiter(group: str) -> trio.CapacityLimiter:
+    if group not in _group_limiters:
+        _group_limiters[group] = trio.CapacityLimiter(
+            GROUP_CAPACITIES.get(group, DEFAULT_GROUP_CAPACITY)
+        )
+    return _group_limiters[group]
+
+
+async def run_sync(fn, *args, group: str, priority=PRIORITY_NORMAL, limiter=None):
+    """
+    Run a blocking function in a worker thread of the pool.
+
+    :param group: The group the work is limited in, e.g. the driver class
+    name.
+    :param priority: The priority of the work, lower is more urgent.
+    :param limiter: A limiter to use for the group instead of the
+    configured one, e.g. an I2C bus limiter.
+    """
+    if limiter is None:
+        limiter = group_limiter(group)
+
+    queued = time.perf_counter()
+    async with limiter:
+        await _pool.acquire(priority)
+        try:
+            if metrics.enabled():
+                metrics.histogram(
+                    "astroplant_worker_wait_seconds",
+                    "Time blocking work waited for the worker pool.",
+                    group=group,
+                    priority=priority,
+                ).observe(time.perf_counter() - queued)
+            return await metrics.run_sync(fn, *args)
+        finally:
+            _pool.release()
+
+
+def _collect_metrics():
+    yield (
+        "astroplant_worker_pool_waiting",
+        "Blocking work waiting for a worker thread of the shared pool.",
+        {},
+        _pool.waiting,
+    )
+    yield (
+        "astroplant_worker_pool_busy",
+        "Worker threads of the shared pool in use.",
+        {},
+        _pool.borrowed,
+    )
+    for (group, limiter) in list(_group_limiters.items()):
+        yield (
+            "astroplant_worker_group_waiting",
+            "Blocking work waiting for its group's capacity.",
+            {"group": group},
+            limiter.statistics().tasks_waiting,
+        )
+
+
+metrics.add_collector(_collect_metrics)
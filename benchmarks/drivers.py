@@ -0,0 +1,305 @@
+"""
+Benchmark the peripheral drivers against emulated hardware.
+
+Every driver is run against the emulation (see
+`astroplant_peripheral_device_library.emulation`), reporting per call:
+latency percentiles, pigpio commands, I2C transactions, bytes on the bus,
+GPIO edges, CPU time and peak Python memory. For example:
+
+    python benchmarks/drivers.py --iterations 50 --output results.json
+    python benchmarks/drivers.py --compare results.json
+
+Latencies of the emulated hardware are scaled by --latency-scale; 0 measures
+the drivers' own overhead only. CPU time is that of the whole process, and so
+includes the emulated devices.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+os.environ["ASTROPLANT_EMULATION"] = "1"
+
+import trio
+import trio.testing
+
+from astroplant_peripheral_device_library import emulation
+from astroplant_peripheral_device_library.emulation import pigpio as emulated_pigpio
+from astroplant_peripheral_device_library.emulation import serial as emulated_serial
+
+INTERVALS = {"intervals": {"measurementInterval": 60, "aggregateInterval": 900}}
+
+
+def _sensor(module_name, class_name, configuration):
+    """
+    Benchmark the `measure` of a sensor.
+    """
+
+    async def benchmark(iterations, record):
+        module = __import__(
+            f"astroplant_peripheral_device_library.{module_name}",
+            fromlist=[class_name],
+        )
+        sensor = getattr(module, class_name)(
+            configuration=dict(INTERVALS, **configuration)
+        )
+        if hasattr(sensor, "set_up"):
+            await sensor.set_up()
+        try:
+            for _ in range(iterations):
+                await record(sensor.measure)
+        finally:
+            if hasattr(sensor, "clean_up"):
+                await sensor.clean_up()
+
+    return benchmark
+
+
+async def _lcd(iterations, record):
+    """
+    Benchmark redrawing both rows of the LCD.
+    """
+    from astroplant_peripheral_device_library import i2c, lcd
+
+    display = lcd.LCD(configuration={"i2cAddress": "0x27"})
+    await i2c.run_sync(display.i2c_device.bus, display._initialize)
+
+    def redraw(idx):
+        display.set_cursor_position(0, 0)
+        display._write_str(f"CO2 {600 + idx:5d} ppm    "[: display.columns])
+        display.set_cursor_position(1, 0)
+        display._write_str(f"Temp {21.5:5.1f} C     "[: display.columns])
+
+    try:
+        for idx in range(iterations):
+            await record(i2c.run_sync, display.i2c_device.bus, redraw, idx)
+    finally:
+        display.i2c_device.stop()
+
+
+def _actuator(module_name, class_name, configuration, commands):
+    """
+    Benchmark the `do` of an actuator, cycling through commands.
+    """
+
+    async def benchmark(iterations, record):
+        module = __import__(
+            f"astroplant_peripheral_device_library.{module_name}",
+            fromlist=[class_name],
+        )
+        actuator = getattr(module, class_name)(configuration=configuration)
+        try:
+            for idx in range(iterations):
+                await record(actuator.do, commands[idx % len(commands)])
+        finally:
+            await actuator.clean_up()
+
+    return benchmark
+
+
+async def _camera(iterations, record):
+    """
+    Benchmark the NIR and NDVI processing of the camera. Waits for lighting
+    are skipped by running on a virtual clock.
+    """
+    from astroplant_peripheral_device_library import pi_camera_v2
+    from astroplant_peripheral_device_library.emulation import picamera2
+
+    camera = picamera2.Picamera2()
+    camera.configure(camera.create_still_configuration(main={"size": (1640, 1232)}))
+    camera.start()
+
+    async def led_panel_control(command):
+        pass
+
+    async def ndvi():
+        return await pi_camera_v2._capture_ndvi(camera, led_panel_control)
+
+    for _ in range(iterations):
+        await record(ndvi)
+
+
+BENCHMARKS = {
+    "Bme280": _sensor("bme280", "Bme280", {"i2cAddress": "0x76"}),
+    "Bh1750": _sensor("bh1750", "Bh1750", {"i2cAddress": "0x23"}),
+    "Dht22": _sensor("dht22", "Dht22", {"gpioAddress": 4}),
+    "Ds18b20": _sensor("ds18b20", "Ds18b20", {}),
+    "MhZ19": _sensor("mh_z19", "MhZ19", {"serialFile": "/dev/ttyS0"}),
+    "LCD": _lcd,
+    "Pwm": _actuator(
+        "pwm",
+        "Pwm",
+        {"gpioAddresses": [20, 21]},
+        [{"intensity": 25}, {"intensity": 75}],
+    ),
+    "LedPanel": _actuator(
+        "led_panel",
+        "LedPanel",
+        {"gpioAddressBlue": 17, "gpioAddressRed": 27, "gpioAddressFarRed": 22},
+        [
+            {"blue": 75, "red": 75, "farRed": 0},
+            {"blue": 0, "red": 0, "farRed": 75},
+        ],
+    ),
+    "PiCameraV2": _camera,
+}
+
+# Benchmarks run on a virtual clock, skipping sleeps.
+VIRTUAL_CLOCK = {"PiCameraV2"}
+
+
+def _counters():
+    return {
+        "pigpio_commands": emulated_pigpio.stats["commands"],
+        "i2c_transactions": emulated_pigpio.stats["i2c_transactions"],
+        "i2c_bytes": emulated_pigpio.stats["i2c_bytes"],
+        "gpio_edges": emulated_pigpio.stats["gpio_edges"],
+        "serial_bytes": emulated_serial.stats["bytes"],
+    }
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    idx = min(int(round(percentile / 100 * (len(values) - 1))), len(values) - 1)
+    return values[idx]
+
+
+def run(name, iterations):
+    latencies = []
+    cpu_times = []
+    counters = {key: 0 for key in _counters()}
+    peak_memory = 0
+
+    async def record(fn, *args):
+        nonlocal peak_memory
+
+        before = _counters()
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        await fn(*args)
+        latencies.append(time.perf_counter() - start)
+        cpu_times.append(time.process_time() - cpu_start)
+        peak_memory = max(
+            peak_memory, tracemalloc.get_traced_memory()[1] - memory_before
+        )
+        for (key, value) in _counters().items():
+            counters[key] += value - before[key]
+
+    clock = (
+        trio.testing.MockClock(autojump_threshold=0) if name in VIRTUAL_CLOCK else None
+    )
+
+    tracemalloc.start()
+    try:
+        trio.run(BENCHMARKS[name], iterations, record, clock=clock)
+    finally:
+        tracemalloc.stop()
+
+    result = {
+        "calls": len(latencies),
+        "latency_seconds": {
+            "mean": statistics.mean(latencies),
+            "p50": _percentile(latencies, 50),
+            "p90": _percentile(latencies, 90),
+            "p99": _percentile(latencies, 99),
+            "max": max(latencies),
+        },
+        "cpu_seconds_per_call": statistics.mean(cpu_times),
+        "peak_memory_bytes": peak_memory,
+    }
+    for (key, value) in counters.items():
+        result[f"{key}_per_call"] = value / len(latencies)
+    return result
+
+
+def compare(results, baseline):
+    """
+    Print the change of each metric relative to a baseline.
+    """
+    for (name, result) in results.items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]
+        changes = {
+            "p50": (result["latency_seconds"]["p50"], base["latency_seconds"]["p50"]),
+            "p99": (result["latency_seconds"]["p99"], base["latency_seconds"]["p99"]),
+            "cpu": (result["cpu_seconds_per_call"], base["cpu_seconds_per_call"]),
+            "memory": (result["peak_memory_bytes"], base["peak_memory_bytes"]),
+            "i2c": (
+                result["i2c_transactions_per_call"],
+                base["i2c_transactions_per_call"],
+            ),
+        }
+        formatted = "  ".join(
+            f"{key} {(new / old - 1) * 100:+6.1f}%" if old else f"{key}    n/a"
+            for (key, (new, old)) in changes.items()
+        )
+        print(f"{name:12} {formatted}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=1.0,
+        help="scale of the emulated hardware latencies",
+    )
+    parser.add_argument("--drivers", nargs="+", default=list(BENCHMARKS.keys()))
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="compare against results in this file")
+    args = parser.parse_args()
+
+    emulation.LATENCY_SCALE = args.latency_scale
+
+    results = {}
+    for name in args.drivers:
+        emulated_pigpio.reset_stats()
+        emulated_serial.reset_stats()
+        try:
+            results[name] = run(name, args.iterations)
+        except ImportError as e:
+            print(f"{name:12} skipped: {e}", file=sys.stderr)
+            continue
+
+        result = results[name]
+        bytes_per_call = result["i2c_bytes_per_call"] + result["serial_bytes_per_call"]
+        print(
+            f"{name:12} "
+            f"p50 {result['latency_seconds']['p50'] * 1e3:8.2f} ms  "
+            f"p99 {result['latency_seconds']['p99'] * 1e3:8.2f} ms  "
+            f"cpu {result['cpu_seconds_per_call'] * 1e3:7.2f} ms  "
+            f"i2c {result['i2c_transactions_per_call']:6.1f}  "
+            f"bytes {bytes_per_call:7.1f}  "
+            f"edges {result['gpio_edges_per_call']:5.1f}  "
+            f"mem {result['peak_memory_bytes'] / 1024:9.1f} KiB"
+        )
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "iterations": args.iterations,
+        "latency_scale": args.latency_scale,
+        "results": results,
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Compare the latency of the I2C backends.
+
+Requires a device on the bus. Without hardware, the kernel's i2c-stub module
+provides one, e.g.:
+
+    sudo modprobe i2c-dev
+    sudo modprobe i2c-stub chip_addr=0x50
+    python benchmarks/i2c_backends.py --bus 11 --address 0x50
+
+(The stub's bus number is listed by `i2cdetect -l`. The pigpio backend
+additionally requires pigpiod to be running.)
+"""
+
+import argparse
+import statistics
+import time
+
+from astroplant_peripheral_device_library import i2c, i2c_backends
+
+
+def _time_calls(fn, iterations):
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def benchmark(backend, bus, address, register, iterations):
+    device = i2c.I2cDevice(address, bus=bus, backend=backend)
+    try:
+        results = {
+            "read_byte_data": _time_calls(
+                lambda: device.read_byte_data(register), iterations
+            ),
+            "read_i2c_block_data(8)": _time_calls(
+                lambda: device.read_i2c_block_data(register, 8), iterations
+            ),
+            "write_byte": _time_calls(lambda: device.write_byte(0x00), iterations),
+        }
+    finally:
+        device.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--bus", type=int, default=1)
+    parser.add_argument("--address", type=lambda a: int(a, base=16), default=0x50)
+    parser.add_argument("--register", type=lambda r: int(r, base=16), default=0x00)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument(
+        "--backends", nargs="+", default=list(i2c_backends.BACKENDS.keys())
+    )
+    args = parser.parse_args()
+
+    for backend in args.backends:
+        results = benchmark(
+            backend, args.bus, args.address, args.register, args.iterations
+        )
+        for (operation, durations) in results.items():
+            print(
+                f"{backend:8} {operation:24} "
+                f"median {statistics.median(durations) * 1e6:8.1f} us  "
+                f"mean {statistics.mean(durations) * 1e6:8.1f} us"
+            )
+
+
+if __name__ == "__main__":
+    main()
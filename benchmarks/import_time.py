@@ -0,0 +1,132 @@
+"""
+Measure import times of the registry and each driver against a budget.
+
+Every import is timed in a fresh interpreter, such that nothing is cached
+between measurements. The registry must import without any driver module;
+each driver and shared module must import within its budget, and without
+NumPy unless it needs it. Exits with status 1 if a budget is
+exceeded, e.g. for use in CI:
+
+    python benchmarks/import_time.py --runs 5
+
+Drivers whose dependencies are not installed are reported and skipped.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+from astroplant_peripheral_device_library import registry
+
+PACKAGE = "astroplant_peripheral_device_library"
+
+# Budgets in milliseconds, on a Raspberry Pi 3B+.
+REGISTRY_BUDGET = 20
+DEFAULT_DRIVER_BUDGET = 300
+DRIVER_BUDGETS = {
+    # NumPy, Pillow and picamera2
+    "PiCameraV2": 1500,
+}
+# Drivers that may import NumPy.
+NUMPY_DRIVERS = frozenset(["PiCameraV2"])
+
+# Modules imported by many drivers, with their budgets.
+MODULE_BUDGETS = {
+    # statistics, but not NumPy
+    "aggregation": 100,
+}
+
+_MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+duration = time.perf_counter() - start
+drivers = sorted(
+    name for name in sys.modules
+    if name.startswith("{package}.") and name.rsplit(".", 1)[1] in {modules!r}
+)
+numpy = "numpy" in sys.modules
+print(json.dumps({{"seconds": duration, "driver_modules": drivers, "numpy": numpy}}))
+"""
+
+
+def _driver_modules():
+    return sorted(
+        {target.partition(":")[0].lstrip(".") for target in registry.DRIVERS.values()}
+    )
+
+
+def measure(statement: str) -> dict:
+    code = _MEASURE.format(
+        statement=statement, package=PACKAGE, modules=_driver_modules()
+    )
+    process = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        raise ImportError(process.stderr.strip().splitlines()[-1])
+    return json.loads(process.stdout)
+
+
+def median_ms(statement: str, runs: int):
+    results = [measure(statement) for _ in range(runs)]
+    return (
+        statistics.median(result["seconds"] for result in results) * 1e3,
+        results[-1]["driver_modules"],
+        results[-1]["numpy"],
+    )
+
+
+def _report(name: str, duration: float, budget: float, numpy=False) -> bool:
+    ok = duration <= budget and not numpy
+    print(
+        f"{name:12} {duration:8.1f} ms  budget {budget:7.1f} ms  "
+        f"{'ok' if ok else 'FAILED'}"
+    )
+    if numpy:
+        print(f"  {name} imported NumPy")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="scale the budgets, e.g. for machines slower than a Pi 3B+",
+    )
+    args = parser.parse_args()
+
+    failed = False
+
+    (duration, drivers, numpy) = median_ms(f"from {PACKAGE} import registry", args.runs)
+    failed |= not _report("registry", duration, REGISTRY_BUDGET * args.scale, numpy)
+    if drivers:
+        failed = True
+        print(f"  registry imported driver modules: {', '.join(drivers)}")
+
+    for (module, budget) in sorted(MODULE_BUDGETS.items()):
+        (duration, _, numpy) = median_ms(f"from {PACKAGE} import {module}", args.runs)
+        failed |= not _report(module, duration, budget * args.scale, numpy)
+
+    for name in sorted(registry.DRIVERS):
+        statement = f"from {PACKAGE} import registry; registry.get({name!r})"
+        try:
+            (duration, _, numpy) = median_ms(statement, args.runs)
+        except ImportError as e:
+            print(f"{name:12} skipped: {e}")
+            continue
+
+        budget = DRIVER_BUDGETS.get(name, DEFAULT_DRIVER_BUDGET) * args.scale
+        numpy &= name not in NUMPY_DRIVERS
+        failed |= not _report(name, duration, budget, numpy)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,7 +16,8 @@ setup(name='astroplant-peripheral-device-library',
       author='AstroPlant',
       author_email='thomas@kepow.org',
       url='https://astroplant.io',
-      packages=['astroplant_peripheral_device_library',],
+      packages=['astroplant_peripheral_device_library',
+                'astroplant_peripheral_device_library.emulation',],
       install_requires=requirements,
      )
 